@@ -0,0 +1,79 @@
+"""
+Compare the per-request latency of the Gradio API and the REST API of app.py.
+
+Both paths run the same question and image on the same model, so the
+difference between them is the serving overhead. Short answers make it
+stand out: ask a question with a one-word answer.
+
+Usage:
+python3 api_bench.py --image-file /workspace/brain.jpg --num-requests 20
+"""
+import argparse
+import base64
+import json
+import statistics
+import time
+
+from gradio_client import Client, handle_file
+import requests
+
+SERVER_URL = "http://localhost:5011"
+
+
+def time_requests(fn, num_requests):
+    fn()  # warm up, loads the model
+    latencies = []
+    for _ in range(num_requests):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def summary(latencies):
+    latencies = sorted(latencies)
+    return {
+        "mean_s": round(statistics.mean(latencies), 4),
+        "p50_s": round(latencies[len(latencies) // 2], 4),
+        "p95_s": round(latencies[int(0.95 * (len(latencies) - 1))], 4),
+    }
+
+
+def main(args):
+    with open(args.image_file, "rb") as f:
+        image_url = "data:image/png;base64," + base64.b64encode(f.read()).decode()
+
+    client = Client(args.server_url)
+    session = requests.Session()
+
+    def gradio_call():
+        client.predict("Analyze Image", args.model, args.question,
+                       handle_file(args.image_file), api_name="/process_input")
+
+    def rest_call():
+        r = session.post(args.server_url + "/v1/chat/completions", json={
+            "model": args.model,
+            "messages": [{"role": "user", "content": [
+                {"type": "text", "text": args.question},
+                {"type": "image_url", "image_url": {"url": image_url}},
+            ]}],
+        })
+        r.raise_for_status()
+
+    results = {
+        "gradio": summary(time_requests(gradio_call, args.num_requests)),
+        "rest": summary(time_requests(rest_call, args.num_requests)),
+    }
+    results["rest_saves_s"] = round(results["gradio"]["mean_s"] - results["rest"]["mean_s"], 4)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--server-url", type=str, default=SERVER_URL)
+    parser.add_argument("--model", type=str, default="HealthGPT-M3")
+    parser.add_argument("--question", type=str, default="Which organ is shown? Answer in one word.")
+    parser.add_argument("--image-file", type=str, required=True)
+    parser.add_argument("--num-requests", type=int, default=20)
+    args = parser.parse_args()
+    main(args)
@@ -1,6 +1,17 @@
+import os
+import threading
 import traceback
 
-from model import HealthGPT, HealthGPT_Agent
+from llava.utils import locked_stream
+
+from fastapi import FastAPI
+import uvicorn
+
+if os.environ.get("HEALTHGPT_STUB_MODEL"):
+    # No weights, for load tests and CI, see stub_model.py
+    from stub_model import StubHealthGPT_Agent as HealthGPT_Agent
+else:
+    from model import HealthGPT, HealthGPT_Agent
 from config import HealthGPTConfig_M3_COM, HealthGPTConfig_M3_GEN, HealthGPTConfig_L14_COM
 
 configs = {
@@ -10,46 +21,55 @@ configs = {
 }
 
 agent = HealthGPT_Agent(configs=configs, model_name=None)
+# The UI and the REST API share the agent, which holds one model at a time
+agent_lock = threading.Lock()
 
 # HealthGPT interface
 import gradio as gr
 from PIL import Image, ImageDraw
 
 def process_input(option, model_name, text, image):
+    # A generator, so Gradio stops it when the user leaves the page or an API
+    # call times out; closing the stream cancels decoding at the next step.
     if not text.strip():
-        return (
+        yield (
             gr.update(value="⚠️ Please input your question.", visible=True),
             gr.update(value=None, visible=False),
         )
+        return
     try:
         if option == "Analyze Image":
             model_name = model_name + "-COM"
-            try:
-                agent.load_model(model_name=model_name)
-                resp = agent.process(option, text, image)
-            except Exception as e:
-                agent.load_model(model_name=model_name)
-                resp = agent.process(option, text, image)
-            return (
-                gr.update(value=resp, visible=True),
-                gr.update(value=None, visible=False),
-            )
-
         elif option == "Generate Image":
             model_name = model_name + "-GEN"
+        cancel_event = threading.Event()
+
+        def start():
             try:
                 agent.load_model(model_name=model_name)
-                resp = agent.process(option, text, image)
             except Exception as e:
                 agent.load_model(model_name=model_name)
-                resp = agent.process(option, text, image)
-            return (
-                gr.update(value=None, visible=False),
-                gr.update(value=resp, visible=True),
-            )
+            return agent.process_stream(option, text, image, cancel_event)
+
+        # agent_lock is held by the decoding thread, not across the yields below, so a
+        # client that goes away mid-stream cannot keep the agent locked
+        for partial, resp in locked_stream(agent_lock, start, cancel_event):
+            if option == "Analyze Image":
+                yield (
+                    gr.update(value=resp if resp is not None else partial, visible=True),
+                    gr.update(value=None, visible=False),
+                )
+            elif resp is not None:
+                yield (
+                    gr.update(value=None, visible=False),
+                    gr.update(value=resp, visible=True),
+                )
+            else:
+                # No visible progress for image generation, but yielding lets Gradio cancel it
+                yield gr.update(), gr.update()
     except Exception as e:
         print(traceback.format_exc())
-        return (
+        yield (
             gr.update(value=f"⚠️ {e.args[0]}", visible=True),
             gr.update(value=None, visible=False),
         )
@@ -90,6 +110,13 @@ For an optimal experience, please use desktop computers for this demo, as mobile
 
     demo.css = """footer {display: none !important;}"""
 
-# Start Gradio website
-# show_api=True enables API documentation at /docs
-demo.launch(server_name="0.0.0.0", server_port=5011, show_api=True)
+# Start Gradio website and the REST API (see rest_api.py) in one server
+# /docs documents the REST API
+# The queue is required for streaming outputs and cancels them on disconnect
+from rest_api import create_router
+
+app = FastAPI()
+app.include_router(create_router(agent, configs, agent_lock))
+demo.queue()
+app = gr.mount_gradio_app(app, demo, path="/")
+uvicorn.run(app, host="0.0.0.0", port=5011)
@@ -0,0 +1,65 @@
+"""
+Check that a client leaving mid-stream does not keep the agent of app.py locked.
+
+A streaming request is dropped after its first tokens, through the REST API and
+through the Gradio API, and a second request then has to finish well before the
+dropped answer would have. Run it against the stub model with long answers, so
+that an answer left decoding holds the agent for 20 seconds:
+
+HEALTHGPT_STUB_MODEL=1 HEALTHGPT_STUB_NUM_TOKENS=1000 python3 app.py
+python3 check_disconnect.py
+"""
+import argparse
+import json
+import time
+
+from gradio_client import Client
+import requests
+
+SERVER_URL = "http://localhost:5011"
+
+
+def ask(server_url, model, stream):
+    return requests.post(server_url + "/v1/chat/completions", json={
+        "model": model,
+        "messages": [{"role": "user", "content": "Which organ is shown?"}],
+        "stream": stream,
+    }, stream=stream, timeout=600)
+
+
+def drop_rest_stream(args):
+    with ask(args.server_url, args.model, stream=True) as r:
+        for line in r.iter_lines():
+            if line.startswith(b"data: ") and "content" in json.loads(line[6:])["choices"][0]["delta"]:
+                break
+
+
+def drop_gradio_stream(args):
+    job = Client(args.server_url).submit("Analyze Image", args.model, "Which organ is shown?", None,
+                                         api_name="/process_input")
+    while not job.outputs():
+        time.sleep(0.05)
+    job.cancel()
+
+
+def time_next_request(args):
+    start = time.perf_counter()
+    ask(args.server_url, args.model, stream=False).raise_for_status()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--server-url", type=str, default=SERVER_URL)
+    parser.add_argument("--model", type=str, default="HealthGPT-M3")
+    parser.add_argument("--max-seconds", type=float, default=5.0,
+                        help="Time allowed for the request after the dropped one, plus its own answer.")
+    args = parser.parse_args()
+
+    baseline = time_next_request(args)
+    print(f"request on an idle agent: {baseline:.2f}s")
+    for name, drop in (("REST", drop_rest_stream), ("Gradio", drop_gradio_stream)):
+        drop(args)
+        seconds = time_next_request(args)
+        print(f"request after a dropped {name} stream: {seconds:.2f}s")
+        assert seconds < baseline + args.max_seconds, f"the dropped {name} stream kept the agent locked"
@@ -15,6 +15,10 @@ class HealthGPTConfig_M3_COM:
     hlora_nums = 4
     vq_idx_nums = 8192
     instruct_template = "phi3_instruct"
+    # Opt-in: the fast tokenizer, kept only if its ids match the slow one on probe
+    # prompts of instruct_template. Probes cannot cover every input, so verify on
+    # your own prompts before turning it on.
+    use_fast_tokenizer = False
     vit_path = "/workspace/clip-vit-large-patch14-336"
     hlora_path = "/workspace/HealthGPT-M3/com_hlora_weights.bin"
     fusion_layer_path = "/workspace/HealthGPT-M3/fusion_layer_weights.bin"
@@ -24,6 +28,24 @@ class HealthGPTConfig_M3_COM:
     num_beams = 1
     max_new_tokens = 2048
     task_type = "comprehension"
+    # Weight-only quantization of the frozen base linears (None, 8 or 4), done
+    # when the H-LoRA layers wrap them. H-LoRA experts and router stay in `dtype`.
+    quant_bits = None
+    quant_group_size = 128
+
+
+# CPU-only profile of HealthGPT-M3 comprehension for edge nodes.
+# - dtype: "BF16" on CPUs with AVX512-BF16/AMX, otherwise "FP32"
+# - num_threads: intra-op threads, None keeps torch's default (one per core)
+# - channels_last: NHWC vision preprocessing for oneDNN convolutions
+# - compile_decode: torch.compile the language model forward (slow first call)
+class HealthGPTConfig_M3_COM_CPU(HealthGPTConfig_M3_COM):
+    device = "cpu"
+    device_map = None
+    dtype = "BF16"
+    num_threads = None
+    channels_last = True
+    compile_decode = False
 
 
 class HealthGPTConfig_M3_GEN:
@@ -38,6 +60,7 @@ class HealthGPTConfig_M3_GEN:
     hlora_nums = 4
     vq_idx_nums = 8192
     instruct_template = "phi3_instruct"
+    use_fast_tokenizer = False
     vit_path = "./clip-vit-large-patch14-336/"
     hlora_path = "./HealthGPT-M3/gen_hlora_weights.bin"
     fusion_layer_path = "./HealthGPT-M3/fusion_layer_weights.bin"
@@ -48,6 +71,8 @@ class HealthGPTConfig_M3_GEN:
     max_new_tokens = 2048
     save_path = "output.png"
     task_type = "generation"
+    quant_bits = None
+    quant_group_size = 128
 
 
 class HealthGPTConfig_L14_COM:
@@ -62,6 +87,7 @@ class HealthGPTConfig_L14_COM:
     hlora_nums = 4
     vq_idx_nums = 8192
     instruct_template = "phi4_instruct"
+    use_fast_tokenizer = False
     vit_path = "./clip-vit-large-patch14-336/"
     hlora_path = "./HealthGPT-L14/com_hlora_weights_phi4.bin"
     fusion_layer_path = None
@@ -71,3 +97,5 @@ class HealthGPTConfig_L14_COM:
     num_beams = 1
     max_new_tokens = 2048
     task_type = "comprehension"
+    quant_bits = None
+    quant_group_size = 128
@@ -0,0 +1,74 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+import json
+import time
+import argparse
+import platform
+import torch
+from PIL import Image
+
+from model import HealthGPT
+from config import HealthGPTConfig_M3_COM_CPU
+
+
+def bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_name_or_path', type=str, default=None)
+    parser.add_argument('--vit_path', type=str, default=None)
+    parser.add_argument('--hlora_path', type=str, default=None)
+    parser.add_argument('--fusion_layer_path', type=str, default=None)
+    parser.add_argument('--dtype', type=str, default=None, choices=['BF16', 'FP32'])
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--compile_decode', action='store_true')
+    parser.add_argument('--no_channels_last', action='store_true')
+    parser.add_argument('--max_new_tokens', type=int, default=128)
+    parser.add_argument('--question', type=str, default='What problems are there with this image?')
+    parser.add_argument('--img_path', type=str, default=None)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--iters', type=int, default=3)
+    args = parser.parse_args()
+
+    config = HealthGPTConfig_M3_COM_CPU()
+    for key in ['model_name_or_path', 'vit_path', 'hlora_path', 'fusion_layer_path', 'dtype', 'num_threads']:
+        if getattr(args, key) is not None:
+            setattr(config, key, getattr(args, key))
+    config.compile_decode = args.compile_decode
+    config.channels_last = not args.no_channels_last
+    config.max_new_tokens = args.max_new_tokens
+
+    start = time.perf_counter()
+    model = HealthGPT(config)
+    load_s = time.perf_counter() - start
+
+    image = Image.open(args.img_path).convert('RGB') if args.img_path else None
+    for _ in range(args.warmup):
+        model.infer(args.question, image)
+
+    latencies, tokens = [], []
+    for _ in range(args.iters):
+        start = time.perf_counter()
+        response = model.infer(args.question, image)
+        latencies.append(time.perf_counter() - start)
+        # Re-tokenize the answer; close to the generated count up to special tokens
+        tokens.append(len(model.tokenizer(response, add_special_tokens=False).input_ids))
+
+    report = {
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "torch": torch.__version__,
+        "num_threads": torch.get_num_threads(),
+        "dtype": config.dtype,
+        "channels_last": config.channels_last,
+        "compile_decode": config.compile_decode,
+        "load_s": round(load_s, 2),
+        "latency_s": [round(x, 3) for x in latencies],
+        "output_tokens": tokens,
+        "tokens_per_s": round(sum(tokens) / sum(latencies), 2),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+
+    bench()
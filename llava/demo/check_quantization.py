@@ -0,0 +1,108 @@
+"""
+Check the H-LoRA weight-only quantization kernels on random weights, on CPU.
+
+For int8 and int4 and a range of shapes, including input features that are not
+a multiple of the group size (one scale per row then), quantize_weight /
+dequantize_weight must round trip every weight to within half a quantization
+step of its group, and quantized_linear must match
+F.linear(x, dequantize_weight(...), bias) for several block sizes.
+
+Usage:
+python3 check_quantization.py --trials 5
+"""
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+import argparse
+import torch
+import torch.nn.functional as F
+from llava.peft.tuners.lora import quantize_weight, dequantize_weight, quantized_linear
+
+# (out_features, in_features, group_size); the last ones are not a multiple of the group size
+SHAPES = [(64, 256, 128), (48, 384, 64), (32, 1024, 128), (16, 3072, 128),
+          (32, 200, 128), (24, 96, 64), (8, 130, 128), (8, 62, 0)]
+BLOCK_FEATURES = [1024, 256, 64, 1]
+
+
+def random_weight(out_features, in_features, generator):
+    weight = torch.randn(out_features, in_features, generator=generator) * 0.02
+    # A few outliers, which set the scale of their group
+    rows = torch.randint(out_features, (4,), generator=generator)
+    cols = torch.randint(in_features, (4,), generator=generator)
+    weight[rows, cols] *= 50
+    return weight
+
+
+def check_round_trip(weight, bits, group_size):
+    """Failures of the quantize / dequantize round trip, and its relative error."""
+    out_features, in_features = weight.shape
+    qweight, scale = quantize_weight(weight, bits, group_size)
+    groups = in_features // group_size if group_size > 0 and in_features % group_size == 0 else 1
+    failures = []
+    expected_shape = (out_features, in_features // 2 if bits == 4 else in_features)
+    if qweight.dtype != (torch.uint8 if bits == 4 else torch.int8) or tuple(qweight.shape) != expected_shape:
+        failures.append(f"qweight is {qweight.dtype} {tuple(qweight.shape)}")
+    if tuple(scale.shape) != (out_features, groups):
+        failures.append(f"scale has shape {tuple(scale.shape)}, expected {(out_features, groups)}")
+        return failures, float("nan")
+
+    dequantized = dequantize_weight(qweight, scale, bits, dtype=torch.float32)
+    # Symmetric rounding is off by at most half a step, the largest weight of a group is exact
+    bound = scale.repeat_interleave(in_features // groups, dim=1) / 2
+    excess = (dequantized - weight).abs() - bound * (1 + 1e-5)
+    if excess.max() > 1e-7:
+        failures.append(f"round trip error exceeds half a step by {excess.max().item():.3g}")
+    return failures, ((dequantized - weight).norm() / weight.norm()).item()
+
+
+def check_linear(weight, bits, group_size, generator):
+    """Failures of quantized_linear against F.linear on the dequantized weight."""
+    out_features, in_features = weight.shape
+    qweight, scale = quantize_weight(weight, bits, group_size)
+    x = torch.randn(2, 5, in_features, generator=generator)
+    bias = torch.randn(out_features, generator=generator)
+    expected = F.linear(x, dequantize_weight(qweight, scale, bits, dtype=torch.float32), bias)
+    failures = []
+    for block_features in BLOCK_FEATURES:
+        actual = quantized_linear(x, qweight, scale, bits, bias, block_features=block_features)
+        if actual.shape != expected.shape or not torch.allclose(actual, expected, rtol=1e-4, atol=1e-5):
+            error = (actual - expected).abs().max().item() if actual.shape == expected.shape else float("nan")
+            failures.append(f"quantized_linear with block_features={block_features} is off by {error:.3g}")
+    return failures
+
+
+def check(trials, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    failures = []
+    for bits in (8, 4):
+        for out_features, in_features, group_size in SHAPES:
+            errors = []
+            for trial in range(trials):
+                weight = random_weight(out_features, in_features, generator)
+                trial_failures, error = check_round_trip(weight, bits, group_size)
+                trial_failures += check_linear(weight, bits, group_size, generator)
+                failures += [f"int{bits} {out_features}x{in_features} group {group_size}: {f}" for f in trial_failures]
+                errors.append(error)
+            print(f"int{bits} {out_features}x{in_features} group {group_size}: "
+                  f"mean relative error {sum(errors) / len(errors):.4f}")
+
+    # Packed int4 needs pairs of input features
+    try:
+        quantize_weight(torch.randn(8, 131), 4, 128)
+        failures.append("int4 quantization of an odd number of input features did not raise")
+    except ValueError:
+        pass
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trials', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    failures = check(args.trials, args.seed)
+    for failure in failures:
+        print(failure)
+    assert not failures, f"{len(failures)} quantization checks failed"
+    print("all quantization checks passed")
@@ -0,0 +1,181 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+import json
+import time
+import argparse
+import torch
+import transformers
+from llava.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN
+from llava import conversation as conversation_lib
+from llava.mm_utils import tokenizer_image_token
+from llava.model.language_model.llava_phi3 import LlavaPhiForCausalLM
+from llava.peft import LoraConfig, get_peft_model
+from llava.peft.tuners.lora import Linear as HLoraLinear, dequantize_weight
+from PIL import Image
+from utils import find_all_linear_names, add_special_tokens_and_resize_model, load_weights, expand2square, com_vision_args
+
+
+def build_model(args, model_dtype):
+    model = LlavaPhiForCausalLM.from_pretrained(
+        pretrained_model_name_or_path=args.model_name_or_path,
+        attn_implementation=args.attn_implementation,
+        torch_dtype=model_dtype,
+        low_cpu_mem_usage=True,
+    )
+    lora_config = LoraConfig(
+        r=args.hlora_r,
+        lora_alpha=args.hlora_alpha,
+        target_modules=find_all_linear_names(model),
+        lora_dropout=args.hlora_dropout,
+        bias='none',
+        task_type="CAUSAL_LM",
+        lora_nums=args.hlora_nums,
+    )
+    model = get_peft_model(model, lora_config)
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained(
+        args.model_name_or_path,
+        padding_side="right",
+        use_fast=False,
+    )
+    add_special_tokens_and_resize_model(tokenizer, model, args.vq_idx_nums)
+
+    com_vision_args.model_name_or_path = args.model_name_or_path
+    com_vision_args.vision_tower = args.vit_path
+    com_vision_args.version = args.instruct_template
+    model.get_model().initialize_vision_modules(model_args=com_vision_args)
+    model.get_vision_tower().to(dtype=model_dtype)
+
+    model = load_weights(model, args.hlora_path, args.fusion_layer_path)
+    model.eval()
+    model.to(device=args.device, dtype=model_dtype)
+    return model, tokenizer
+
+
+def run_question(args, model, tokenizer, model_dtype):
+    if args.img_path:
+        qs = DEFAULT_IMAGE_TOKEN + '\n' + args.question
+    else:
+        qs = args.question
+    conv = conversation_lib.conv_templates[args.instruct_template].copy()
+    conv.append_message(conv.roles[0], qs)
+    conv.append_message(conv.roles[1], None)
+    prompt = conv.get_prompt()
+    input_ids = tokenizer_image_token(prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt').unsqueeze_(0).to(args.device)
+    image_tensor, image_size = None, None
+    if args.img_path:
+        vision_tower = model.get_vision_tower()
+        image = Image.open(args.img_path).convert('RGB')
+        image = expand2square(image, tuple(int(x*255) for x in vision_tower.image_processor.image_mean))
+        image_tensor = vision_tower.image_processor.preprocess(image, return_tensors='pt')['pixel_values'][0].unsqueeze_(0)
+        image_tensor = image_tensor.to(dtype=model_dtype, device=args.device)
+        image_size = image.size
+
+    start = time.perf_counter()
+    with torch.inference_mode():
+        output_ids = model.base_model.model.generate(
+            input_ids,
+            images=image_tensor,
+            image_sizes=image_size,
+            do_sample=False,
+            num_beams=1,
+            max_new_tokens=args.max_new_tokens,
+            use_cache=True)
+    latency = time.perf_counter() - start
+    output_ids = output_ids[0].tolist()
+    return {
+        "latency_s": round(latency, 3),
+        "new_tokens": len(output_ids),
+        "tokens_per_s": round(len(output_ids) / latency, 2),
+        "output_ids": output_ids,
+        "text": tokenizer.decode(output_ids, skip_special_tokens=True),
+    }
+
+
+def base_weight_bytes(model):
+    total = 0
+    for module in model.modules():
+        if isinstance(module, HLoraLinear):
+            if module.quant_bits is None:
+                total += module.weight.numel() * module.weight.element_size()
+            else:
+                total += module.weight_q.numel() * module.weight_q.element_size()
+                total += module.weight_scale.numel() * module.weight_scale.element_size()
+    return total
+
+
+def quantize_model(args, model):
+    """Quantize every H-LoRA base weight in place and return the relative reconstruction error per layer."""
+    errors = {}
+    for name, module in model.named_modules():
+        if not isinstance(module, HLoraLinear) or module.quant_bits is not None:
+            continue
+        weight = module.weight.data
+        module.quantize_weight(args.bits, args.group_size)
+        dequantized = dequantize_weight(module.weight_q, module.weight_scale, args.bits, dtype=torch.float32)
+        error = (dequantized - weight.float()).norm() / weight.float().norm().clamp(min=1e-8)
+        errors[name] = error.item()
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_name_or_path', type=str, default='microsoft/Phi-3-mini-4k-instruct')
+    parser.add_argument('--dtype', type=str, default='FP32')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--attn_implementation', type=str, default=None)
+    parser.add_argument('--hlora_r', type=int, default=64)
+    parser.add_argument('--hlora_alpha', type=int, default=128)
+    parser.add_argument('--hlora_dropout', type=float, default=0.0)
+    parser.add_argument('--hlora_nums', type=int, default=4)
+    parser.add_argument('--vq_idx_nums', type=int, default=8192)
+    parser.add_argument('--instruct_template', type=str, default='phi3_instruct')
+    parser.add_argument('--vit_path', type=str, default='openai/clip-vit-large-patch14-336')
+    parser.add_argument('--hlora_path', type=str, default=None)
+    parser.add_argument('--fusion_layer_path', type=str, default=None)
+    parser.add_argument('--bits', type=int, default=8, choices=[8, 4])
+    parser.add_argument('--group_size', type=int, default=128)
+    # Optional accuracy / latency comparison against the unquantized model
+    parser.add_argument('--question', type=str, default=None)
+    parser.add_argument('--img_path', type=str, default=None)
+    parser.add_argument('--max_new_tokens', type=int, default=128)
+    parser.add_argument('--report_path', type=str, default=None)
+    args = parser.parse_args()
+
+    model_dtype = torch.float32 if args.dtype == 'FP32' else (torch.float16 if args.dtype == 'FP16' else torch.bfloat16)
+    model, tokenizer = build_model(args, model_dtype)
+
+    report = {"bits": args.bits, "group_size": args.group_size, "dtype": args.dtype, "device": args.device}
+    if args.question:
+        report["reference"] = run_question(args, model, tokenizer, model_dtype)
+    report["base_weight_bytes"] = base_weight_bytes(model)
+
+    errors = quantize_model(args, model)
+    report["quantized_base_weight_bytes"] = base_weight_bytes(model)
+    report["mean_relative_error"] = sum(errors.values()) / max(len(errors), 1)
+    report["max_relative_error"] = max(errors.values(), default=0.0)
+
+    if args.question:
+        quantized = run_question(args, model, tokenizer, model_dtype)
+        reference_ids = report["reference"]["output_ids"]
+        matched = 0
+        for ref, out in zip(reference_ids, quantized["output_ids"]):
+            if ref != out:
+                break
+            matched += 1
+        quantized["matching_prefix_tokens"] = matched
+        quantized["exact_match"] = reference_ids == quantized["output_ids"]
+        report["quantized"] = quantized
+        for run in (report["reference"], report["quantized"]):
+            del run["output_ids"]
+
+    print(json.dumps(report, indent=2))
+    if args.report_path:
+        with open(args.report_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,43 @@
+#!/bin/bash
+
+# HealthGPT-M3: quantize the frozen Phi-3 linears to int8 on CPU and compare with the FP32 model
+MODEL_NAME_OR_PATH="microsoft/Phi-3-mini-4k-instruct"
+VIT_PATH="openai/clip-vit-large-patch14-336/"
+HLORA_PATH="com_hlora_weights.bin"
+FUSION_LAYER_PATH="fusion_layer_weights.bin"
+
+python3 quantize_hlora.py \
+    --model_name_or_path "$MODEL_NAME_OR_PATH" \
+    --dtype "FP32" \
+    --device "cpu" \
+    --hlora_r "64" \
+    --hlora_alpha "128" \
+    --hlora_nums "4" \
+    --vq_idx_nums "8192" \
+    --instruct_template "phi3_instruct" \
+    --vit_path "$VIT_PATH" \
+    --hlora_path "$HLORA_PATH" \
+    --fusion_layer_path "$FUSION_LAYER_PATH" \
+    --bits "8" \
+    --group_size "128" \
+    --report_path "m3_int8_report.json" \
+    --question "Your question" \
+    --img_path "path/to/image.jpg"
+
+# HealthGPT-L14: int4 Phi-4 base weights
+python3 quantize_hlora.py \
+    --model_name_or_path "microsoft/Phi-4" \
+    --dtype "BF16" \
+    --device "cpu" \
+    --hlora_r "32" \
+    --hlora_alpha "64" \
+    --hlora_nums "4" \
+    --vq_idx_nums "8192" \
+    --instruct_template "phi4_instruct" \
+    --vit_path "$VIT_PATH" \
+    --hlora_path "com_hlora_weights_phi4.bin" \
+    --bits "4" \
+    --group_size "128" \
+    --report_path "l14_int4_report.json" \
+    --question "Your question" \
+    --img_path "path/to/image.jpg"
@@ -6,6 +6,8 @@ from dataclasses import dataclass, field
 import argparse
 from PIL import Image
 
+from llava.mm_utils import tokenizer_image_token
+
 def expand2square(pil_img, background_color):
     width, height = pil_img.size
     if width == height:
@@ -57,6 +59,37 @@ def add_special_tokens_and_resize_model(tokenizer, model, vq_idx_nums=8192):
     
     return num_new_tokens
 
+def load_fast_tokenizer(model_name_or_path, slow_tokenizer, probe_texts=()):
+    """
+    Loads the fast tokenizer of `model_name_or_path` with the special tokens added to `slow_tokenizer`.
+    Returns `slow_tokenizer` unchanged if there is no fast tokenizer or the two disagree on any probe text.
+    Probe texts are tokenized the way prompts are, split around `<image>` by `tokenizer_image_token`.
+    """
+    try:
+        fast_tokenizer = transformers.AutoTokenizer.from_pretrained(
+            model_name_or_path,
+            padding_side=slow_tokenizer.padding_side,
+            use_fast=True,
+        )
+    except Exception as e:
+        print(f"Warning: fast tokenizer unavailable, keeping the slow tokenizer: {e}")
+        return slow_tokenizer
+    if not fast_tokenizer.is_fast:
+        return slow_tokenizer
+    if len(slow_tokenizer.additional_special_tokens) != 0:
+        fast_tokenizer.add_special_tokens({'additional_special_tokens': slow_tokenizer.additional_special_tokens})
+    if len(fast_tokenizer) != len(slow_tokenizer):
+        print(f"Warning: fast tokenizer has {len(fast_tokenizer)} tokens, slow has {len(slow_tokenizer)}; keeping the slow tokenizer")
+        return slow_tokenizer
+    for text in probe_texts:
+        slow_ids = tokenizer_image_token(text, slow_tokenizer)
+        if tokenizer_image_token(text, fast_tokenizer) != slow_ids or \
+                fast_tokenizer.decode([i for i in slow_ids if i >= 0], skip_special_tokens=True) != \
+                slow_tokenizer.decode([i for i in slow_ids if i >= 0], skip_special_tokens=True):
+            print(f"Warning: fast and slow tokenizers disagree on {text!r}; keeping the slow tokenizer")
+            return slow_tokenizer
+    return fast_tokenizer
+
 com_vision_args = argparse.Namespace(
     freeze_backbone=False,
     mm_patch_merge_type='flat',
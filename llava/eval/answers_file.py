@@ -0,0 +1,102 @@
+"""
+Resumable answers files for the eval scripts.
+
+Answers are appended and flushed as they are produced, so a crashed or
+killed run keeps everything it finished. Rerunning the same command skips
+the questions that already have an answer.
+"""
+import json
+import os
+import time
+
+
+def answer_key(record):
+    """Identifies an answer: MMBench writes one per (question, round), the others one per question."""
+    return record["question_id"], record.get("round_id")
+
+
+def read_answers(path):
+    """Complete answer records of `path`; a partly written last line is ignored."""
+    records = []
+    with open(path) as f:
+        for line in f:
+            if line.endswith("\n") and line.strip():
+                records.append(json.loads(line))
+    return records
+
+
+def iter_answers(path, follow=None, poll_interval=1.0, done=None):
+    """
+    Answer records of `path`, one at a time.
+
+    With `follow` (seconds), lines appended by a running eval are read as
+    they arrive, until none arrived for `follow` seconds or `done()` is true;
+    a line is only read once its newline is written. Without `follow` the file
+    is complete, and a last line without a newline is read as well.
+    """
+    with open(path) as f:
+        pending = ""
+        idle_since = time.monotonic()
+        while done is None or not done():
+            line = f.readline()
+            if line:
+                pending += line
+                if not pending.endswith("\n"):
+                    continue
+                line, pending = pending, ""
+                idle_since = time.monotonic()
+                if line.strip():
+                    yield json.loads(line)
+            elif follow is None:
+                if pending.strip():
+                    yield json.loads(pending)
+                return
+            elif time.monotonic() - idle_since > follow:
+                return
+            else:
+                time.sleep(poll_interval)
+
+
+class AnswersFile(object):
+    def __init__(self, path, resume=True, flush_every=1):
+        self.path = path
+        self.flush_every = flush_every
+        self.num_written = 0
+        self.answered = set()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if resume and os.path.exists(path):
+            self.answered = {answer_key(r) for r in read_answers(path)}
+            # Drop a partly written last line so that appended answers start on a line of their own
+            with open(path, "rb+") as f:
+                data = f.read()
+                f.truncate(data.rfind(b"\n") + 1)
+            if self.answered:
+                print(f"Resuming {path}: {len(self.answered)} answers already there.")
+        self.file = open(path, "a" if resume else "w")
+
+    def has(self, question_id, round_id=None):
+        return (question_id, round_id) in self.answered
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.answered.add(answer_key(record))
+        self.num_written += 1
+        if self.num_written % self.flush_every == 0:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def merge_answers_files(paths, output):
+    """Concatenate `paths` into `output` in order, keeping the first answer of every question."""
+    seen = set()
+    with open(output, "w") as f:
+        for path in paths:
+            for record in read_answers(path):
+                key = answer_key(record)
+                if key in seen:
+                    continue
+                seen.add(key)
+                f.write(json.dumps(record) + "\n")
+    return len(seen)
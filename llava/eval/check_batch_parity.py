@@ -0,0 +1,48 @@
+"""
+Check that batched model_vqa_loader runs answer exactly like batch size 1.
+
+model_vqa_loader runs greedily on the same questions at batch size 1 and at
+--batch-size, and the two answers files must hold the same records in the same
+order; only the random answer_id may differ. Arguments after `--` are passed to
+both runs.
+
+Usage:
+python3 -m llava.eval.check_batch_parity --batch-size 8 -- \
+    --model-path liuhaotian/llava-v1.5-7b --question-file questions.jsonl --image-folder images
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+
+def run(answers_file, batch_size, extra_args):
+    subprocess.run([sys.executable, "-m", "llava.eval.model_vqa_loader", "--answers-file", answers_file,
+                    "--batch-size", str(batch_size), "--temperature", "0", "--overwrite"] + extra_args,
+                   check=True)
+    with open(answers_file) as f:
+        records = [json.loads(line) for line in f]
+    for record in records:
+        record.pop("answer_id")
+    return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("extra_args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    extra_args = args.extra_args[1:] if args.extra_args[:1] == ["--"] else args.extra_args
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        reference = run(os.path.join(tmp_dir, "batch1.jsonl"), 1, extra_args)
+        batched = run(os.path.join(tmp_dir, f"batch{args.batch_size}.jsonl"), args.batch_size, extra_args)
+
+    assert len(reference) == len(batched), f"{len(reference)} answers at batch size 1, {len(batched)} batched"
+    differ = [(a, b) for a, b in zip(reference, batched) if a != b]
+    for a, b in differ[:10]:
+        print(f"question {a['question_id']}:\n  batch size 1: {a['text']!r}\n  batched: {b['text']!r}")
+    assert not differ, f"{len(differ)} of {len(reference)} answers differ from batch size 1"
+    print(f"{len(reference)} answers match batch size 1")
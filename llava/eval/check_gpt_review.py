@@ -0,0 +1,82 @@
+"""
+Check ReviewClient against the local OpenAI stub with rate limiting on.
+
+The stub (llava/eval/openai_stub_server.py) answers a share of requests with
+429. Reviews of distinct contents are requested twice with a fresh cache:
+the first run must retry the 429s and return every review in the order of
+the contents, the second run must be served from the cache without a single
+request.
+
+Usage:
+python3 -m llava.eval.check_gpt_review --rate-limit-prob 0.3
+"""
+import argparse
+import hashlib
+import json
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from llava.eval.gpt_review import ReviewClient
+
+
+def stub_review(request):
+    """The review the stub gives `request`, see openai_stub_server.chat_completions."""
+    digest = hashlib.sha256(json.dumps(request["messages"], sort_keys=True).encode()).digest()
+    return f"{digest[0] % 10 + 1} {digest[1] % 10 + 1}\nStub review."
+
+
+def get_stats(api_base):
+    return httpx.get(api_base.rsplit("/v1", 1)[0] + "/stats").json()
+
+
+def wait_for_server(api_base, timeout=30):
+    start = time.time()
+    while True:
+        try:
+            return get_stats(api_base)
+        except httpx.TransportError:
+            if time.time() - start > timeout:
+                raise
+            time.sleep(0.2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8101)
+    parser.add_argument("--rate-limit-prob", type=float, default=0.3)
+    parser.add_argument("--num-reviews", type=int, default=50)
+    args = parser.parse_args()
+
+    api_base = f"http://localhost:{args.port}/v1"
+    server = subprocess.Popen([sys.executable, "-m", "llava.eval.openai_stub_server", "--port", str(args.port),
+                               "--rate-limit-prob", str(args.rate_limit_prob)])
+    try:
+        wait_for_server(api_base)
+        contents = [f"[Question]\nQuestion {i}?\n\n[System]\nRate the answers.\n\n" for i in range(args.num_reviews)]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            client = ReviewClient("gpt-4", api_base=api_base, api_key="stub", concurrency=8,
+                                  requests_per_minute=6000, max_retries=12, cache_dir=cache_dir)
+            expected = [stub_review(client.build_request(content, 64)) for content in contents]
+
+            reported = []
+            reviews = client.review(contents, 64, on_review=lambda i, review: reported.append(i))
+            stats = get_stats(api_base)
+            print(f"first run: {stats['requests']} requests, {stats['rate_limited']} rate limited")
+            assert reviews == expected, "reviews are missing or out of order"
+            assert reported == list(range(len(contents))), "reviews were not reported in order"
+            assert stats["rate_limited"] > 0, "no request was rate limited, raise --rate-limit-prob"
+            assert stats["requests"] == len(contents) + stats["rate_limited"]
+
+            reviews = client.review(contents, 64)
+            second = get_stats(api_base)
+            print(f"second run: {second['requests'] - stats['requests']} requests")
+            assert reviews == expected
+            assert second["requests"] == stats["requests"], "the second run was not served from the cache"
+        print("ok")
+    finally:
+        server.terminate()
+        server.wait()
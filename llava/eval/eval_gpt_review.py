@@ -2,38 +2,7 @@ import argparse
 import json
 import os
 
-import openai
-import tqdm
-import ray
-import time
-
-NUM_SECONDS_TO_SLEEP = 3
-
-@ray.remote(num_cpus=4)
-def get_eval(content: str, max_tokens: int):
-    while True:
-        try:
-            response = openai.ChatCompletion.create(
-                model='gpt-4',
-                messages=[{
-                    'role': 'system',
-                    'content': 'You are a helpful and precise assistant for checking the quality of the answer.'
-                }, {
-                    'role': 'user',
-                    'content': content,
-                }],
-                temperature=0.2,  # TODO: figure out which temperature is best for evaluation
-                max_tokens=max_tokens,
-            )
-            break
-        except openai.error.RateLimitError:
-            pass
-        except Exception as e:
-            print(e)
-        time.sleep(NUM_SECONDS_TO_SLEEP)
-
-    print('success!')
-    return response['choices'][0]['message']['content']
+from llava.eval.gpt_review import add_review_args, review_client_from_args
 
 
 def parse_score(review):
@@ -60,10 +29,9 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--rule')
     parser.add_argument('-o', '--output')
     parser.add_argument('--max-tokens', type=int, default=1024, help='maximum number of tokens produced in the output')
+    add_review_args(parser, model='gpt-4')
     args = parser.parse_args()
 
-    ray.init()
-
     f_q = open(os.path.expanduser(args.question))
     f_ans1 = open(os.path.expanduser(args.answer_list[0]))
     f_ans2 = open(os.path.expanduser(args.answer_list[1]))
@@ -72,7 +40,7 @@ if __name__ == '__main__':
     review_file = open(f'{args.output}', 'w')
 
     js_list = []
-    handles = []
+    contents = []
     idx = 0
     for ques_js, ans1_js, ans2_js in zip(f_q, f_ans1, f_ans2):
         # if idx == 1:
@@ -100,14 +68,23 @@ if __name__ == '__main__':
             'answer2_id': ans2['answer_id'],
             'category': category})
         idx += 1
-        handles.append(get_eval.remote(content, args.max_tokens))
-        # To avoid the rate limit set by OpenAI
-        time.sleep(NUM_SECONDS_TO_SLEEP)
+        contents.append(content)
+
+    # Reviews are written in order as they finish; writing stops at the first failed review, so
+    # the file never holds a review without its content. Finished reviews are cached for the next run
+    num_failed = 0
+
+    def write_review(i, review):
+        global num_failed
+        if review is None or num_failed:
+            num_failed += 1
+            return
+        js_list[i]['content'] = review
+        js_list[i]['tuple'] = parse_score(review)
+        review_file.write(json.dumps(js_list[i]) + '\n')
+        review_file.flush()
 
-    reviews = ray.get(handles)
-    for idx, review in enumerate(reviews):
-        scores = parse_score(review)
-        js_list[idx]['content'] = review
-        js_list[idx]['tuple'] = scores
-        review_file.write(json.dumps(js_list[idx]) + '\n')
+    review_client_from_args(args).review(contents, args.max_tokens, write_review)
     review_file.close()
+    if num_failed:
+        print(f'{num_failed} reviews not written after a failed review, run again to request them.')
@@ -2,35 +2,7 @@ import argparse
 import json
 import os
 
-import openai
-import time
-
-NUM_SECONDS_TO_SLEEP = 0.5
-
-
-def get_eval(content: str, max_tokens: int):
-    while True:
-        try:
-            response = openai.ChatCompletion.create(
-                model='gpt-4-0314',
-                messages=[{
-                    'role': 'system',
-                    'content': 'You are a helpful and precise assistant for checking the quality of the answer.'
-                }, {
-                    'role': 'user',
-                    'content': content,
-                }],
-                temperature=0.2,  # TODO: figure out which temperature is best for evaluation
-                max_tokens=max_tokens,
-            )
-            break
-        except openai.error.RateLimitError:
-            pass
-        except Exception as e:
-            print(e)
-        time.sleep(NUM_SECONDS_TO_SLEEP)
-
-    return response['choices'][0]['message']['content']
+from llava.eval.gpt_review import add_review_args, review_client_from_args
 
 
 def parse_score(review):
@@ -57,6 +29,7 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--rule')
     parser.add_argument('-o', '--output')
     parser.add_argument('--max-tokens', type=int, default=1024, help='maximum number of tokens produced in the output')
+    add_review_args(parser, model='gpt-4-0314')
     args = parser.parse_args()
 
     f_q = open(os.path.expanduser(args.question))
@@ -74,7 +47,7 @@ if __name__ == '__main__':
     context_list = [json.loads(line) for line in open(os.path.expanduser(args.context))]
     image_to_context = {context['image']: context for context in context_list}
 
-    handles = []
+    pending = []
     idx = 0
     for ques_js, ans1_js, ans2_js in zip(f_q, f_ans1, f_ans2):
         ques = json.loads(ques_js)
@@ -105,14 +78,27 @@ if __name__ == '__main__':
             'category': category
         }
         if idx >= len(cur_reviews):
-            review = get_eval(content, args.max_tokens)
-            scores = parse_score(review)
-            cur_js['content'] = review
-            cur_js['tuple'] = scores
-            review_file.write(json.dumps(cur_js) + '\n')
-            review_file.flush()
+            pending.append((cur_js, content))
         else:
             print(f'Skipping {idx} as we already have it.')
         idx += 1
-        print(idx)
+
+    # Reviews are appended in order as they finish; the file is resumed by position, so
+    # writing stops at the first failed review and the next run requests it again
+    num_failed = 0
+
+    def write_review(i, review):
+        global num_failed
+        if review is None or num_failed:
+            num_failed += 1
+            return
+        cur_js = pending[i][0]
+        cur_js['content'] = review
+        cur_js['tuple'] = parse_score(review)
+        review_file.write(json.dumps(cur_js) + '\n')
+        review_file.flush()
+
+    review_client_from_args(args).review([content for _, content in pending], args.max_tokens, write_review)
     review_file.close()
+    if num_failed:
+        print(f'{num_failed} reviews not written after a failed review, run again to resume.')
@@ -2,80 +2,79 @@ import os
 import json
 import argparse
 
-def eval_pope(answers, label_file):
-    label_list = [json.loads(q)['label'] for q in open(label_file, 'r')]
+from llava.eval.answers_file import iter_answers
+from llava.eval.streaming_metrics import cached_index, BinaryMetrics, LiveReport, add_streaming_args
+
+
+def parse_pred(text):
+    # Only keep the first sentence
+    if text.find('.') != -1:
+        text = text.split('.')[0]
+
+    text = text.replace(',', '')
+    words = text.split(' ')
+    if 'No' in words or 'not' in words or 'no' in words:
+        return 0
+    else:
+        return 1
+
+
+def load_labels(label_file):
+    return [0 if json.loads(q)['label'] == 'no' else 1 for q in open(label_file, 'r')]
 
-    for answer in answers:
-        text = answer['text']
-
-        # Only keep the first sentence
-        if text.find('.') != -1:
-            text = text.split('.')[0]
-
-        text = text.replace(',', '')
-        words = text.split(' ')
-        if 'No' in words or 'not' in words or 'no' in words:
-            answer['text'] = 'no'
-        else:
-            answer['text'] = 'yes'
-
-    for i in range(len(label_list)):
-        if label_list[i] == 'no':
-            label_list[i] = 0
-        else:
-            label_list[i] = 1
-
-    pred_list = []
-    for answer in answers:
-        if answer['text'] == 'no':
-            pred_list.append(0)
-        else:
-            pred_list.append(1)
-
-    pos = 1
-    neg = 0
-    yes_ratio = pred_list.count(1) / len(pred_list)
-
-    TP, TN, FP, FN = 0, 0, 0, 0
-    for pred, label in zip(pred_list, label_list):
-        if pred == pos and label == pos:
-            TP += 1
-        elif pred == pos and label == neg:
-            FP += 1
-        elif pred == neg and label == neg:
-            TN += 1
-        elif pred == neg and label == pos:
-            FN += 1
 
+def print_metrics(metrics):
     print('TP\tFP\tTN\tFN\t')
-    print('{}\t{}\t{}\t{}'.format(TP, FP, TN, FN))
-
-    precision = float(TP) / float(TP + FP)
-    recall = float(TP) / float(TP + FN)
-    f1 = 2*precision*recall / (precision + recall)
-    acc = (TP + TN) / (TP + TN + FP + FN)
-    print('Accuracy: {}'.format(acc))
-    print('Precision: {}'.format(precision))
-    print('Recall: {}'.format(recall))
-    print('F1 score: {}'.format(f1))
-    print('Yes ratio: {}'.format(yes_ratio))
-    print('%.3f, %.3f, %.3f, %.3f, %.3f' % (f1, acc, precision, recall, yes_ratio) )
+    print('{}\t{}\t{}\t{}'.format(metrics.tp, metrics.fp, metrics.tn, metrics.fn))
+
+    summary = metrics.summary()
+    print('Accuracy: {}'.format(summary['acc']))
+    print('Precision: {}'.format(summary['precision']))
+    print('Recall: {}'.format(summary['recall']))
+    print('F1 score: {}'.format(summary['f1']))
+    print('Yes ratio: {}'.format(summary['yes_ratio']))
+    print('%.3f, %.3f, %.3f, %.3f, %.3f' % (summary['f1'], summary['acc'], summary['precision'], summary['recall'], summary['yes_ratio']) )
+
+
+def eval_pope(answers, categories, labels, metrics, report_every=0):
+    """
+    Fold a stream of answers into the `metrics` of their categories.
+
+    The answers of a category are matched to the lines of its label file in order.
+    """
+    report = LiveReport(lambda: {c: round(m.summary()['f1'], 4) for c, m in metrics.items()}, report_every)
+    for answer in answers:
+        category = categories[answer['question_id']]
+        if category not in labels:
+            continue
+        i = metrics[category].num_preds
+        metrics[category].update(parse_pred(answer['text']), labels[category][i] if i < len(labels[category]) else None)
+        report.step()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--annotation-dir", type=str)
     parser.add_argument("--question-file", type=str)
     parser.add_argument("--result-file", type=str)
+    add_streaming_args(parser)
     args = parser.parse_args()
 
-    questions = [json.loads(line) for line in open(args.question_file)]
-    questions = {question['question_id']: question for question in questions}
-    answers = [json.loads(q) for q in open(args.result_file)]
+    categories = cached_index([args.question_file], lambda: {
+        question['question_id']: question['category'] for question in map(json.loads, open(args.question_file))
+    }, 'pope_categories')
+    labels = {}
     for file in os.listdir(args.annotation_dir):
         assert file.startswith('coco_pope_')
         assert file.endswith('.json')
-        category = file[10:-5]
-        cur_answers = [x for x in answers if questions[x['question_id']]['category'] == category]
-        print('Category: {}, # samples: {}'.format(category, len(cur_answers)))
-        eval_pope(cur_answers, os.path.join(args.annotation_dir, file))
+        labels[file[10:-5]] = load_labels(os.path.join(args.annotation_dir, file))
+
+    metrics = {category: BinaryMetrics() for category in labels}
+    # Reading stops early only while following a running eval, a complete file is read to the end
+    done = (lambda: all(m.num_preds >= len(labels[c]) for c, m in metrics.items())) if args.follow is not None else None
+    answers = iter_answers(args.result_file, follow=args.follow, done=done)
+    eval_pope(answers, categories, labels, metrics, args.report_every)
+    for category, category_metrics in metrics.items():
+        print('Category: {}, # samples: {}'.format(category, category_metrics.num_preds))
+        print_metrics(category_metrics)
         print("====================================")
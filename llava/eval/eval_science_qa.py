@@ -1,9 +1,14 @@
 import argparse
+import itertools
 import json
 import os
 import re
 import random
 
+from llava.eval.answers_file import iter_answers
+from llava.eval.streaming_metrics import (cached_index, MeanMetric, LiveReport, add_streaming_args, JsonItems,
+                                         dump_json_stream)
+
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -13,6 +18,7 @@ def get_args():
     parser.add_argument('--output-result', type=str)
     parser.add_argument('--split', type=str, default='test')
     parser.add_argument('--options', type=list, default=["A", "B", "C", "D", "E"])
+    add_streaming_args(parser)
     return parser.parse_args()
 
 
@@ -36,79 +42,114 @@ def get_pred_idx(prediction, choices, options):
         return random.choice(range(len(choices)))
 
 
-if __name__ == "__main__":
-    args = get_args()
-
-    base_dir = args.base_dir
-    split_indices = json.load(open(os.path.join(base_dir, "pid_splits.json")))[args.split]
+def load_split(base_dir, split):
+    """Answer index and number of choices of every problem of `split`, in split order."""
+    split_indices = json.load(open(os.path.join(base_dir, "pid_splits.json")))[split]
     problems = json.load(open(os.path.join(base_dir, "problems.json")))
-    predictions = [json.loads(line) for line in open(args.result_file)]
-    predictions = {pred['question_id']: pred for pred in predictions}
-    split_problems = {idx: problems[idx] for idx in split_indices}
-
-    results = {'correct': [], 'incorrect': []}
-    sqa_results = {}
-    sqa_results['acc'] = None
-    sqa_results['correct'] = None
-    sqa_results['count'] = None
-    sqa_results['results'] = {}
-    sqa_results['outputs'] = {}
-
-    for prob_id, prob in split_problems.items():
-        if prob_id not in predictions:
-            pred = {'text': 'FAILED', 'prompt': 'Unknown'}
-            pred_text = 'FAILED'
-        else:
-            pred = predictions[prob_id]
-            pred_text = pred['text']
+    return {idx: (problems[idx]['answer'], len(problems[idx]['choices'])) for idx in split_indices}
 
-        if pred_text in args.options:
-            answer = pred_text
-        elif len(pred_text) >= 3 and pred_text[0] in args.options and pred_text[1:3] == ". ":
-            answer = pred_text[0]
+
+def parse_answer(pred_text, options):
+    if pred_text in options:
+        answer = pred_text
+    elif len(pred_text) >= 3 and pred_text[0] in options and pred_text[1:3] == ". ":
+        answer = pred_text[0]
+    else:
+        pattern = re.compile(r'The answer is ([A-Z]).')
+        res = pattern.findall(pred_text)
+        if len(res) == 1:
+            answer = res[0]  # 'A', 'B', ...
         else:
-            pattern = re.compile(r'The answer is ([A-Z]).')
-            res = pattern.findall(pred_text)
-            if len(res) == 1:
-                answer = res[0]  # 'A', 'B', ...
-            else:
-                answer = "FAILED"
+            answer = "FAILED"
+    return answer
 
-        pred_idx = get_pred_idx(answer, prob['choices'], args.options)
 
-        analysis = {
+if __name__ == "__main__":
+    args = get_args()
+
+    base_dir = args.base_dir
+    split_problems = cached_index(
+        [os.path.join(base_dir, "pid_splits.json"), os.path.join(base_dir, "problems.json")],
+        lambda: load_split(base_dir, args.split), f'science_qa_{args.split}')
+
+    # Per problem only the index of the answer that counts and its prediction are kept; the
+    # analyses are rebuilt from the result file while the outputs are written
+    last_answer = {}
+    pred_indices = {}
+    accuracy = MeanMetric()
+    report = LiveReport(lambda: {'acc': round(accuracy.mean() * 100, 2),
+                                 'img_acc': round(accuracy.mean('multimodal') * 100, 2)}, args.report_every)
+
+    def analyze(prob_id, pred):
+        answer_idx, _ = split_problems[prob_id]
+        return {
             'question_id': prob_id,
-            'parsed_ans': answer,
-            'ground_truth': args.options[prob['answer']],
+            'parsed_ans': parse_answer(pred['text'], args.options),
+            'ground_truth': args.options[answer_idx],
             'question': pred['prompt'],
-            'pred': pred_text,
+            'pred': pred['text'],
             'is_multimodal': '<image>' in pred['prompt'],
         }
 
-        sqa_results['results'][prob_id] = get_pred_idx(answer, prob['choices'], args.options)
-        sqa_results['outputs'][prob_id] = pred_text
-
-        if pred_idx == prob['answer']:
-            results['correct'].append(analysis)
-        else:
-            results['incorrect'].append(analysis)
-
-    correct = len(results['correct'])
-    total = len(results['correct']) + len(results['incorrect'])
+    def score(prob_id, pred):
+        answer_idx, num_choices = split_problems[prob_id]
+        analysis = analyze(prob_id, pred)
+        pred_idx = get_pred_idx(analysis['parsed_ans'], range(num_choices), args.options)
+        pred_indices[prob_id] = pred_idx
+        # A problem answered again is rescored, the last answer counts
+        accuracy.update(int(pred_idx == answer_idx), key=prob_id,
+                        groups=('multimodal',) if analysis['is_multimodal'] else ())
+
+    # Reading stops early only while following a running eval, a complete file is read to the
+    # end so that a later answer to a problem overrides an earlier one
+    done = (lambda: len(pred_indices) == len(split_problems)) if args.follow is not None else None
+    num_answers = 0
+    for pred in iter_answers(args.result_file, follow=args.follow, done=done):
+        if pred['question_id'] in split_problems:
+            last_answer[pred['question_id']] = num_answers
+            score(pred['question_id'], pred)
+            report.step()
+        num_answers += 1
+    unanswered = {'text': 'FAILED', 'prompt': 'Unknown'}
+    for prob_id in split_problems:
+        if prob_id not in pred_indices:
+            score(prob_id, unanswered)
+
+    def final_answers():
+        """(problem, answer that counts) in result file order, then the unanswered problems."""
+        counted = {i: prob_id for prob_id, i in last_answer.items()}
+        for i, pred in enumerate(itertools.islice(iter_answers(args.result_file), num_answers)):
+            if i in counted:
+                yield counted[i], pred
+        for prob_id in split_problems:
+            if prob_id not in last_answer:
+                yield prob_id, unanswered
+
+    def analyses(correct):
+        for prob_id, pred in final_answers():
+            if (pred_indices[prob_id] == split_problems[prob_id][0]) == correct:
+                yield analyze(prob_id, pred)
+
+    correct = accuracy.total()
+    total = accuracy.count()
 
     ###### IMG ######
-    multimodal_correct = len([x for x in results['correct'] if x['is_multimodal']])
-    multimodal_incorrect = len([x for x in results['incorrect'] if x['is_multimodal']])
-    multimodal_total = multimodal_correct + multimodal_incorrect
+    multimodal_correct = accuracy.total('multimodal')
+    multimodal_total = accuracy.count('multimodal')
     ###### IMG ######
 
     print(f'Total: {total}, Correct: {correct}, Accuracy: {correct / total * 100:.2f}%, IMG-Accuracy: {multimodal_correct / multimodal_total * 100:.2f}%')
 
-    sqa_results['acc'] = correct / total * 100
-    sqa_results['correct'] = correct
-    sqa_results['count'] = total
+    results = JsonItems([('correct', analyses(True)), ('incorrect', analyses(False))])
+    sqa_results = JsonItems([
+        ('acc', correct / total * 100),
+        ('correct', correct),
+        ('count', total),
+        ('results', JsonItems((prob_id, pred_indices[prob_id]) for prob_id in split_problems)),
+        ('outputs', JsonItems((prob_id, pred['text']) for prob_id, pred in final_answers())),
+    ])
 
     with open(args.output_file, 'w') as f:
-        json.dump(results, f, indent=2)
+        dump_json_stream(results, f)
     with open(args.output_result, 'w') as f:
-        json.dump(sqa_results, f, indent=2)
+        dump_json_stream(sqa_results, f)
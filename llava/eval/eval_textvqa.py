@@ -3,7 +3,9 @@ import argparse
 import json
 import re
 
-from llava.eval.m4c_evaluator import TextVQAAccuracyEvaluator
+from llava.eval.answers_file import iter_answers
+from llava.eval.m4c_evaluator import TextVQAAccuracyEvaluator, score_in_pool
+from llava.eval.streaming_metrics import cached_index, MeanMetric, LiveReport, add_streaming_args
 
 
 def get_args():
@@ -11,6 +13,8 @@ def get_args():
     parser.add_argument('--annotation-file', type=str)
     parser.add_argument('--result-file', type=str)
     parser.add_argument('--result-dir', type=str)
+    parser.add_argument('--num-workers', type=int, default=1)
+    add_streaming_args(parser)
     return parser.parse_args()
 
 
@@ -32,34 +36,56 @@ def prompt_processor(prompt):
     return question.lower()
 
 
-def eval_single(annotation_file, result_file):
-    experiment_name = os.path.splitext(os.path.basename(result_file))[0]
-    print(experiment_name)
+def load_annotations(annotation_file):
     annotations = json.load(open(annotation_file))['data']
-    annotations = {(annotation['image_id'], annotation['question'].lower()): annotation for annotation in annotations}
-    results = [json.loads(line) for line in open(result_file)]
+    return {(annotation['image_id'], annotation['question'].lower()): annotation['answers'] for annotation in annotations}
 
-    pred_list = []
+
+def pred_batches(results, annotations, batch_size):
+    batch = []
     for result in results:
-        annotation = annotations[(result['question_id'], prompt_processor(result['prompt']))]
-        pred_list.append({
+        batch.append({
             "pred_answer": result['text'],
-            "gt_answers": annotation['answers'],
+            "gt_answers": annotations[(result['question_id'], prompt_processor(result['prompt']))],
         })
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def eval_single(annotation_file, result_file, num_workers=1, report_every=0, follow=None):
+    experiment_name = os.path.splitext(os.path.basename(result_file))[0]
+    print(experiment_name)
+    annotations = cached_index([annotation_file], lambda: load_annotations(annotation_file), 'textvqa_answers')
 
     evaluator = TextVQAAccuracyEvaluator()
-    print('Samples: {}\nAccuracy: {:.2f}%\n'.format(len(pred_list), 100. * evaluator.eval_pred_list(pred_list)))
+    accuracy = MeanMetric()
+    report = LiveReport(lambda: {"accuracy": round(100. * accuracy.mean(), 2)}, report_every)
+    # Scored a batch at a time, so the worker pool gets enough work and only one batch is held in memory
+    batch_size = report_every or 10000
+    for pred_list in pred_batches(iter_answers(result_file, follow=follow), annotations, batch_size):
+        if num_workers > 1:
+            scores = score_in_pool(evaluator, pred_list, num_workers)
+        else:
+            scores = evaluator.score_pred_list(pred_list)
+        for score in scores:
+            accuracy.update(score)
+        report.step(len(scores))
+    print('Samples: {}\nAccuracy: {:.2f}%\n'.format(accuracy.count(), 100. * accuracy.mean()))
 
 
 if __name__ == "__main__":
     args = get_args()
 
     if args.result_file is not None:
-        eval_single(args.annotation_file, args.result_file)
+        eval_single(args.annotation_file, args.result_file, args.num_workers, args.report_every, args.follow)
 
     if args.result_dir is not None:
         for result_file in sorted(os.listdir(args.result_dir)):
             if not result_file.endswith('.jsonl'):
                 print(f'Skipping {result_file}')
                 continue
-            eval_single(args.annotation_file, os.path.join(args.result_dir, result_file))
+            eval_single(args.annotation_file, os.path.join(args.result_dir, result_file), args.num_workers,
+                        args.report_every)
@@ -0,0 +1,205 @@
+"""
+Asyncio client for the GPT review scripts.
+
+Reviews are requested from an OpenAI compatible `/chat/completions`
+endpoint with at most `concurrency` requests in flight, a token bucket
+limiting the request rate, and exponential backoff (honouring Retry-After)
+on rate limits, server errors and timeouts. Every review is stored in a
+content-addressed cache on disk, keyed by the hash of the full request, so
+rerunning a script only pays for reviews it has not seen.
+
+`--api-base` points the scripts at another server, e.g. the local stub of
+llava/eval/openai_stub_server.py.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+
+import httpx
+from tqdm import tqdm
+
+
+SYSTEM_PROMPT = 'You are a helpful and precise assistant for checking the quality of the answer.'
+
+
+class TokenBucket(object):
+    """Allows `rate` acquisitions per second on average and bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ReviewCache(object):
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.expanduser(cache_dir)
+
+    def key(self, request):
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get(self, key):
+        try:
+            with open(self.path(key)) as f:
+                return json.load(f)['content']
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def put(self, key, request, content):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a temporary name first, so a crash never leaves a partial entry
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'request': request, 'content': content}, f)
+        os.replace(tmp_path, path)
+
+
+class ReviewClient(object):
+    def __init__(self, model, api_base=None, api_key=None, concurrency=8, requests_per_minute=60,
+                 max_retries=8, cache_dir='~/.cache/llava/gpt_review', timeout=120, temperature=0.2):
+        self.model = model
+        self.api_base = (api_base or os.environ.get('OPENAI_API_BASE', 'https://api.openai.com/v1')).rstrip('/')
+        self.api_key = api_key or os.environ.get('OPENAI_API_KEY', '')
+        self.concurrency = concurrency
+        self.requests_per_minute = requests_per_minute
+        self.max_retries = max_retries
+        self.cache = ReviewCache(cache_dir) if cache_dir else None
+        self.timeout = timeout
+        self.temperature = temperature
+
+    def build_request(self, content, max_tokens):
+        return {
+            'model': self.model,
+            'messages': [{
+                'role': 'system',
+                'content': SYSTEM_PROMPT,
+            }, {
+                'role': 'user',
+                'content': content,
+            }],
+            'temperature': self.temperature,
+            'max_tokens': max_tokens,
+        }
+
+    async def request(self, client, bucket, semaphore, request):
+        async with semaphore:
+            for attempt in range(self.max_retries + 1):
+                await bucket.acquire()
+                delay = min(60, 2 ** attempt) * (0.5 + random.random() / 2)
+                try:
+                    response = await client.post(self.api_base + '/chat/completions', json=request)
+                except httpx.TransportError as e:
+                    print(f'Request failed: {e!r}, retrying in {delay:.1f}s.')
+                else:
+                    if response.status_code == 200:
+                        return response.json()['choices'][0]['message']['content']
+                    if response.status_code != 429 and response.status_code < 500:
+                        response.raise_for_status()
+                    retry_after = response.headers.get('retry-after')
+                    if retry_after is not None:
+                        try:
+                            delay = max(delay, float(retry_after))
+                        except ValueError:
+                            pass
+                    print(f'HTTP {response.status_code}, retrying in {delay:.1f}s.')
+                await asyncio.sleep(delay)
+        raise RuntimeError(f'Review failed after {self.max_retries + 1} attempts.')
+
+    async def review_all(self, contents, max_tokens, on_review=None):
+        requests = [self.build_request(content, max_tokens) for content in contents]
+        reviews = [None] * len(requests)
+        finished = [False] * len(requests)
+        num_reported = 0
+
+        def report():
+            # In order: reviews up to the first unfinished one
+            nonlocal num_reported
+            while num_reported < len(requests) and finished[num_reported]:
+                if on_review is not None:
+                    on_review(num_reported, reviews[num_reported])
+                num_reported += 1
+
+        todo = []
+        for i, request in enumerate(requests):
+            key = self.cache.key(request) if self.cache else None
+            reviews[i] = self.cache.get(key) if self.cache else None
+            if reviews[i] is None:
+                todo.append((i, key))
+            else:
+                finished[i] = True
+        print(f'{len(requests) - len(todo)} reviews cached, requesting {len(todo)}.')
+        report()
+        if not todo:
+            return reviews
+
+        bucket = TokenBucket(self.requests_per_minute / 60, capacity=self.concurrency)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        headers = {'Authorization': f'Bearer {self.api_key}'}
+        limits = httpx.Limits(max_connections=self.concurrency)
+        async with httpx.AsyncClient(headers=headers, limits=limits, timeout=self.timeout) as client:
+            progress = tqdm(total=len(todo))
+
+            async def one(i, key):
+                try:
+                    reviews[i] = await self.request(client, bucket, semaphore, requests[i])
+                except (httpx.HTTPError, RuntimeError) as e:
+                    # The other reviews go on; this one stays None and is requested again on the next run
+                    print(f'Review {i} failed: {e!r}')
+                else:
+                    if self.cache:
+                        self.cache.put(key, requests[i], reviews[i])
+                finished[i] = True
+                progress.update(1)
+                report()
+
+            await asyncio.gather(*[one(i, key) for i, key in todo])
+            progress.close()
+        return reviews
+
+    def review(self, contents, max_tokens, on_review=None):
+        """
+        Reviews of `contents`, in order; None where a review failed. `on_review(i, review)`
+        is called in order as soon as the reviews up to `i` are done, so results can be
+        written while later ones are still pending.
+        """
+        return asyncio.run(self.review_all(contents, max_tokens, on_review))
+
+
+def add_review_args(parser, model):
+    parser.add_argument('--model', type=str, default=model)
+    parser.add_argument('--api-base', type=str, default=None,
+        help='OpenAI compatible API base URL (default: $OPENAI_API_BASE or the OpenAI API).')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests-per-minute', type=float, default=60)
+    parser.add_argument('--max-retries', type=int, default=8)
+    parser.add_argument('--temperature', type=float, default=0.2,
+        help='Sampling temperature of the reviewer. 0.2 is what the published LLaVA reviews used; 0 makes '
+             'reviews close to deterministic. It is part of the cache key, so changing it requests new reviews.')
+    parser.add_argument('--cache-dir', type=str, default='~/.cache/llava/gpt_review',
+        help='Where reviews are cached; an empty string disables the cache.')
+
+
+def review_client_from_args(args):
+    return ReviewClient(args.model, api_base=args.api_base, concurrency=args.concurrency,
+                        requests_per_minute=args.requests_per_minute, max_retries=args.max_retries,
+                        cache_dir=args.cache_dir, temperature=args.temperature)
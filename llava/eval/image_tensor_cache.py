@@ -0,0 +1,205 @@
+"""
+On-disk cache of preprocessed image tensors for repeated eval runs.
+
+Decoding, resizing and normalizing an image gives the same pixel tensor on
+every run for a given image processor and `image_aspect_ratio`. The cache
+keeps these tensors in one memory-mapped .npy array per processor
+configuration, next to an index from the sha1 of each image file to its row.
+Loaders read rows straight from the page cache, and images missing from the
+cache are preprocessed as before.
+
+Layout: <cache-dir>/<processor key>/pixels.npy and index.json
+
+Prebuild it for a question file (jsonl, or a json list, with "image" entries):
+python3 -m llava.eval.image_tensor_cache --cache-dir ~/.cache/llava/pixels \
+    --question-file questions.jsonl --image-folder images --model-path liuhaotian/llava-v1.5-13b
+"""
+import argparse
+import hashlib
+import json
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
+from PIL import Image
+
+from llava.mm_utils import process_images
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def processor_key(image_processor, image_aspect_ratio):
+    config = {"processor": image_processor.to_dict(), "image_aspect_ratio": image_aspect_ratio}
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def preprocess(path, image_processor, image_aspect_ratio):
+    image = Image.open(path).convert('RGB')
+    model_cfg = SimpleNamespace(image_aspect_ratio=image_aspect_ratio)
+    return process_images([image], image_processor, model_cfg)[0], image.size
+
+
+class ImageTensorCache(object):
+    def __init__(self, cache_dir, image_processor, image_aspect_ratio):
+        if image_aspect_ratio == "anyres":
+            raise ValueError("anyres images preprocess to variable sized tensors and cannot be cached")
+        self.image_processor = image_processor
+        self.image_aspect_ratio = image_aspect_ratio
+        self.dir = os.path.join(os.path.expanduser(cache_dir), processor_key(image_processor, image_aspect_ratio))
+        self.index_path = os.path.join(self.dir, "index.json")
+        self.pixels_path = os.path.join(self.dir, "pixels.npy")
+        self.index = {"rows": {}, "sizes": {}, "files": {}}
+        self.pixels = None
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+            self.open()
+
+    def open(self):
+        # Copy-on-write, so the rows can back writable tensors without touching the file
+        self.pixels = np.load(self.pixels_path, mmap_mode="c") if self.index["rows"] else None
+
+    def __getstate__(self):
+        # A pickled memmap is a full copy of the array; DataLoader workers map the file again instead
+        state = self.__dict__.copy()
+        state["pixels"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if os.path.exists(self.pixels_path):
+            self.open()
+
+    def __len__(self):
+        return len(self.index["rows"])
+
+    def key(self, path):
+        """sha1 of the file, taken from the index while size and mtime are unchanged."""
+        stat = os.stat(path)
+        entry = self.index["files"].get(os.path.abspath(path))
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        return file_hash(path)
+
+    def get(self, path):
+        """(pixel tensor, image size) of the image at `path`, None if not cached."""
+        if self.pixels is None:
+            return None
+        key = self.key(path)
+        row = self.index["rows"].get(key)
+        if row is None:
+            return None
+        return torch.from_numpy(self.pixels[row]), tuple(self.index["sizes"][key])
+
+    def load(self, path):
+        """(pixel tensor, image size), from the cache when possible."""
+        cached = self.get(path)
+        if cached is not None:
+            return cached
+        return preprocess(path, self.image_processor, self.image_aspect_ratio)
+
+    def build(self, paths, num_workers=8):
+        """Add the images of `paths` that are not cached yet; returns how many were added."""
+        keys = {}
+        for path in tqdm(paths, desc="hashing"):
+            keys.setdefault(self.key(path), path)
+        missing = [(key, path) for key, path in keys.items() if key not in self.index["rows"]]
+        files = dict(self.index["files"])
+        for key, path in keys.items():
+            stat = os.stat(path)
+            files[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns, key]
+        if not missing:
+            self.write_index(dict(self.index, files=files))
+            return 0
+
+        dataset = PreprocessDataset([path for _, path in missing], self.image_processor, self.image_aspect_ratio)
+        loader = DataLoader(dataset, batch_size=None, num_workers=num_workers)
+        num_rows = len(self.index["rows"])
+        os.makedirs(self.dir, exist_ok=True)
+        tmp_path = self.pixels_path + ".tmp.npy"
+        pixels, rows, sizes = None, dict(self.index["rows"]), dict(self.index["sizes"])
+        for (key, path), (tensor, size) in tqdm(zip(missing, loader), total=len(missing), desc="preprocessing"):
+            if pixels is None:
+                shape = tuple(self.pixels.shape[1:]) if self.pixels is not None else tuple(tensor.shape)
+                pixels = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32,
+                                                   shape=(num_rows + len(missing),) + shape)
+                if self.pixels is not None:
+                    pixels[:num_rows] = self.pixels
+            if tuple(tensor.shape) != pixels.shape[1:]:
+                raise ValueError(f"{path} preprocesses to {tuple(tensor.shape)}, but the cache holds "
+                                 f"{pixels.shape[1:]} tensors")
+            pixels[len(rows)] = tensor.numpy()
+            rows[key] = len(rows)
+            sizes[key] = list(size)
+        pixels.flush()
+        del pixels
+        os.replace(tmp_path, self.pixels_path)
+        self.write_index({"rows": rows, "sizes": sizes, "files": files})
+        self.open()
+        return len(missing)
+
+    def write_index(self, index):
+        index["config"] = {"image_aspect_ratio": self.image_aspect_ratio,
+                           "processor": self.image_processor.to_dict()}
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, default=str)
+        os.replace(tmp_path, self.index_path)
+        self.index = index
+
+
+class PreprocessDataset(Dataset):
+    def __init__(self, paths, image_processor, image_aspect_ratio):
+        self.paths = paths
+        self.image_processor = image_processor
+        self.image_aspect_ratio = image_aspect_ratio
+
+    def __getitem__(self, index):
+        return preprocess(self.paths[index], self.image_processor, self.image_aspect_ratio)
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def image_paths(question_file, image_folder):
+    question_file = os.path.expanduser(question_file)
+    with open(question_file) as f:
+        if question_file.endswith(".jsonl"):
+            questions = [json.loads(line) for line in f if line.strip()]
+        else:
+            questions = json.load(f)
+    return sorted({os.path.join(image_folder, q["image"]) for q in questions if q.get("image")})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cache-dir", type=str, required=True)
+    parser.add_argument("--question-file", type=str, required=True)
+    parser.add_argument("--image-folder", type=str, default="")
+    parser.add_argument("--model-path", type=str, default=None,
+        help="Take the vision tower and image_aspect_ratio from this model's config.")
+    parser.add_argument("--vision-tower", type=str, default=None)
+    parser.add_argument("--image-aspect-ratio", type=str, default=None,
+        help="'pad' for HealthGPT and llava-v1.5.")
+    parser.add_argument("--num-workers", type=int, default=8)
+    args = parser.parse_args()
+
+    from transformers import CLIPImageProcessor, PretrainedConfig
+
+    vision_tower, image_aspect_ratio = args.vision_tower, args.image_aspect_ratio
+    if args.model_path is not None:
+        model_config, _ = PretrainedConfig.get_config_dict(args.model_path)
+        vision_tower = vision_tower or model_config.get("mm_vision_tower")
+        image_aspect_ratio = image_aspect_ratio or model_config.get("image_aspect_ratio")
+    if vision_tower is None:
+        parser.error("pass --model-path or --vision-tower")
+
+    cache = ImageTensorCache(args.cache_dir, CLIPImageProcessor.from_pretrained(vision_tower), image_aspect_ratio)
+    added = cache.build(image_paths(args.question_file, args.image_folder), num_workers=args.num_workers)
+    print(f"Added {added} images, {len(cache)} cached in {cache.dir}.")
@@ -0,0 +1,92 @@
+"""
+Run an eval script as N local shard processes and merge their answers.
+
+Every shard gets `--num-chunks N --chunk-idx i --answers-file <shard-dir>/N_i.jsonl`
+appended to the given command and the GPUs of `--gpus` round robin. Shards
+that fail are started again up to `--max-retries` times; as the eval scripts
+resume their answers files, a retry only runs the questions that are left.
+Once all shards are done, their answers are merged in order into `--answers-file`.
+
+Usage:
+python3 -m llava.eval.launch_shards --num-shards 8 --gpus 0,1,2,3,4,5,6,7 \
+    --answers-file ./playground/data/eval/vqav2/answers/llava-v1.5-13b/merge.jsonl -- \
+    python -m llava.eval.model_vqa_loader --model-path liuhaotian/llava-v1.5-13b \
+    --question-file ./playground/data/eval/vqav2/llava_vqav2_mscoco_test-dev2015.jsonl \
+    --image-folder ./playground/data/eval/vqav2/test2015 --temperature 0 --conv-mode vicuna_v1
+"""
+import argparse
+import os
+import subprocess
+import time
+
+from llava.eval.answers_file import merge_answers_files
+
+
+def shard_paths(shard_dir, num_shards):
+    return [os.path.join(shard_dir, f"{num_shards}_{idx}.jsonl") for idx in range(num_shards)]
+
+
+def start_shard(args, idx, answers_file):
+    env = os.environ.copy()
+    if args.gpus:
+        gpus = args.gpus.split(",")
+        env["CUDA_VISIBLE_DEVICES"] = gpus[idx % len(gpus)]
+    command = args.command + ["--num-chunks", str(args.num_shards), "--chunk-idx", str(idx),
+                              "--answers-file", answers_file]
+    log = open(os.path.join(args.shard_dir, f"{args.num_shards}_{idx}.log"), "a")
+    return subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT), log
+
+
+def main(args):
+    os.makedirs(args.shard_dir, exist_ok=True)
+    answers_files = shard_paths(args.shard_dir, args.num_shards)
+    attempts = [0] * args.num_shards
+    running = {}
+    for idx in range(args.num_shards):
+        running[idx] = start_shard(args, idx, answers_files[idx])
+        attempts[idx] += 1
+
+    failed = []
+    while running:
+        time.sleep(1)
+        for idx, (process, log) in list(running.items()):
+            returncode = process.poll()
+            if returncode is None:
+                continue
+            log.close()
+            del running[idx]
+            if returncode == 0:
+                print(f"Shard {idx} done.")
+            elif attempts[idx] <= args.max_retries:
+                print(f"Shard {idx} exited with {returncode}, resuming it (attempt {attempts[idx] + 1}).")
+                running[idx] = start_shard(args, idx, answers_files[idx])
+                attempts[idx] += 1
+            else:
+                print(f"Shard {idx} exited with {returncode}, giving up. See {log.name}.")
+                failed.append(idx)
+
+    if failed:
+        raise SystemExit(f"Shards {sorted(failed)} failed, rerun the same command to resume them.")
+    num_answers = merge_answers_files(answers_files, args.answers_file)
+    print(f"Merged {num_answers} answers into {args.answers_file}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-shards", type=int, required=True)
+    parser.add_argument("--gpus", type=str, default=os.environ.get("CUDA_VISIBLE_DEVICES", ""),
+        help="Comma separated GPU ids, assigned to the shards round robin.")
+    parser.add_argument("--answers-file", type=str, required=True)
+    parser.add_argument("--shard-dir", type=str, default=None,
+        help="Where the shard answers and logs go (default: <answers-file>_shards).")
+    parser.add_argument("--max-retries", type=int, default=1)
+    parser.add_argument("command", nargs=argparse.REMAINDER,
+        help="The eval command, after `--`.")
+    args = parser.parse_args()
+    if args.command and args.command[0] == "--":
+        args.command = args.command[1:]
+    if not args.command:
+        parser.error("the eval command is missing")
+    if args.shard_dir is None:
+        args.shard_dir = os.path.splitext(args.answers_file)[0] + "_shards"
+    main(args)
@@ -1,4 +1,7 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import math
 import re
 
 from tqdm import tqdm
@@ -175,8 +178,13 @@ class EvalAIAnswerProcessor:
         "!",
     ]
 
+    ARTICLE_SET = frozenset(ARTICLES)
+    # Every punctuation is one character, so all of them are removed or spaced out in one translate
+    REMOVE_PUNCTUATIONS = str.maketrans({p: "" for p in PUNCTUATIONS})
+
     def __init__(self, *args, **kwargs):
-        pass
+        # Predictions and ground truth answers repeat a lot, normalize each string once
+        self.cache = {}
 
     def word_tokenize(self, word):
         word = word.lower()
@@ -184,33 +192,34 @@ class EvalAIAnswerProcessor:
         return word.strip()
 
     def process_punctuation(self, in_text):
-        out_text = in_text
-        for p in self.PUNCTUATIONS:
-            if (p + " " in in_text or " " + p in in_text) or (
-                re.search(self.COMMA_STRIP, in_text) is not None
-            ):
-                out_text = out_text.replace(p, "")
-            else:
-                out_text = out_text.replace(p, " ")
+        if re.search(self.COMMA_STRIP, in_text) is not None:
+            out_text = in_text.translate(self.REMOVE_PUNCTUATIONS)
+        else:
+            # A punctuation next to a space is removed, elsewhere it becomes a space
+            out_text = in_text.translate({
+                ord(p): "" if (p + " " in in_text or " " + p in in_text) else " "
+                for p in self.PUNCTUATIONS if p in in_text
+            })
+        # re.UNICODE lands in `count`, so at most 32 periods are stripped; kept for identical scores
         out_text = self.PERIOD_STRIP.sub("", out_text, re.UNICODE)
         return out_text
 
     def process_digit_article(self, in_text):
         out_text = []
-        temp_text = in_text.lower().split()
-        for word in temp_text:
-            word = self.NUMBER_MAP.setdefault(word, word)
-            if word not in self.ARTICLES:
-                out_text.append(word)
-            else:
-                pass
-        for word_id, word in enumerate(out_text):
-            if word in self.CONTRACTIONS:
-                out_text[word_id] = self.CONTRACTIONS[word]
-        out_text = " ".join(out_text)
-        return out_text
+        for word in in_text.lower().split():
+            word = self.NUMBER_MAP.get(word, word)
+            if word not in self.ARTICLE_SET:
+                out_text.append(self.CONTRACTIONS.get(word, word))
+        return " ".join(out_text)
 
     def __call__(self, item):
+        result = self.cache.get(item)
+        if result is None:
+            result = self.process(item)
+            self.cache[item] = result
+        return result
+
+    def process(self, item):
         item = self.word_tokenize(item)
         item = item.replace("\n", " ").replace("\t", " ").strip()
         item = self.process_punctuation(item)
@@ -218,6 +227,21 @@ class EvalAIAnswerProcessor:
         return item
 
 
+def _score_chunk(args):
+    evaluator_cls, pred_list = args
+    return evaluator_cls().score_pred_list(pred_list)
+
+
+def score_in_pool(evaluator, pred_list, num_workers):
+    """Per entry scores of `evaluator`, computed in `num_workers` processes, in order."""
+    if num_workers <= 1 or len(pred_list) < 2 * num_workers:
+        return evaluator.score_pred_list(pred_list, progress=True)
+    chunk_size = math.ceil(len(pred_list) / (4 * num_workers))
+    chunks = [(type(evaluator), pred_list[i:i + chunk_size]) for i in range(0, len(pred_list), chunk_size)]
+    with ProcessPoolExecutor(num_workers) as executor:
+        return [score for scores in executor.map(_score_chunk, chunks) for score in scores]
+
+
 class TextVQAAccuracyEvaluator:
     def __init__(self):
         self.answer_processor = EvalAIAnswerProcessor()
@@ -228,31 +252,27 @@ class TextVQAAccuracyEvaluator:
         """
         answers = [self.answer_processor(a) for a in raw_answers]
         assert len(answers) == 10
-        gt_answers = list(enumerate(answers))
-        unique_answers = set(answers)
+        counts = Counter(answers)
         unique_answer_scores = {}
 
-        for unique_answer in unique_answers:
-            accs = []
-            for gt_answer in gt_answers:
-                other_answers = [item for item in gt_answers if item != gt_answer]
-                matching_answers = [
-                    item for item in other_answers if item[1] == unique_answer
-                ]
-                acc = min(1, float(len(matching_answers)) / 3)
-                accs.append(acc)
+        for unique_answer, count in counts.items():
+            # Leave one human out: the others agreeing with the answer, at most 3 count
+            accs = [min(1, float(count - (answer == unique_answer)) / 3) for answer in answers]
             unique_answer_scores[unique_answer] = sum(accs) / len(accs)
 
         return unique_answer_scores
 
-    def eval_pred_list(self, pred_list):
+    def score_pred_list(self, pred_list, progress=False):
         pred_scores = []
-        for entry in tqdm(pred_list):
+        for entry in tqdm(pred_list, disable=not progress):
             pred_answer = self.answer_processor(entry["pred_answer"])
             unique_answer_scores = self._compute_answer_scores(entry["gt_answers"])
             score = unique_answer_scores.get(pred_answer, 0.0)
             pred_scores.append(score)
+        return pred_scores
 
+    def eval_pred_list(self, pred_list, num_workers=1):
+        pred_scores = score_in_pool(self, pred_list, num_workers)
         accuracy = sum(pred_scores) / len(pred_scores)
         return accuracy
 
@@ -261,14 +281,17 @@ class STVQAAccuracyEvaluator:
     def __init__(self):
         self.answer_processor = EvalAIAnswerProcessor()
 
-    def eval_pred_list(self, pred_list):
+    def score_pred_list(self, pred_list, progress=False):
         pred_scores = []
         for entry in pred_list:
             pred_answer = self.answer_processor(entry["pred_answer"])
             gts = [self.answer_processor(a) for a in entry["gt_answers"]]
             score = 1.0 if pred_answer in gts else 0.0
             pred_scores.append(score)
+        return pred_scores
 
+    def eval_pred_list(self, pred_list, num_workers=1):
+        pred_scores = score_in_pool(self, pred_list, num_workers)
         accuracy = sum(pred_scores) / len(pred_scores)
         return accuracy
 
@@ -286,14 +309,17 @@ class STVQAANLSEvaluator:
         anls = iou if iou >= 0.5 else 0.0
         return anls
 
-    def eval_pred_list(self, pred_list):
+    def score_pred_list(self, pred_list, progress=False):
         pred_scores = []
         for entry in pred_list:
             anls = max(
                 self.get_anls(entry["pred_answer"], gt) for gt in entry["gt_answers"]
             )
             pred_scores.append(anls)
+        return pred_scores
 
+    def eval_pred_list(self, pred_list, num_workers=1):
+        pred_scores = score_in_pool(self, pred_list, num_workers)
         accuracy = sum(pred_scores) / len(pred_scores)
         return accuracy
 
@@ -0,0 +1,155 @@
+"""
+Answer a question file with a HealthGPT variant of config.py.
+
+The model is loaded once, images are read and preprocessed by DataLoader
+workers while the GPU generates, and questions are answered `--batch-size`
+at a time. The question and answers files use the llava/eval jsonl format
+({"question_id", "image", "text"} in, {"question_id", "prompt", "text", ...}
+out), so the existing scorers apply; answers are appended as they are made
+and a rerun resumes where the last one stopped.
+
+Usage:
+python3 -m llava.eval.model_vqa_healthgpt --model-name HealthGPT-M3-COM \
+    --question-file questions.jsonl --image-folder images --answers-file answers.jsonl --batch-size 8
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+import shortuuid
+import torch
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
+from PIL import Image
+
+from llava.eval.answers_file import AnswersFile
+from llava.eval.image_tensor_cache import ImageTensorCache
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from model import HealthGPT
+from config import HealthGPTConfig_M3_COM, HealthGPTConfig_M3_COM_CPU, HealthGPTConfig_L14_COM
+
+
+configs = {
+    "HealthGPT-M3-COM": HealthGPTConfig_M3_COM(),
+    "HealthGPT-M3-COM-CPU": HealthGPTConfig_M3_COM_CPU(),
+    "HealthGPT-L14-COM": HealthGPTConfig_L14_COM(),
+}
+
+
+def split_list(lst, n):
+    """Split a list into n (roughly) equal-sized chunks"""
+    chunk_size = math.ceil(len(lst) / n)  # integer division
+    return [lst[i:i+chunk_size] for i in range(0, len(lst), chunk_size)]
+
+
+def get_chunk(lst, n, k):
+    chunks = split_list(lst, n)
+    return chunks[k]
+
+
+class QuestionDataset(Dataset):
+    def __init__(self, questions, image_folder, preprocess_image, image_cache=None):
+        self.questions = questions
+        self.image_folder = image_folder
+        self.preprocess_image = preprocess_image
+        self.image_cache = image_cache
+
+    def __getitem__(self, index):
+        line = self.questions[index]
+        image_tensor = None
+        if line.get("image"):
+            image_file = os.path.join(self.image_folder, line["image"])
+            if self.image_cache is not None:
+                image_tensor, _ = self.image_cache.load(image_file)
+            else:
+                image = Image.open(image_file).convert('RGB')
+                image_tensor = self.preprocess_image(image)
+        return line, image_tensor
+
+    def __len__(self):
+        return len(self.questions)
+
+
+def collate_fn(batch):
+    return tuple(zip(*batch))
+
+
+def eval_model(args):
+    config = configs[args.model_name]
+    config.max_new_tokens = args.max_new_tokens
+    model = HealthGPT(config)
+
+    questions = [json.loads(q) for q in open(os.path.expanduser(args.question_file), "r")]
+    questions = get_chunk(questions, args.num_chunks, args.chunk_idx)
+    answers_file = os.path.expanduser(args.answers_file)
+    ans_file = AnswersFile(answers_file, resume=not args.overwrite, flush_every=args.flush_every)
+    questions = [q for q in questions if not ans_file.has(q["question_id"])]
+
+    image_cache = None
+    if args.image_cache_dir:
+        # HealthGPT pads images to squares like image_aspect_ratio "pad"
+        image_cache = ImageTensorCache(args.image_cache_dir, model.image_processor, "pad")
+        print(f"{len(image_cache)} preprocessed images cached in {image_cache.dir}.")
+    dataset = QuestionDataset(questions, args.image_folder, model.preprocess_image, image_cache)
+    data_loader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers,
+                             shuffle=False, collate_fn=collate_fn)
+
+    start = time.time()
+    num_tokens = 0
+    progress = tqdm(total=len(questions))
+    for lines, image_tensors in data_loader:
+        answers = [None] * len(lines)
+        # Questions with and without an image are generated as separate batches
+        for rows in ([i for i, x in enumerate(image_tensors) if x is not None],
+                     [i for i, x in enumerate(image_tensors) if x is None]):
+            if not rows:
+                continue
+            responses = model.infer_batch([lines[i]["text"] for i in rows], [image_tensors[i] for i in rows])
+            for i, response in zip(rows, responses):
+                answers[i] = response
+
+        for line, answer in zip(lines, answers):
+            num_tokens += len(model.tokenizer(answer, add_special_tokens=False).input_ids)
+            ans_id = shortuuid.uuid()
+            ans_file.write({"question_id": line["question_id"],
+                            "prompt": line["text"],
+                            "text": answer,
+                            "answer_id": ans_id,
+                            "model_id": args.model_name,
+                            "metadata": {}})
+        progress.update(len(lines))
+    progress.close()
+    ans_file.close()
+
+    elapsed = time.time() - start
+    print(json.dumps({
+        "questions": len(questions),
+        "seconds": round(elapsed, 2),
+        "questions_per_s": round(len(questions) / elapsed, 3) if elapsed else None,
+        "tokens_per_s": round(num_tokens / elapsed, 1) if elapsed else None,
+    }))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-name", type=str, default="HealthGPT-M3-COM", choices=list(configs))
+    parser.add_argument("--image-folder", type=str, default="")
+    parser.add_argument("--question-file", type=str, default="tables/question.jsonl")
+    parser.add_argument("--answers-file", type=str, default="answer.jsonl")
+    parser.add_argument("--num-chunks", type=int, default=1)
+    parser.add_argument("--chunk-idx", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--max_new_tokens", type=int, default=512)
+    parser.add_argument("--image-cache-dir", type=str, default=None,
+        help="Read preprocessed images from this cache, see llava/eval/image_tensor_cache.py.")
+    parser.add_argument("--flush-every", type=int, default=1)
+    parser.add_argument("--overwrite", action="store_true",
+        help="Start a new answers file instead of resuming the existing one.")
+    args = parser.parse_args()
+
+    eval_model(args)
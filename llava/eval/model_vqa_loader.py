@@ -10,10 +10,14 @@ from llava.conversation import conv_templates, SeparatorStyle
 from llava.model.builder import load_pretrained_model
 from llava.utils import disable_torch_init
 from llava.mm_utils import tokenizer_image_token, process_images, get_model_name_from_path
+from llava.eval.answers_file import AnswersFile
+from llava.eval.option_scoring import tokenize_options, score_options
+from llava.eval.image_tensor_cache import ImageTensorCache
 from torch.utils.data import Dataset, DataLoader
 
 from PIL import Image
 import math
+from functools import partial
 
 
 def split_list(lst, n):
@@ -27,55 +31,114 @@ def get_chunk(lst, n, k):
     return chunks[k]
 
 
+def build_prompt(line, model_config):
+    qs = line["text"]
+    if model_config.mm_use_im_start_end:
+        qs = DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + '\n' + qs
+    else:
+        qs = DEFAULT_IMAGE_TOKEN + '\n' + qs
+
+    conv = conv_templates[args.conv_mode].copy()
+    conv.append_message(conv.roles[0], qs)
+    conv.append_message(conv.roles[1], None)
+    return conv.get_prompt()
+
+
 # Custom dataset class
 class CustomDataset(Dataset):
-    def __init__(self, questions, image_folder, tokenizer, image_processor, model_config):
+    def __init__(self, questions, image_folder, tokenizer, image_processor, model_config, image_cache=None):
         self.questions = questions
         self.image_folder = image_folder
         self.tokenizer = tokenizer
         self.image_processor = image_processor
         self.model_config = model_config
+        self.image_cache = image_cache
 
     def __getitem__(self, index):
         line = self.questions[index]
         image_file = line["image"]
-        qs = line["text"]
-        if self.model_config.mm_use_im_start_end:
-            qs = DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + '\n' + qs
-        else:
-            qs = DEFAULT_IMAGE_TOKEN + '\n' + qs
-
-        conv = conv_templates[args.conv_mode].copy()
-        conv.append_message(conv.roles[0], qs)
-        conv.append_message(conv.roles[1], None)
-        prompt = conv.get_prompt()
+        prompt = build_prompt(line, self.model_config)
 
-        image = Image.open(os.path.join(self.image_folder, image_file)).convert('RGB')
-        image_tensor = process_images([image], self.image_processor, self.model_config)[0]
+        if self.image_cache is not None:
+            image_tensor, image_size = self.image_cache.load(os.path.join(self.image_folder, image_file))
+        else:
+            image = Image.open(os.path.join(self.image_folder, image_file)).convert('RGB')
+            image_tensor = process_images([image], self.image_processor, self.model_config)[0]
+            image_size = image.size
 
         input_ids = tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt')
 
-        return input_ids, image_tensor, image.size
+        return input_ids, image_tensor, image_size
 
     def __len__(self):
         return len(self.questions)
 
 
-def collate_fn(batch):
+def collate_fn(batch, pad_token_id=0):
     input_ids, image_tensors, image_sizes = zip(*batch)
-    input_ids = torch.stack(input_ids, dim=0)
-    image_tensors = torch.stack(image_tensors, dim=0)
-    return input_ids, image_tensors, image_sizes
+    if all(len(x) == len(input_ids[0]) for x in input_ids):
+        # No padding, so every row is computed as it is at batch size 1
+        input_ids = torch.stack(input_ids, dim=0)
+        attention_mask = None
+    else:
+        # Left padded, so that generation continues right after every prompt
+        max_len = max(len(x) for x in input_ids)
+        padded = torch.full((len(input_ids), max_len), pad_token_id, dtype=input_ids[0].dtype)
+        attention_mask = torch.zeros((len(input_ids), max_len), dtype=torch.long)
+        for i, x in enumerate(input_ids):
+            padded[i, max_len - len(x):] = x
+            attention_mask[i, max_len - len(x):] = 1
+        input_ids = padded
+    if all(x.shape == image_tensors[0].shape for x in image_tensors):
+        image_tensors = torch.stack(image_tensors, dim=0)
+    else:
+        image_tensors = list(image_tensors)
+    return input_ids, attention_mask, image_tensors, image_sizes
 
 
 # DataLoader
-def create_data_loader(questions, image_folder, tokenizer, image_processor, model_config, batch_size=1, num_workers=4):
-    assert batch_size == 1, "batch_size must be 1"
-    dataset = CustomDataset(questions, image_folder, tokenizer, image_processor, model_config)
-    data_loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False, collate_fn=collate_fn)
+def create_data_loader(questions, image_folder, tokenizer, image_processor, model_config, batches, num_workers=4,
+                       image_cache=None):
+    dataset = CustomDataset(questions, image_folder, tokenizer, image_processor, model_config, image_cache)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    data_loader = DataLoader(dataset, batch_sampler=batches, num_workers=num_workers,
+                             collate_fn=partial(collate_fn, pad_token_id=pad_token_id))
     return data_loader
 
 
+def length_batches(lengths, batch_size):
+    """
+    Batches of question indices with equal prompt lengths, so that no row is padded. Questions keep
+    their order within a length, and batches are ordered by their first question.
+    """
+    by_length = {}
+    for i, length in enumerate(lengths):
+        by_length.setdefault(length, []).append(i)
+    batches = [indices[i:i + batch_size] for indices in by_length.values()
+               for i in range(0, len(indices), batch_size)]
+    return sorted(batches, key=lambda batch: batch[0])
+
+
+def stop_token_ids(tokenizer, generation_config):
+    """Every eos id generate stops on, and the pad id it fills finished rows of a batch with."""
+    ids = {tokenizer.eos_token_id, generation_config.pad_token_id}
+    eos_token_id = generation_config.eos_token_id
+    ids.update(eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id])
+    ids.discard(None)
+    return ids
+
+
+def trim_output_ids(output_ids, stop_ids):
+    """Cut every row after its first stop token, batched rows that finish early are padded to the longest."""
+    rows = []
+    for row in output_ids.tolist():
+        end = next((i for i, token in enumerate(row) if token in stop_ids), None)
+        if end is not None:
+            row = row[:end + 1]
+        rows.append(row)
+    return rows
+
+
 def eval_model(args):
     # Model
     disable_torch_init()
@@ -86,43 +149,85 @@ def eval_model(args):
     questions = [json.loads(q) for q in open(os.path.expanduser(args.question_file), "r")]
     questions = get_chunk(questions, args.num_chunks, args.chunk_idx)
     answers_file = os.path.expanduser(args.answers_file)
-    os.makedirs(os.path.dirname(answers_file), exist_ok=True)
-    ans_file = open(answers_file, "w")
+    ans_file = AnswersFile(answers_file, resume=not args.overwrite, flush_every=args.flush_every)
+    questions = [q for q in questions if not ans_file.has(q["question_id"])]
 
     if 'plain' in model_name and 'finetune' not in model_name.lower() and 'mmtag' not in args.conv_mode:
         args.conv_mode = args.conv_mode + '_mmtag'
         print(f'It seems that this is a plain model, but it is not using a mmtag prompt, auto switching to {args.conv_mode}.')
 
-    data_loader = create_data_loader(questions, args.image_folder, tokenizer, image_processor, model.config)
-
-    for (input_ids, image_tensor, image_sizes), line in tqdm(zip(data_loader, questions), total=len(questions)):
-        idx = line["question_id"]
-        cur_prompt = line["text"]
+    if args.fp32:
+        model.float()
+    image_dtype = torch.float32 if args.fp32 else torch.float16
+    if args.pad_batches:
+        model.config.tokenizer_padding_side = "left"
+        batches = [list(range(i, min(i + args.batch_size, len(questions))))
+                   for i in range(0, len(questions), args.batch_size)]
+    else:
+        lengths = [len(tokenizer_image_token(build_prompt(q, model.config), tokenizer, IMAGE_TOKEN_INDEX))
+                   for q in questions]
+        if getattr(model.config, "image_aspect_ratio", None) == "anyres":
+            # The number of image features depends on the image size, opening an image only reads its header
+            lengths = [(length, Image.open(os.path.join(args.image_folder, q["image"])).size)
+                       for length, q in zip(lengths, questions)]
+        batches = length_batches(lengths, args.batch_size)
+    if args.scoring == "likelihood":
+        candidate_ids = tokenize_options(tokenizer, args.candidates)
+    stop_ids = stop_token_ids(tokenizer, model.generation_config)
+    image_cache = None
+    if args.image_cache_dir:
+        image_cache = ImageTensorCache(args.image_cache_dir, image_processor,
+                                       getattr(model.config, "image_aspect_ratio", None))
+        print(f"{len(image_cache)} preprocessed images cached in {image_cache.dir}.")
+    data_loader = create_data_loader(questions, args.image_folder, tokenizer, image_processor, model.config,
+                                     batches, num_workers=args.num_workers, image_cache=image_cache)
 
+    # Answers of batches that ran ahead wait here, so the file is written in question order
+    finished = {}
+    num_written = 0
+    progress = tqdm(total=len(questions))
+    for (input_ids, attention_mask, image_tensor, image_sizes), indices in zip(data_loader, batches):
         input_ids = input_ids.to(device='cuda', non_blocking=True)
+        if attention_mask is not None:
+            attention_mask = attention_mask.to(device='cuda', non_blocking=True)
+        if isinstance(image_tensor, list):
+            image_tensor = [x.to(dtype=image_dtype, device='cuda', non_blocking=True) for x in image_tensor]
+        else:
+            image_tensor = image_tensor.to(dtype=image_dtype, device='cuda', non_blocking=True)
+
+        if args.scoring == "likelihood":
+            scores = score_options(model, input_ids, candidate_ids, images=image_tensor,
+                                   image_sizes=image_sizes, attention_mask=attention_mask)
+            outputs = [args.candidates[i] for i in scores.argmax(dim=-1).tolist()]
+        else:
+            with torch.inference_mode():
+                output_ids = model.generate(
+                    input_ids,
+                    attention_mask=attention_mask,
+                    images=image_tensor,
+                    image_sizes=image_sizes,
+                    do_sample=True if args.temperature > 0 else False,
+                    temperature=args.temperature,
+                    top_p=args.top_p,
+                    num_beams=args.num_beams,
+                    max_new_tokens=args.max_new_tokens,
+                    use_cache=True)
+
+            outputs = tokenizer.batch_decode(trim_output_ids(output_ids, stop_ids), skip_special_tokens=True)
 
-        with torch.inference_mode():
-            output_ids = model.generate(
-                input_ids,
-                images=image_tensor.to(dtype=torch.float16, device='cuda', non_blocking=True),
-                image_sizes=image_sizes,
-                do_sample=True if args.temperature > 0 else False,
-                temperature=args.temperature,
-                top_p=args.top_p,
-                num_beams=args.num_beams,
-                max_new_tokens=args.max_new_tokens,
-                use_cache=True)
-
-        outputs = tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0].strip()
-
-        ans_id = shortuuid.uuid()
-        ans_file.write(json.dumps({"question_id": idx,
-                                   "prompt": cur_prompt,
-                                   "text": outputs,
-                                   "answer_id": ans_id,
-                                   "model_id": model_name,
-                                   "metadata": {}}) + "\n")
-        # ans_file.flush()
+        finished.update(zip(indices, outputs))
+        while num_written in finished:
+            line, output = questions[num_written], finished.pop(num_written)
+            ans_id = shortuuid.uuid()
+            ans_file.write({"question_id": line["question_id"],
+                            "prompt": line["text"],
+                            "text": output.strip(),
+                            "answer_id": ans_id,
+                            "model_id": model_name,
+                            "metadata": {}})
+            num_written += 1
+        progress.update(len(indices))
+    progress.close()
     ans_file.close()
 
 if __name__ == "__main__":
@@ -139,6 +244,24 @@ if __name__ == "__main__":
     parser.add_argument("--top_p", type=float, default=None)
     parser.add_argument("--num_beams", type=int, default=1)
     parser.add_argument("--max_new_tokens", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=1,
+        help="Questions per generate call. Only prompts of equal length are batched, so no row is padded; "
+             "llava/eval/check_batch_parity.py diffs the answers against batch size 1.")
+    parser.add_argument("--pad-batches", action="store_true",
+        help="Batch questions in file order with left padding instead: fuller batches, but greedy answers "
+             "can differ from batch size 1.")
+    parser.add_argument("--fp32", action="store_true",
+        help="Run the model in fp32, where batch shapes are far less likely to flip a greedy token.")
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--image-cache-dir", type=str, default=None,
+        help="Read preprocessed images from this cache, see llava/eval/image_tensor_cache.py.")
+    parser.add_argument("--scoring", type=str, default="generate", choices=["generate", "likelihood"],
+        help="likelihood: answer with the candidate of highest log-likelihood instead of generating.")
+    parser.add_argument("--candidates", type=str, nargs="+", default=["Yes", "No"],
+        help="Answers scored by --scoring likelihood, e.g. Yes No for POPE.")
+    parser.add_argument("--flush-every", type=int, default=1)
+    parser.add_argument("--overwrite", action="store_true",
+        help="Start a new answers file instead of resuming the existing one.")
     args = parser.parse_args()
 
     eval_model(args)
@@ -11,6 +11,8 @@ from llava.conversation import conv_templates, SeparatorStyle
 from llava.model.builder import load_pretrained_model
 from llava.utils import disable_torch_init
 from llava.mm_utils import tokenizer_image_token, process_images, load_image_from_base64, get_model_name_from_path
+from llava.eval.answers_file import AnswersFile
+from llava.eval.option_scoring import tokenize_options, score_options
 
 from PIL import Image
 import math
@@ -61,8 +63,7 @@ def eval_model(args):
     questions = pd.read_table(os.path.expanduser(args.question_file))
     questions = get_chunk(questions, args.num_chunks, args.chunk_idx)
     answers_file = os.path.expanduser(args.answers_file)
-    os.makedirs(os.path.dirname(answers_file), exist_ok=True)
-    ans_file = open(answers_file, "w")
+    ans_file = AnswersFile(answers_file, resume=not args.overwrite, flush_every=args.flush_every)
 
     if 'plain' in model_name and 'finetune' not in model_name.lower() and 'mmtag' not in args.conv_mode:
         args.conv_mode = args.conv_mode + '_mmtag'
@@ -79,6 +80,10 @@ def eval_model(args):
 
         for round_idx in range(num_rounds):
             idx = row['index']
+            if ans_file.has(idx, round_idx):
+                options = options[1:] + options[:1]
+                cur_option_char = cur_option_char[1:] + cur_option_char[:1]
+                continue
             question = row['question']
             hint = row['hint']
             image = load_image_from_base64(row['image'])
@@ -107,32 +112,39 @@ def eval_model(args):
 
             image_tensor = process_images([image], image_processor, model.config)[0]
 
-            with torch.inference_mode():
-                output_ids = model.generate(
-                    input_ids,
-                    images=image_tensor.unsqueeze(0).half().cuda(),
-                    image_sizes=[image.size],
-                    do_sample=True if args.temperature > 0 else False,
-                    temperature=args.temperature,
-                    top_p=args.top_p,
-                    num_beams=args.num_beams,
-                    # no_repeat_ngram_size=3,
-                    max_new_tokens=1024,
-                    use_cache=True)
-
-            outputs = tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0].strip()
+            metadata = {}
+            if args.scoring == "likelihood":
+                letters = all_options[:len(options)]
+                scores = score_options(model, input_ids, tokenize_options(tokenizer, letters),
+                                       images=image_tensor.unsqueeze(0).half().cuda(), image_sizes=[image.size])[0]
+                outputs = letters[int(scores.argmax())]
+                metadata["option_scores"] = dict(zip(letters, scores.tolist()))
+            else:
+                with torch.inference_mode():
+                    output_ids = model.generate(
+                        input_ids,
+                        images=image_tensor.unsqueeze(0).half().cuda(),
+                        image_sizes=[image.size],
+                        do_sample=True if args.temperature > 0 else False,
+                        temperature=args.temperature,
+                        top_p=args.top_p,
+                        num_beams=args.num_beams,
+                        # no_repeat_ngram_size=3,
+                        max_new_tokens=1024,
+                        use_cache=True)
+
+                outputs = tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0].strip()
 
             ans_id = shortuuid.uuid()
-            ans_file.write(json.dumps({"question_id": idx,
-                                    "round_id": round_idx,
-                                    "prompt": cur_prompt,
-                                    "text": outputs,
-                                    "options": options,
-                                    "option_char": cur_option_char,
-                                    "answer_id": ans_id,
-                                    "model_id": model_name,
-                                    "metadata": {}}) + "\n")
-            ans_file.flush()
+            ans_file.write({"question_id": idx,
+                            "round_id": round_idx,
+                            "prompt": cur_prompt,
+                            "text": outputs,
+                            "options": options,
+                            "option_char": cur_option_char,
+                            "answer_id": ans_id,
+                            "model_id": model_name,
+                            "metadata": metadata})
 
             # rotate options
             options = options[1:] + options[:1]
@@ -155,6 +167,11 @@ if __name__ == "__main__":
     parser.add_argument("--all-rounds", action="store_true")
     parser.add_argument("--single-pred-prompt", action="store_true")
     parser.add_argument("--lang", type=str, default="en")
+    parser.add_argument("--scoring", type=str, default="generate", choices=["generate", "likelihood"],
+        help="likelihood: answer with the option letter of highest log-likelihood instead of generating.")
+    parser.add_argument("--flush-every", type=int, default=1)
+    parser.add_argument("--overwrite", action="store_true",
+        help="Start a new answers file instead of resuming the existing one.")
     args = parser.parse_args()
 
     eval_model(args)
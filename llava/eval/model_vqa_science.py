@@ -10,6 +10,8 @@ from llava.conversation import conv_templates, SeparatorStyle
 from llava.model.builder import load_pretrained_model
 from llava.utils import disable_torch_init
 from llava.mm_utils import tokenizer_image_token, process_images, get_model_name_from_path
+from llava.eval.answers_file import AnswersFile
+from llava.eval.option_scoring import option_letters, tokenize_options, score_options
 
 from PIL import Image
 import math
@@ -36,8 +38,8 @@ def eval_model(args):
     questions = json.load(open(os.path.expanduser(args.question_file), "r"))
     questions = get_chunk(questions, args.num_chunks, args.chunk_idx)
     answers_file = os.path.expanduser(args.answers_file)
-    os.makedirs(os.path.dirname(answers_file), exist_ok=True)
-    ans_file = open(answers_file, "w")
+    ans_file = AnswersFile(answers_file, resume=not args.overwrite, flush_every=args.flush_every)
+    questions = [q for q in questions if not ans_file.has(q["id"])]
     for i, line in enumerate(tqdm(questions)):
         idx = line["id"]
         question = line['conversations'][0]
@@ -70,27 +72,34 @@ def eval_model(args):
 
         input_ids = tokenizer_image_token(prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).cuda()
 
-        with torch.inference_mode():
-            output_ids = model.generate(
-                input_ids,
-                images=images,
-                image_sizes=image_sizes,
-                do_sample=True if args.temperature > 0 else False,
-                temperature=args.temperature,
-                max_new_tokens=1024,
-                use_cache=True,
-            )
-
-        outputs = tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0].strip()
+        letters = option_letters(question['value']) if args.scoring == "likelihood" else []
+        metadata = {}
+        if letters:
+            scores = score_options(model, input_ids, tokenize_options(tokenizer, letters),
+                                   images=images, image_sizes=image_sizes)[0]
+            outputs = letters[int(scores.argmax())]
+            metadata["option_scores"] = dict(zip(letters, scores.tolist()))
+        else:
+            with torch.inference_mode():
+                output_ids = model.generate(
+                    input_ids,
+                    images=images,
+                    image_sizes=image_sizes,
+                    do_sample=True if args.temperature > 0 else False,
+                    temperature=args.temperature,
+                    max_new_tokens=1024,
+                    use_cache=True,
+                )
+
+            outputs = tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0].strip()
 
         ans_id = shortuuid.uuid()
-        ans_file.write(json.dumps({"question_id": idx,
-                                   "prompt": cur_prompt,
-                                   "text": outputs,
-                                   "answer_id": ans_id,
-                                   "model_id": model_name,
-                                   "metadata": {}}) + "\n")
-        ans_file.flush()
+        ans_file.write({"question_id": idx,
+                        "prompt": cur_prompt,
+                        "text": outputs,
+                        "answer_id": ans_id,
+                        "model_id": model_name,
+                        "metadata": metadata})
     ans_file.close()
 
 if __name__ == "__main__":
@@ -106,6 +115,11 @@ if __name__ == "__main__":
     parser.add_argument("--temperature", type=float, default=0.2)
     parser.add_argument("--answer-prompter", action="store_true")
     parser.add_argument("--single-pred-prompt", action="store_true")
+    parser.add_argument("--scoring", type=str, default="generate", choices=["generate", "likelihood"],
+        help="likelihood: answer with the option letter of highest log-likelihood instead of generating.")
+    parser.add_argument("--flush-every", type=int, default=1)
+    parser.add_argument("--overwrite", action="store_true",
+        help="Start a new answers file instead of resuming the existing one.")
     args = parser.parse_args()
 
     eval_model(args)
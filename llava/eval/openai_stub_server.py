@@ -0,0 +1,60 @@
+"""
+A local stand-in for the OpenAI chat completions API, to run the GPT review scripts offline.
+
+Every request gets a deterministic review "<score> <score>\n..." derived
+from a hash of its messages. `--rate-limit-prob` answers that share of the
+requests with 429 to exercise the client's backoff.
+
+Usage:
+python3 -m llava.eval.openai_stub_server --port 8100
+python3 llava/eval/eval_gpt_review.py --api-base http://localhost:8100/v1 ...
+"""
+import argparse
+import hashlib
+import json
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+import uvicorn
+
+
+app = FastAPI()
+stats = {"requests": 0, "rate_limited": 0}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+    if random.random() < args.rate_limit_prob:
+        stats["rate_limited"] += 1
+        return JSONResponse({"error": {"message": "Rate limit reached (stub)."}},
+                            status_code=429, headers={"Retry-After": "0"})
+
+    digest = hashlib.sha256(json.dumps(body["messages"], sort_keys=True).encode()).digest()
+    content = f"{digest[0] % 10 + 1} {digest[1] % 10 + 1}\nStub review."
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+    }
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--rate-limit-prob", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
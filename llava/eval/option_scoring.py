@@ -0,0 +1,78 @@
+"""
+Likelihood scoring for multiple-choice evals.
+
+Instead of generating an answer and parsing it, every candidate answer is
+scored by its log-likelihood after the prompt and the best one is taken. The
+image and question are prefilled once per question; single-token candidates
+(option letters, Yes / No) are read off the logits of that pass, longer ones
+are scored together in one more pass over copies of the prompt's KV cache.
+"""
+import re
+
+import torch
+
+from llava.mm_utils import legacy_cache
+
+
+def option_letters(question):
+    """Option letters of a ScienceQA style `Options: (A) ... (B) ...` line."""
+    for line in question.split("\n"):
+        if line.startswith("Options:"):
+            return re.findall(r"\(([A-Z])\) ", line)
+    return []
+
+
+def tokenize_options(tokenizer, options):
+    """Token ids of every option as it continues the prompt."""
+    return [tokenizer(option, add_special_tokens=False).input_ids for option in options]
+
+
+@torch.inference_mode()
+def score_options(model, input_ids, option_ids, images=None, image_sizes=None, attention_mask=None):
+    """
+    Log-likelihood of every option after every prompt, shape (batch, num options).
+
+    `input_ids` is a batch of prompts, left padded when `attention_mask` is
+    given; all prompts share the same `option_ids` (one list of token ids per option).
+    """
+    if images is not None:
+        _, position_ids, attention_mask, _, inputs_embeds, _ = model.prepare_inputs_labels_for_multimodal(
+            input_ids, None, attention_mask, None, None, images, image_sizes=image_sizes)
+    else:
+        position_ids = None
+        inputs_embeds = model.get_model().embed_tokens(input_ids)
+    if attention_mask is None:
+        attention_mask = torch.ones(inputs_embeds.shape[:2], dtype=torch.long, device=inputs_embeds.device)
+    attention_mask = attention_mask.long()
+    if position_ids is None:
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+
+    outputs = model(inputs_embeds=inputs_embeds, attention_mask=attention_mask,
+                    position_ids=position_ids, use_cache=True)
+    first_logprobs = outputs.logits[:, -1].float().log_softmax(dim=-1)
+    first_ids = torch.tensor([ids[0] for ids in option_ids], device=first_logprobs.device)
+    scores = first_logprobs[:, first_ids]
+    max_len = max(len(ids) for ids in option_ids)
+    if max_len == 1:
+        return scores
+
+    # Feed all options but their last token at once, every row on its own copy of its prompt's cache
+    batch_size, num_options = scores.shape
+    device = input_ids.device
+    ids = torch.zeros((num_options, max_len), dtype=torch.long, device=device)
+    mask = torch.zeros((num_options, max_len), dtype=torch.long, device=device)
+    for i, option in enumerate(option_ids):
+        ids[i, :len(option)] = torch.tensor(option, device=device)
+        mask[i, :len(option)] = 1
+    ids, mask = ids.repeat(batch_size, 1), mask.repeat(batch_size, 1)
+
+    past_key_values = tuple(
+        tuple(x.repeat_interleave(num_options, dim=0) for x in layer)
+        for layer in legacy_cache(outputs.past_key_values))
+    prefix_mask = attention_mask.repeat_interleave(num_options, dim=0)
+    positions = position_ids[:, -1:].repeat_interleave(num_options, dim=0) + 1 + torch.arange(max_len - 1, device=device)
+    outputs = model(input_ids=ids[:, :-1], attention_mask=torch.cat([prefix_mask, mask[:, :-1]], dim=1),
+                    position_ids=positions, past_key_values=past_key_values, use_cache=False)
+    logprobs = outputs.logits.float().log_softmax(dim=-1).gather(-1, ids[:, 1:, None]).squeeze(-1)
+    rest = (logprobs * mask[:, 1:]).sum(dim=-1).view(batch_size, num_options)
+    return scores + rest.to(scores.device)
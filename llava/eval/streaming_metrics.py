@@ -0,0 +1,161 @@
+"""
+Streaming metrics for the llava/eval scorers.
+
+The scorers read the result jsonl one answer at a time (see
+`answers_file.iter_answers`) and fold every answer into running metrics, so
+memory does not grow with the result file and the metrics so far can be
+printed while a long eval is still writing it (`--report-every`, `--follow`).
+Annotation files are reduced to the index a scorer needs once, and the index
+is cached on disk until the annotation file changes.
+"""
+import hashlib
+import json
+import os
+import pickle
+import types
+from collections import defaultdict
+
+
+def cached_index(paths, build, name, cache_dir="~/.cache/llava/eval_index"):
+    """
+    `build()`, computed once and cached until any of `paths` changes.
+
+    `name` tells apart the different indices built from the same files.
+    """
+    stats = [(os.path.abspath(p), os.stat(p).st_size, os.stat(p).st_mtime_ns) for p in paths]
+    key = hashlib.sha1(json.dumps([name, stats]).encode()).hexdigest()
+    cache_path = os.path.join(os.path.expanduser(cache_dir), f"{name}-{key[:16]}.pkl")
+    try:
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        pass
+    index = build()
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+    return index
+
+
+class MeanMetric(object):
+    """
+    Running mean of per-answer scores, overall and per group.
+
+    An answer updated again under the same `key` replaces its earlier score,
+    like a later line of a result file overrides an earlier one.
+    """
+
+    def __init__(self):
+        self.sums = defaultdict(int)
+        self.counts = defaultdict(int)
+        self.scores = {}
+
+    def update(self, score, key=None, groups=()):
+        if key is not None:
+            if key in self.scores:
+                old_score, old_groups = self.scores[key]
+                self._add(-old_score, -1, old_groups)
+            self.scores[key] = (score, groups)
+        self._add(score, 1, groups)
+
+    def _add(self, score, count, groups):
+        for group in (None,) + tuple(groups):
+            self.sums[group] += score
+            self.counts[group] += count
+
+    def count(self, group=None):
+        return self.counts[group]
+
+    def total(self, group=None):
+        return self.sums[group]
+
+    def mean(self, group=None):
+        return self.sums[group] / self.counts[group] if self.counts[group] else 0.0
+
+
+class BinaryMetrics(object):
+    """Running confusion matrix of yes (1) / no (0) answers."""
+
+    def __init__(self):
+        self.tp = self.fp = self.tn = self.fn = 0
+        self.num_preds = 0
+        self.num_yes = 0
+
+    def update(self, pred, label=None):
+        """`label` None counts the answer in the yes ratio only."""
+        self.num_preds += 1
+        self.num_yes += pred
+        if label is None:
+            return
+        if pred and label:
+            self.tp += 1
+        elif pred:
+            self.fp += 1
+        elif not label:
+            self.tn += 1
+        else:
+            self.fn += 1
+
+    def summary(self):
+        precision = self.tp / (self.tp + self.fp) if self.tp + self.fp else 0.0
+        recall = self.tp / (self.tp + self.fn) if self.tp + self.fn else 0.0
+        total = self.tp + self.fp + self.tn + self.fn
+        return {
+            "f1": 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+            "acc": (self.tp + self.tn) / total if total else 0.0,
+            "precision": precision,
+            "recall": recall,
+            "yes_ratio": self.num_yes / self.num_preds if self.num_preds else 0.0,
+        }
+
+
+class LiveReport(object):
+    """Prints `summary()` as a json line every `every` answers; `every` 0 never prints."""
+
+    def __init__(self, summary, every=0):
+        self.summary = summary
+        self.every = every
+        self.num_answers = 0
+
+    def step(self, n=1):
+        before = self.num_answers
+        self.num_answers += n
+        if self.every and before // self.every != self.num_answers // self.every:
+            print(json.dumps(dict(answers=self.num_answers, **self.summary())), flush=True)
+
+
+class JsonItems(object):
+    """(key, value) pairs that `dump_json_stream` writes as a json object while they are produced."""
+
+    def __init__(self, items):
+        self.items = items
+
+
+def dump_json_stream(obj, f, indent=2, level=0):
+    """
+    Write `obj` to `f` like json.dump(obj, f, indent=indent), where a generator is
+    written as a list and `JsonItems` as an object, one item at a time, so that
+    per-answer outputs never have to be held in memory.
+    """
+    if isinstance(obj, JsonItems):
+        entries, brackets = ((json.dumps(key) + ": ", value) for key, value in obj.items), "{}"
+    elif isinstance(obj, types.GeneratorType):
+        entries, brackets = (("", value) for value in obj), "[]"
+    else:
+        f.write(json.dumps(obj, indent=indent).replace("\n", "\n" + " " * indent * level))
+        return
+    empty = True
+    for prefix, value in entries:
+        f.write((brackets[0] if empty else ",") + "\n" + " " * indent * (level + 1) + prefix)
+        dump_json_stream(value, f, indent, level + 1)
+        empty = False
+    f.write(brackets if empty else "\n" + " " * indent * level + brackets[1])
+
+
+def add_streaming_args(parser):
+    parser.add_argument('--report-every', type=int, default=0,
+        help='Print the metrics so far every N answers.')
+    parser.add_argument('--follow', type=float, default=None,
+        help='Score a result file that a running eval is still writing, until it is idle for this many seconds.')
@@ -4,6 +4,7 @@ import base64
 import torch
 import math
 import ast
+import time
 
 from transformers import StoppingCriteria
 from llava.constants import IMAGE_TOKEN_INDEX
@@ -204,6 +205,84 @@ def tokenizer_image_token(prompt, tokenizer, image_token_index=IMAGE_TOKEN_INDEX
     return input_ids
 
 
+class PromptTokenCache:
+    """
+    Tokenizes single-turn prompts of one conversation template with its fixed pieces (system prompt, role headers,
+    separators) tokenized once, so only the user's message is tokenized per call. The result is checked against
+    `tokenizer_image_token` on the full prompt for probe messages of every supported shape (an image before and/or
+    after the text, non-ASCII text), and the full prompt is tokenized for shapes the cached pieces do not reproduce.
+    Messages the probes do not cover, with more images or whitespace at a chunk boundary where tokens can merge
+    across it, are always tokenized in full.
+    """
+    placeholder = "\x00message\x00"
+    image_first = '<image>\n'
+    image_last = '\n<image>'
+    probe_messages = (
+        "What is shown in this image?",
+        "Could you explain what this mass in the MRI means for my health?",
+        "这张胸片显示了什么？Ist das Röntgenbild auffällig? 80 µg/m², ≥ 5 mm",
+    )
+
+    def __init__(self, tokenizer, conv, suffix="", image_token_index=IMAGE_TOKEN_INDEX):
+        self.tokenizer = tokenizer
+        self.image_token_index = image_token_index
+        conv = conv.copy()
+        conv.append_message(conv.roles[0], self.placeholder)
+        conv.append_message(conv.roles[1], None)
+        self.prefix, self.suffix = conv.get_prompt().split(self.placeholder)
+        self.suffix += suffix
+        self.prefix_ids = tokenizer(self.prefix).input_ids
+        self.suffix_ids = self._tokenize(self.suffix)
+        self.exact = {}
+        for shape in ((False, False), (True, False), (False, True), (True, True)):
+            self.exact[shape] = all(
+                self._encode(message) == self._encode_full(message)
+                for message in self._probes(shape)
+            )
+
+    def _probes(self, shape):
+        image_first, image_last = shape
+        return [(self.image_first if image_first else '') + message + (self.image_last if image_last else '')
+                for message in self.probe_messages]
+
+    def _shape(self, message):
+        """(image first, image last) of a message the probes cover, None otherwise."""
+        image_first = message.startswith(self.image_first)
+        image_last = message.endswith(self.image_last)
+        text = message[len(self.image_first) if image_first else 0:
+                       len(message) - len(self.image_last) if image_last else len(message)]
+        if not text or '<image>' in text or text != text.strip():
+            return None
+        return image_first, image_last
+
+    def _tokenize(self, text):
+        return self.tokenizer(text, add_special_tokens=False).input_ids if text else []
+
+    def _encode(self, message):
+        input_ids = list(self.prefix_ids)
+        for i, chunk in enumerate(message.split('<image>')):
+            if i > 0:
+                input_ids.append(self.image_token_index)
+            input_ids.extend(self._tokenize(chunk))
+        input_ids.extend(self.suffix_ids)
+        return input_ids
+
+    def _encode_full(self, message):
+        return tokenizer_image_token(self.prefix + message + self.suffix, self.tokenizer, self.image_token_index)
+
+    def __call__(self, message, return_tensors=None):
+        shape = self._shape(message)
+        if shape is not None and self.exact[shape]:
+            input_ids = self._encode(message)
+        else:
+            input_ids = self._encode_full(message)
+        if return_tensors is not None:
+            if return_tensors == 'pt':
+                return torch.tensor(input_ids, dtype=torch.long)
+            raise ValueError(f'Unsupported tensor type: {return_tensors}')
+        return input_ids
+
+
 def get_model_name_from_path(model_path):
     model_path = model_path.strip("/")
     model_paths = model_path.split("/")
@@ -212,6 +291,14 @@ def get_model_name_from_path(model_path):
     else:
         return model_paths[-1]
 
+
+def legacy_cache(past_key_values):
+    """Per-layer (key, value) tuples, which can be padded, concatenated and indexed along the batch."""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
 class KeywordsStoppingCriteria(StoppingCriteria):
     def __init__(self, keywords, tokenizer, input_ids):
         self.keywords = keywords
@@ -245,3 +332,29 @@ class KeywordsStoppingCriteria(StoppingCriteria):
         for i in range(output_ids.shape[0]):
             outputs.append(self.call_for_batch(output_ids[i].unsqueeze(0), scores))
         return all(outputs)
+
+
+class CancelStoppingCriteria(StoppingCriteria):
+    """Stops generation at the next decode step once `cancel_event` (a threading.Event) is set."""
+    def __init__(self, cancel_event):
+        self.cancel_event = cancel_event
+
+    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        return self.cancel_event.is_set()
+
+
+class DeadlineStoppingCriteria(StoppingCriteria):
+    """
+    Stops generation at the next decode step once `deadline` (unix time) has passed. `expired` is set when that cut
+    the answer short; a step that ends on `eos_token_id` finished the answer on its own.
+    """
+    def __init__(self, deadline, eos_token_id=None):
+        self.deadline = deadline
+        self.eos_token_id = eos_token_id
+        self.expired = False
+
+    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        if time.time() < self.deadline:
+            return False
+        self.expired = self.eos_token_id is None or output_ids[0, -1].item() != self.eos_token_id
+        return True
@@ -0,0 +1,221 @@
+"""
+Check that the batched prepare_inputs_labels_for_multimodal matches the per-sample loop it replaced.
+
+Random batches with left and right padding, mixed lengths, rows with zero, one
+or several images, truncation to tokenizer_model_max_length, and both tensor
+and list (variable length) image features go through both implementations;
+embeds, labels, attention_mask and position_ids must be exactly equal.
+
+Usage:
+python3 -m llava.model.check_multimodal_inputs --trials 200
+"""
+import argparse
+import random
+from types import SimpleNamespace
+
+import torch
+import torch.nn as nn
+
+from llava.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX
+from llava.model.llava_arch import LlavaMetaForCausalLM
+
+
+class ToyModel(LlavaMetaForCausalLM):
+    """Embedding table and an "encoder" that sums the channels of [N, 3, num_patches, hidden] images."""
+
+    def __init__(self, config, vocab_size=100, hidden_size=8):
+        self.config = config
+        self.embed_tokens = nn.Embedding(vocab_size, hidden_size)
+        self.device = torch.device("cpu")
+
+    def get_model(self):
+        return self
+
+    def get_vision_tower(self):
+        return self
+
+    def encode_images(self, images):
+        return images.sum(dim=1)
+
+
+def reference_prepare_inputs(model, input_ids, position_ids, attention_mask, labels, image_features):
+    """The per-sample loop of prepare_inputs_labels_for_multimodal, from after the image features are computed."""
+    _labels = labels
+    _position_ids = position_ids
+    _attention_mask = attention_mask
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids, dtype=torch.bool)
+    else:
+        attention_mask = attention_mask.bool()
+    if position_ids is None:
+        position_ids = torch.arange(0, input_ids.shape[1], dtype=torch.long, device=input_ids.device)
+    if labels is None:
+        labels = torch.full_like(input_ids, IGNORE_INDEX)
+
+    input_ids = [cur_input_ids[cur_attention_mask] for cur_input_ids, cur_attention_mask in zip(input_ids, attention_mask)]
+    labels = [cur_labels[cur_attention_mask] for cur_labels, cur_attention_mask in zip(labels, attention_mask)]
+
+    new_input_embeds = []
+    new_labels = []
+    cur_image_idx = 0
+    for batch_idx, cur_input_ids in enumerate(input_ids):
+        num_images = (cur_input_ids == IMAGE_TOKEN_INDEX).sum()
+        if num_images == 0:
+            cur_image_features = image_features[cur_image_idx]
+            cur_input_embeds_1 = model.get_model().embed_tokens(cur_input_ids)
+            cur_input_embeds = torch.cat([cur_input_embeds_1, cur_image_features[0:0]], dim=0)
+            new_input_embeds.append(cur_input_embeds)
+            new_labels.append(labels[batch_idx])
+            cur_image_idx += 1
+            continue
+
+        image_token_indices = [-1] + torch.where(cur_input_ids == IMAGE_TOKEN_INDEX)[0].tolist() + [cur_input_ids.shape[0]]
+        cur_input_ids_noim = []
+        cur_labels = labels[batch_idx]
+        cur_labels_noim = []
+        for i in range(len(image_token_indices) - 1):
+            cur_input_ids_noim.append(cur_input_ids[image_token_indices[i]+1:image_token_indices[i+1]])
+            cur_labels_noim.append(cur_labels[image_token_indices[i]+1:image_token_indices[i+1]])
+        split_sizes = [x.shape[0] for x in cur_labels_noim]
+        cur_input_embeds = model.get_model().embed_tokens(torch.cat(cur_input_ids_noim))
+        cur_input_embeds_no_im = torch.split(cur_input_embeds, split_sizes, dim=0)
+        cur_new_input_embeds = []
+        cur_new_labels = []
+
+        for i in range(num_images + 1):
+            cur_new_input_embeds.append(cur_input_embeds_no_im[i])
+            cur_new_labels.append(cur_labels_noim[i])
+            if i < num_images:
+                cur_image_features = image_features[cur_image_idx]
+                cur_image_idx += 1
+                cur_new_input_embeds.append(cur_image_features)
+                cur_new_labels.append(torch.full((cur_image_features.shape[0],), IGNORE_INDEX, device=cur_labels.device, dtype=cur_labels.dtype))
+
+        cur_new_input_embeds = [x.to(model.device) for x in cur_new_input_embeds]
+        new_input_embeds.append(torch.cat(cur_new_input_embeds))
+        new_labels.append(torch.cat(cur_new_labels))
+
+    tokenizer_model_max_length = getattr(model.config, 'tokenizer_model_max_length', None)
+    if tokenizer_model_max_length is not None:
+        new_input_embeds = [x[:tokenizer_model_max_length] for x in new_input_embeds]
+        new_labels = [x[:tokenizer_model_max_length] for x in new_labels]
+
+    max_len = max(x.shape[0] for x in new_input_embeds)
+    batch_size = len(new_input_embeds)
+
+    new_input_embeds_padded = []
+    new_labels_padded = torch.full((batch_size, max_len), IGNORE_INDEX, dtype=new_labels[0].dtype, device=new_labels[0].device)
+    attention_mask = torch.zeros((batch_size, max_len), dtype=attention_mask.dtype, device=attention_mask.device)
+    position_ids = torch.zeros((batch_size, max_len), dtype=position_ids.dtype, device=position_ids.device)
+
+    for i, (cur_new_embed, cur_new_labels) in enumerate(zip(new_input_embeds, new_labels)):
+        cur_len = cur_new_embed.shape[0]
+        padding = torch.zeros((max_len - cur_len, cur_new_embed.shape[1]), dtype=cur_new_embed.dtype, device=cur_new_embed.device)
+        if getattr(model.config, 'tokenizer_padding_side', 'right') == "left":
+            new_input_embeds_padded.append(torch.cat((padding, cur_new_embed), dim=0))
+            if cur_len > 0:
+                new_labels_padded[i, -cur_len:] = cur_new_labels
+                attention_mask[i, -cur_len:] = True
+                position_ids[i, -cur_len:] = torch.arange(0, cur_len, dtype=position_ids.dtype, device=position_ids.device)
+        else:
+            new_input_embeds_padded.append(torch.cat((cur_new_embed, padding), dim=0))
+            if cur_len > 0:
+                new_labels_padded[i, :cur_len] = cur_new_labels
+                attention_mask[i, :cur_len] = True
+                position_ids[i, :cur_len] = torch.arange(0, cur_len, dtype=position_ids.dtype, device=position_ids.device)
+
+    new_input_embeds = torch.stack(new_input_embeds_padded, dim=0)
+    new_labels = None if _labels is None else new_labels_padded
+    attention_mask = None if _attention_mask is None else attention_mask.to(dtype=_attention_mask.dtype)
+    position_ids = None if _position_ids is None else position_ids
+    return position_ids, attention_mask, new_input_embeds, new_labels
+
+
+def random_batch(rng, padding_side, vocab_size, hidden_size, num_patches, list_images):
+    """input_ids, attention_mask, labels and images of a random batch, padded on `padding_side`."""
+    batch_size = rng.randint(1, 5)
+    rows, num_features = [], 0
+    for _ in range(batch_size):
+        text = [rng.randrange(1, vocab_size) for _ in range(rng.randint(0, 12))]
+        for _ in range(rng.choice([0, 0, 1, 1, 1, 2, 3])):
+            text.insert(rng.randint(0, len(text)), IMAGE_TOKEN_INDEX)
+        # single column batches skip the multimodal path altogether
+        while len(text) < 2:
+            text.append(rng.randrange(1, vocab_size))
+        rows.append(text)
+        # a row without images still consumes one image feature
+        num_features += max(text.count(IMAGE_TOKEN_INDEX), 1)
+
+    width = max(len(row) for row in rows)
+    input_ids = torch.zeros((batch_size, width), dtype=torch.long)
+    attention_mask = torch.zeros((batch_size, width), dtype=torch.bool)
+    labels = torch.full((batch_size, width), IGNORE_INDEX, dtype=torch.long)
+    for i, row in enumerate(rows):
+        cols = slice(width - len(row), width) if padding_side == "left" else slice(0, len(row))
+        input_ids[i, cols] = torch.tensor(row)
+        attention_mask[i, cols] = True
+        labels[i, cols] = torch.tensor([IGNORE_INDEX if t == IMAGE_TOKEN_INDEX or rng.random() < 0.3 else t for t in row])
+
+    if list_images:
+        # every entry is one image feature, made of a varying number of encoded images
+        images = [torch.randn(rng.randint(1, 3), 3, num_patches, hidden_size) for _ in range(num_features)]
+        images = [x[0] if len(x) == 1 and rng.random() < 0.5 else x for x in images]
+    else:
+        images = torch.randn(num_features, 3, num_patches, hidden_size)
+    return input_ids, attention_mask, labels, images
+
+
+def reference_image_features(model, images):
+    if isinstance(images, list):
+        images = [x.unsqueeze(0) if x.ndim == 3 else x for x in images]
+        features = torch.split(model.encode_images(torch.cat(images, dim=0)), [x.shape[0] for x in images], dim=0)
+        return [x.flatten(0, 1) for x in features]
+    return model.encode_images(images)
+
+
+def same(a, b):
+    if a is None or b is None:
+        return a is None and b is None
+    return a.dtype == b.dtype and a.shape == b.shape and torch.equal(a, b)
+
+
+def check(trials, seed=0, vocab_size=100, hidden_size=8, num_patches=4):
+    rng = random.Random(seed)
+    torch.manual_seed(seed)
+    failures = []
+    for trial in range(trials):
+        padding_side = rng.choice(["left", "right"])
+        config = SimpleNamespace(tokenizer_padding_side=padding_side, mm_patch_merge_type="flat",
+                                 tokenizer_model_max_length=rng.choice([None, None, 6, 20]))
+        model = ToyModel(config, vocab_size, hidden_size)
+        input_ids, attention_mask, labels, images = random_batch(
+            rng, padding_side, vocab_size, hidden_size, num_patches, list_images=rng.random() < 0.5)
+        attention_mask = rng.choice([attention_mask, attention_mask.long(), None])
+        position_ids = rng.choice([None, torch.arange(input_ids.shape[1]).unsqueeze(0)])
+        labels = rng.choice([labels, None])
+
+        with torch.no_grad():
+            expected = reference_prepare_inputs(model, input_ids, position_ids, attention_mask, labels,
+                                                reference_image_features(model, images))
+            _, new_position_ids, new_attention_mask, _, new_input_embeds, new_labels = \
+                model.prepare_inputs_labels_for_multimodal(input_ids, position_ids, attention_mask, None, labels, images)
+            actual = [new_position_ids, new_attention_mask, new_input_embeds, new_labels]
+
+        names = ["position_ids", "attention_mask", "inputs_embeds", "labels"]
+        mismatched = [name for name, a, b in zip(names, actual, expected) if not same(a, b)]
+        if mismatched:
+            failures.append((trial, padding_side, mismatched))
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trials", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    failures = check(args.trials, args.seed)
+    for trial, padding_side, mismatched in failures:
+        print(f"trial {trial} ({padding_side} padding): {', '.join(mismatched)} differ")
+    assert not failures, f"{len(failures)} of {args.trials} batches differ from the per-sample loop"
+    print(f"{args.trials} batches match the per-sample loop exactly")
@@ -221,97 +221,82 @@ class LlavaMetaForCausalLM(ABC):
         if labels is None:
             labels = torch.full_like(input_ids, IGNORE_INDEX)
 
-        # remove the padding using attention_mask -- FIXME
-        _input_ids = input_ids
-        input_ids = [cur_input_ids[cur_attention_mask] for cur_input_ids, cur_attention_mask in zip(input_ids, attention_mask)]
-        labels = [cur_labels[cur_attention_mask] for cur_labels, cur_attention_mask in zip(labels, attention_mask)]
-
-        new_input_embeds = []
-        new_labels = []
-        cur_image_idx = 0
-        for batch_idx, cur_input_ids in enumerate(input_ids):
-            num_images = (cur_input_ids == IMAGE_TOKEN_INDEX).sum()
-            if num_images == 0:
-                cur_image_features = image_features[cur_image_idx]
-                cur_input_embeds_1 = self.get_model().embed_tokens(cur_input_ids)
-                cur_input_embeds = torch.cat([cur_input_embeds_1, cur_image_features[0:0]], dim=0)
-                new_input_embeds.append(cur_input_embeds)
-                new_labels.append(labels[batch_idx])
-                cur_image_idx += 1
-                continue
-
-            image_token_indices = [-1] + torch.where(cur_input_ids == IMAGE_TOKEN_INDEX)[0].tolist() + [cur_input_ids.shape[0]]
-            cur_input_ids_noim = []
-            cur_labels = labels[batch_idx]
-            cur_labels_noim = []
-            for i in range(len(image_token_indices) - 1):
-                cur_input_ids_noim.append(cur_input_ids[image_token_indices[i]+1:image_token_indices[i+1]])
-                cur_labels_noim.append(cur_labels[image_token_indices[i]+1:image_token_indices[i+1]])
-            split_sizes = [x.shape[0] for x in cur_labels_noim]
-            cur_input_embeds = self.get_model().embed_tokens(torch.cat(cur_input_ids_noim))
-            cur_input_embeds_no_im = torch.split(cur_input_embeds, split_sizes, dim=0)
-            cur_new_input_embeds = []
-            cur_new_labels = []
-
-            for i in range(num_images + 1):
-                cur_new_input_embeds.append(cur_input_embeds_no_im[i])
-                cur_new_labels.append(cur_labels_noim[i])
-                if i < num_images:
-                    cur_image_features = image_features[cur_image_idx]
-                    cur_image_idx += 1
-                    cur_new_input_embeds.append(cur_image_features)
-                    cur_new_labels.append(torch.full((cur_image_features.shape[0],), IGNORE_INDEX, device=cur_labels.device, dtype=cur_labels.dtype))
-
-            cur_new_input_embeds = [x.to(self.device) for x in cur_new_input_embeds]
-
-            cur_new_input_embeds = torch.cat(cur_new_input_embeds)
-            cur_new_labels = torch.cat(cur_new_labels)
-
-            new_input_embeds.append(cur_new_input_embeds)
-            new_labels.append(cur_new_labels)
+        # The whole batch is processed at once: image token positions, output offsets, truncation and
+        # padding are computed with tensor ops and written into a single preallocated buffer.
+        embed_tokens = self.get_model().embed_tokens
+        batch_size = input_ids.shape[0]
+        is_image = (input_ids == IMAGE_TOKEN_INDEX) & attention_mask
+        is_text = attention_mask & ~is_image
+
+        if isinstance(image_features, torch.Tensor):
+            feature_lens = torch.full((image_features.shape[0],), image_features.shape[1], dtype=torch.long, device=input_ids.device)
+            flat_image_features = image_features.flatten(0, 1)
+        else:
+            feature_lens = torch.tensor([x.shape[0] for x in image_features], dtype=torch.long, device=input_ids.device)
+            flat_image_features = torch.cat(list(image_features), dim=0)
+        feature_offsets = torch.cumsum(feature_lens, dim=0) - feature_lens
+
+        # Index of the image feature used by every image token. A row without images still
+        # consumes one image feature.
+        num_images = is_image.sum(dim=1).clamp(min=1)
+        row_image_offsets = torch.cumsum(num_images, dim=0) - num_images
+        image_idx = row_image_offsets[:, None] + torch.cumsum(is_image.long(), dim=1) - 1
+
+        # Output length of every input token: 0 for padding, 1 for text, the feature length for images.
+        token_lens = attention_mask.long()
+        token_lens[is_image] = feature_lens[image_idx[is_image]]
+        token_starts = torch.cumsum(token_lens, dim=1) - token_lens
+        row_lens = token_lens.sum(dim=1)
 
         # Truncate sequences to max length as image embeddings can make the sequence longer
         tokenizer_model_max_length = getattr(self.config, 'tokenizer_model_max_length', None)
         if tokenizer_model_max_length is not None:
-            new_input_embeds = [x[:tokenizer_model_max_length] for x in new_input_embeds]
-            new_labels = [x[:tokenizer_model_max_length] for x in new_labels]
-
-        # Combine them
-        max_len = max(x.shape[0] for x in new_input_embeds)
-        batch_size = len(new_input_embeds)
-
-        new_input_embeds_padded = []
-        new_labels_padded = torch.full((batch_size, max_len), IGNORE_INDEX, dtype=new_labels[0].dtype, device=new_labels[0].device)
-        attention_mask = torch.zeros((batch_size, max_len), dtype=attention_mask.dtype, device=attention_mask.device)
-        position_ids = torch.zeros((batch_size, max_len), dtype=position_ids.dtype, device=position_ids.device)
-
-        for i, (cur_new_embed, cur_new_labels) in enumerate(zip(new_input_embeds, new_labels)):
-            cur_len = cur_new_embed.shape[0]
-            if getattr(self.config, 'tokenizer_padding_side', 'right') == "left":
-                new_input_embeds_padded.append(torch.cat((
-                    torch.zeros((max_len - cur_len, cur_new_embed.shape[1]), dtype=cur_new_embed.dtype, device=cur_new_embed.device),
-                    cur_new_embed
-                ), dim=0))
-                if cur_len > 0:
-                    new_labels_padded[i, -cur_len:] = cur_new_labels
-                    attention_mask[i, -cur_len:] = True
-                    position_ids[i, -cur_len:] = torch.arange(0, cur_len, dtype=position_ids.dtype, device=position_ids.device)
-            else:
-                new_input_embeds_padded.append(torch.cat((
-                    cur_new_embed,
-                    torch.zeros((max_len - cur_len, cur_new_embed.shape[1]), dtype=cur_new_embed.dtype, device=cur_new_embed.device)
-                ), dim=0))
-                if cur_len > 0:
-                    new_labels_padded[i, :cur_len] = cur_new_labels
-                    attention_mask[i, :cur_len] = True
-                    position_ids[i, :cur_len] = torch.arange(0, cur_len, dtype=position_ids.dtype, device=position_ids.device)
+            row_lens = row_lens.clamp(max=tokenizer_model_max_length)
+        max_len = int(row_lens.max())
 
-        new_input_embeds = torch.stack(new_input_embeds_padded, dim=0)
+        if getattr(self.config, 'tokenizer_padding_side', 'right') == "left":
+            row_offsets = max_len - row_lens
+        else:
+            row_offsets = torch.zeros_like(row_lens)
+
+        text_rows, text_cols = torch.nonzero(is_text, as_tuple=True)
+        text_embeds = embed_tokens(input_ids[text_rows, text_cols])
+        text_labels = labels[text_rows, text_cols]
+        text_dest = token_starts[text_rows, text_cols]
+
+        image_rows, image_cols = torch.nonzero(is_image, as_tuple=True)
+        used_images = image_idx[image_rows, image_cols]
+        used_lens = feature_lens[used_images]
+        # One entry per image feature vector, `within` is its position inside its image
+        image_dest = torch.repeat_interleave(token_starts[image_rows, image_cols], used_lens)
+        image_rows = torch.repeat_interleave(image_rows, used_lens)
+        within = torch.arange(image_rows.shape[0], dtype=torch.long, device=input_ids.device)
+        within = within - torch.repeat_interleave(torch.cumsum(used_lens, dim=0) - used_lens, used_lens)
+        image_dest = image_dest + within
+        image_src = torch.repeat_interleave(feature_offsets[used_images], used_lens) + within
+
+        new_input_embeds = torch.zeros(
+            (batch_size, max_len, text_embeds.shape[-1]),
+            dtype=torch.promote_types(text_embeds.dtype, flat_image_features.dtype),
+            device=self.device,
+        )
+        new_labels = torch.full((batch_size, max_len), IGNORE_INDEX, dtype=labels.dtype, device=labels.device)
+
+        keep = text_dest < row_lens[text_rows]
+        text_rows, text_dest = text_rows[keep], text_dest[keep] + row_offsets[text_rows[keep]]
+        new_input_embeds[text_rows, text_dest] = text_embeds[keep].to(new_input_embeds.device, new_input_embeds.dtype)
+        new_labels[text_rows, text_dest] = text_labels[keep]
+
+        keep = image_dest < row_lens[image_rows]
+        image_rows, image_dest = image_rows[keep], image_dest[keep] + row_offsets[image_rows[keep]]
+        new_input_embeds[image_rows, image_dest] = flat_image_features[image_src[keep].to(flat_image_features.device)].to(new_input_embeds.device, new_input_embeds.dtype)
+
+        position_ids = torch.arange(max_len, dtype=position_ids.dtype, device=position_ids.device)[None, :] - row_offsets[:, None]
+        attention_mask = (position_ids >= 0) & (position_ids < row_lens[:, None])
+        position_ids = position_ids.masked_fill(~attention_mask, 0)
 
         if _labels is None:
             new_labels = None
-        else:
-            new_labels = new_labels_padded
 
         if _attention_mask is None:
             attention_mask = None
@@ -45,6 +45,9 @@ class LoraConfig(PeftConfig):
         bias (`str`): Bias type for Lora. Can be 'none', 'all' or 'lora_only'
         modules_to_save (`List[str]`):List of modules apart from LoRA layers to be set as trainable
             and saved in the final checkpoint.
+        quant_bits (`int`): Weight-only quantization of the frozen base weight (8 or 4). Lora experts and router
+            stay in floating point.
+        quant_group_size (`int`): Number of input features sharing one quantization scale.
     """
 
     r: int = field(default=8, metadata={"help": "Lora attention dimension"})
@@ -68,6 +71,13 @@ class LoraConfig(PeftConfig):
         metadata={"help": "Set this to True if the layer to replace stores weight like (fan_in, fan_out)"},
     )
     enable_lora: Optional[List[bool]] = field(default=None, metadata={"help": "Used with `lora.MergedLinear`."})
+    quant_bits: Optional[int] = field(
+        default=None,
+        metadata={"help": "Store the frozen base weight of every Lora layer as int8 (8) or packed int4 (4)."},
+    )
+    quant_group_size: int = field(
+        default=128, metadata={"help": "Number of input features sharing one quantization scale."}
+    )
     bias: str = field(default="none", metadata={"help": "Bias type for Lora. Can be 'none', 'all' or 'lora_only'"})
     modules_to_save: Optional[List[str]] = field(
         default=None,
@@ -119,9 +129,9 @@ class LoraModel(torch.nn.Module):
         loaded_in_4bit = getattr(self.model, "is_loaded_in_4bit", False)
         loaded_in_8bit = getattr(self.model, "is_loaded_in_8bit", False)
         if (loaded_in_4bit or loaded_in_8bit):
-            raise ImportError(
-                "To use Lora with 8-bit or 4-bit quantization, please install the `bitsandbytes` package. "
-                "You can install it with `pip install bitsandbytes`."
+            raise ValueError(
+                "H-LoRA layers cannot wrap `bitsandbytes` quantized modules. Load the base model in floating point "
+                "and set `quant_bits=8` or `quant_bits=4` in `LoraConfig` to quantize the frozen base weights."
             )
         is_target_modules_in_base_model = False
         is_hf_device_map_available = hasattr(self.model, "hf_device_map")
@@ -152,6 +162,8 @@ class LoraModel(torch.nn.Module):
                     new_module = Linear(target.in_features, target.out_features, bias=bias, **kwargs)
 
                 self._replace_module(parent, target_name, new_module, target)
+                if self.peft_config.quant_bits is not None:
+                    new_module.quantize_weight(self.peft_config.quant_bits, self.peft_config.quant_group_size)
         if not is_target_modules_in_base_model:
             raise ValueError(
                 f"Target modules {self.peft_config.target_modules} not found in the base model. "
@@ -235,6 +247,73 @@ def mark_only_lora_as_trainable(model: nn.Module, bias: str = "none") -> None:
     else:
         raise NotImplementedError
 
+def quantize_weight(weight: torch.Tensor, bits: int = 8, group_size: int = 128):
+    """
+    Symmetric weight-only quantization of a `(out_features, in_features)` matrix. Returns the integer weight (int8,
+    or two int4 values packed into one uint8 along the input dimension) and one scale per `group_size` input features.
+    """
+    if bits not in (8, 4):
+        raise ValueError(f"Unsupported quant_bits: {bits}, expected 8 or 4.")
+    out_features, in_features = weight.shape
+    if bits == 4 and in_features % 2 != 0:
+        raise ValueError(f"4-bit quantization needs an even number of input features, got {in_features}.")
+    if group_size is None or group_size <= 0 or in_features % group_size != 0:
+        group_size = in_features
+    qmax = 2 ** (bits - 1) - 1
+    grouped = weight.float().reshape(out_features, in_features // group_size, group_size)
+    scale = grouped.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / qmax
+    qweight = torch.clamp(torch.round(grouped / scale), -qmax - 1, qmax).to(torch.int8)
+    qweight = qweight.reshape(out_features, in_features)
+    if bits == 4:
+        qweight = (qweight + 8).to(torch.uint8)
+        qweight = qweight[:, 0::2] | (qweight[:, 1::2] << 4)
+    return qweight, scale.squeeze(-1)
+
+
+def dequantize_weight(qweight: torch.Tensor, scale: torch.Tensor, bits: int, dtype: Optional[torch.dtype] = None):
+    """Inverse of `quantize_weight`."""
+    if bits == 4:
+        low = (qweight & 0x0F).to(torch.int8) - 8
+        high = (qweight >> 4).to(torch.int8) - 8
+        qweight = torch.stack((low, high), dim=-1).reshape(qweight.shape[0], -1)
+    out_features, in_features = qweight.shape
+    groups = scale.shape[-1]
+    weight = qweight.reshape(out_features, groups, in_features // groups).to(scale.dtype) * scale.unsqueeze(-1)
+    weight = weight.reshape(out_features, in_features)
+    return weight if dtype is None else weight.to(dtype)
+
+
+def quantized_linear(x: torch.Tensor, qweight: torch.Tensor, scale: torch.Tensor, bits: int,
+                     bias: Optional[torch.Tensor] = None, block_features: int = 1024):
+    """
+    `F.linear(x, dequantize_weight(qweight, scale, bits), bias)` without the dequantized weight: only
+    `block_features` input features (whole groups) are dequantized at a time and their products accumulated.
+    """
+    out_features = qweight.shape[0]
+    in_features = x.shape[-1]
+    group_size = in_features // scale.shape[-1]
+    step = max(block_features // group_size, 1) * group_size
+    if bits == 4 and step % 2 != 0:
+        step *= 2
+    result = None
+    for start in range(0, in_features, step):
+        end = min(start + step, in_features)
+        if bits == 4:
+            packed = qweight[:, start // 2:end // 2]
+            low = (packed & 0x0F).to(torch.int8) - 8
+            high = (packed >> 4).to(torch.int8) - 8
+            block = torch.stack((low, high), dim=-1).reshape(out_features, end - start)
+        else:
+            block = qweight[:, start:end]
+        groups = scale[:, start // group_size:end // group_size]
+        weight = block.reshape(out_features, groups.shape[-1], group_size).to(scale.dtype) * groups.unsqueeze(-1)
+        partial = F.linear(x[..., start:end], weight.reshape(out_features, end - start).to(x.dtype))
+        result = partial if result is None else result.add_(partial)
+    if bias is not None:
+        result = result + bias
+    return result
+
+
 class LoraLayer:
     def __init__(
         self,
@@ -282,6 +361,8 @@ class Linear(nn.Linear, LoraLayer):
         self.scaling = self.lora_alpha / self.r * self.lora_num
         # Freezing the pre-trained weight matrix
         self.weight.requires_grad = False
+        # Set by `quantize_weight`, the base weight then lives in `weight_q` / `weight_scale`
+        self.quant_bits = None
         self.reset_parameters()
 
     def reset_parameters(self):
@@ -292,6 +373,13 @@ class Linear(nn.Linear, LoraLayer):
             nn.init.zeros_(getattr(self, f"lora_B").weight)
             nn.init.kaiming_uniform_(self.lora_route.weight, a=math.sqrt(5))
 
+    def quantize_weight(self, bits: int = 8, group_size: int = 128):
+        qweight, scale = quantize_weight(self.weight.data, bits, group_size)
+        self.register_buffer("weight_q", qweight)
+        self.register_buffer("weight_scale", scale.to(self.weight.dtype))
+        self.register_parameter("weight", None)
+        self.quant_bits = bits
+
     def train(self, mode: bool = True):
         nn.Linear.train(self, mode)
         self.lora_route.train(mode)
@@ -306,7 +394,10 @@ class Linear(nn.Linear, LoraLayer):
         getattr(self, f"lora_B").eval()     
 
     def forward(self, x: torch.Tensor):
-        result = F.linear(x, self.weight, bias=self.bias)
+        if self.quant_bits is not None:
+            result = quantized_linear(x, self.weight_q, self.weight_scale, self.quant_bits, bias=self.bias)
+        else:
+            result = F.linear(x, self.weight, bias=self.bias)
         route_weight = nn.functional.softmax(self.lora_route(x), dim=-1).to(result.dtype)
         output_A = getattr(self, "lora_A")(x) * self.scaling
         router_expand = route_weight.repeat_interleave(self.times, dim=-1)
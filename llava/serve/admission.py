@@ -0,0 +1,146 @@
+"""
+Admission control for model workers.
+
+Requests run in at most `limit_model_concurrency` slots. A request may carry
+a `deadline` (unix time) or a `timeout` (seconds from arrival). It is turned
+away at arrival if the queue is full (503) or if the queue time estimated
+from the worker's measured speed already misses the deadline (429), and it
+expires if the deadline passes while it waits. Rejections carry a retry-after
+estimate.
+"""
+import asyncio
+import math
+import threading
+import time
+
+
+class RequestRejected(Exception):
+    def __init__(self, status_code, reason, retry_after):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController(object):
+    def __init__(self, limit_model_concurrency, max_queue_length=None,
+                 speed_meter=None, default_timeout=None):
+        self.limit_model_concurrency = limit_model_concurrency
+        self.max_queue_length = max_queue_length
+        self.speed_meter = speed_meter
+        self.default_timeout = default_timeout
+        # Created on first use so that it binds to the server's event loop
+        self.semaphore = None
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self.expired = 0
+        self.lock = threading.Lock()
+
+    def queue_length(self):
+        return self.running + self.waiting
+
+    def request_time(self):
+        """Expected seconds to first token and to serve one average request, None if not measured yet."""
+        if self.speed_meter is None:
+            return None, None
+        status = self.speed_meter.status()
+        ttft = status["ttft"] or 0.0
+        if not status["tokens_per_second"] or status["avg_new_tokens"] is None:
+            return ttft, None
+        return ttft, ttft + status["avg_new_tokens"] / status["tokens_per_second"]
+
+    def estimate_wait(self):
+        """Expected seconds until a new request gets a slot, None if unknown."""
+        if self.running + self.waiting < self.limit_model_concurrency:
+            return 0.0
+        _, request_time = self.request_time()
+        if request_time is None:
+            return None
+        # Waiting requests start in waves of `limit_model_concurrency` as running ones finish
+        return (self.waiting // self.limit_model_concurrency + 1) * request_time
+
+    def retry_after(self, wait):
+        return max(1, math.ceil(wait)) if wait else 1
+
+    def get_deadline(self, params, now):
+        deadlines = []
+        if params.get("deadline") is not None:
+            deadlines.append(float(params["deadline"]))
+        timeout = params.get("timeout", self.default_timeout)
+        if timeout is not None:
+            deadlines.append(now + float(timeout))
+        return min(deadlines) if deadlines else None
+
+    async def acquire(self, params):
+        """Wait for a slot. Returns the request deadline (or None), raises RequestRejected."""
+        now = time.time()
+        deadline = self.get_deadline(params, now)
+        wait = self.estimate_wait()
+        if self.max_queue_length is not None and self.waiting >= self.max_queue_length:
+            self.mark_shed()
+            raise RequestRejected(503, "Worker queue is full.", self.retry_after(wait))
+        if deadline is not None and wait is not None:
+            ttft, _ = self.request_time()
+            if now + wait + ttft > deadline:
+                self.mark_shed()
+                raise RequestRejected(429, "Request deadline cannot be met.", self.retry_after(wait))
+
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.limit_model_concurrency)
+        if not self.semaphore.locked():
+            # A free slot is taken without suspending
+            await self.semaphore.acquire()
+        else:
+            # asyncio.wait, unlike wait_for, leaves the acquire running on timeout, so a slot granted
+            # at the same moment is seen and handed back instead of leaking
+            acquire = asyncio.ensure_future(self.semaphore.acquire())
+            self.waiting += 1
+            try:
+                await asyncio.wait({acquire}, timeout=None if deadline is None else max(deadline - now, 0))
+            except asyncio.CancelledError:
+                # The client went away while queued
+                self.abandon(acquire)
+                raise
+            finally:
+                self.waiting -= 1
+            if not acquire.done():
+                self.abandon(acquire)
+                self.mark_expired()
+                raise RequestRejected(503, "Request deadline passed while queued.",
+                                      self.retry_after(self.estimate_wait()))
+        self.running += 1
+        with self.lock:
+            self.admitted += 1
+        return deadline
+
+    def abandon(self, acquire):
+        """Give up a pending `semaphore.acquire()` task, releasing the slot if it already got one."""
+        if acquire.done() and not acquire.cancelled():
+            self.semaphore.release()
+        else:
+            acquire.cancel()
+
+    def release(self):
+        self.running -= 1
+        self.semaphore.release()
+
+    def mark_shed(self):
+        with self.lock:
+            self.shed += 1
+
+    def mark_expired(self):
+        with self.lock:
+            self.expired += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "running": self.running,
+                "waiting": self.waiting,
+                "admitted": self.admitted,
+                "shed": self.shed,
+                "expired": self.expired,
+                "estimated_wait": self.estimate_wait(),
+            }
@@ -0,0 +1,252 @@
+"""
+Continuous batching for the model worker.
+
+Requests are queued and a single thread decodes all of them together, one
+token per step for the whole batch. New requests are prefilled and joined to
+the running batch between decode steps, finished ones leave it, and every
+token is pushed to the streamer of its request.
+"""
+import queue
+import threading
+import time
+
+import torch
+import torch.nn.functional as F
+
+from llava.mm_utils import legacy_cache
+from llava.utils import build_logger
+
+
+logger = build_logger("batch_generator", "batch_generator.log")
+
+
+class GenerationRequest(object):
+    def __init__(self, input_ids, images, image_sizes, temperature, top_p,
+                 max_new_tokens, streamer, deadline=None, cancel_event=None):
+        self.input_ids = input_ids
+        self.images = images
+        self.image_sizes = image_sizes
+        self.temperature = temperature
+        self.top_p = top_p
+        self.max_new_tokens = max_new_tokens
+        self.streamer = streamer
+        self.deadline = deadline
+        self.cancel_event = cancel_event
+        self.num_new_tokens = 0
+        self.error = None
+        # Set when the deadline passed before the answer was finished
+        self.expired = False
+
+
+def sample_next_tokens(logits, temperature, top_p):
+    """Greedy for rows with temperature ~0, otherwise temperature and top-p sampling per row."""
+    greedy = logits.argmax(dim=-1)
+    do_sample = temperature > 0.001
+    if not do_sample.any():
+        return greedy
+    logits = logits.float() / temperature.clamp(min=0.001)[:, None]
+    sorted_logits, sorted_indices = logits.sort(dim=-1, descending=True)
+    probs = sorted_logits.softmax(dim=-1)
+    # Keep the smallest prefix whose probability reaches top_p, and always the most likely token
+    remove = probs.cumsum(dim=-1) - probs > top_p[:, None]
+    sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+    sampled = sorted_indices.gather(-1, torch.multinomial(sorted_logits.softmax(dim=-1), 1)).squeeze(-1)
+    return torch.where(do_sample, sampled, greedy)
+
+
+class ActiveBatch(object):
+    """Decode state of the running rows; caches are left padded to a common length."""
+
+    def __init__(self, requests, attention_mask, past_key_values, next_tokens, positions):
+        self.requests = requests
+        self.attention_mask = attention_mask
+        self.past_key_values = past_key_values
+        self.next_tokens = next_tokens
+        self.positions = positions
+
+    def merge(self, other):
+        length = max(self.attention_mask.shape[1], other.attention_mask.shape[1])
+
+        def left_pad(batch):
+            pad = length - batch.attention_mask.shape[1]
+            mask = F.pad(batch.attention_mask, (pad, 0))
+            past = [tuple(F.pad(x, (0, 0, pad, 0)) for x in layer) for layer in batch.past_key_values]
+            return mask, past
+
+        mask_a, past_a = left_pad(self)
+        mask_b, past_b = left_pad(other)
+        self.requests = self.requests + other.requests
+        self.attention_mask = torch.cat([mask_a, mask_b], dim=0)
+        self.past_key_values = tuple(
+            tuple(torch.cat([x, y], dim=0) for x, y in zip(layer_a, layer_b))
+            for layer_a, layer_b in zip(past_a, past_b))
+        self.next_tokens = torch.cat([self.next_tokens, other.next_tokens], dim=0)
+        self.positions = torch.cat([self.positions, other.positions], dim=0)
+
+    def keep(self, rows):
+        index = torch.tensor(rows, dtype=torch.long, device=self.next_tokens.device)
+        self.requests = [self.requests[i] for i in rows]
+        mask = self.attention_mask.index_select(0, index)
+        # Drop columns that only the removed rows used
+        start = int((mask.sum(dim=0) > 0).nonzero()[0])
+        self.attention_mask = mask[:, start:]
+        self.past_key_values = tuple(
+            tuple(x.index_select(0, index)[:, :, start:] for x in layer)
+            for layer in self.past_key_values)
+        self.next_tokens = self.next_tokens.index_select(0, index)
+        self.positions = self.positions.index_select(0, index)
+
+
+class BatchGenerator(object):
+    def __init__(self, model, tokenizer, max_batch_size=8, max_wait=0.01):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        # Batched prompts are left padded so that all rows end at the last column
+        model.config.tokenizer_padding_side = "left"
+
+        self.pending = queue.Queue()
+        self.batch = None
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        self.pending.put(request)
+
+    def num_running(self):
+        batch = self.batch
+        return len(batch.requests) if batch is not None else 0
+
+    def take_pending(self):
+        free = self.max_batch_size - self.num_running()
+        requests = []
+        if self.batch is None:
+            # Idle: wait for a request, then up to `max_wait` for more to share its prefill
+            requests.append(self.pending.get())
+            deadline = time.time() + self.max_wait
+            while len(requests) < free:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(self.pending.get(timeout=timeout))
+                except queue.Empty:
+                    break
+        while len(requests) < free:
+            try:
+                requests.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        return requests
+
+    def loop(self):
+        while True:
+            new_requests = self.take_pending()
+            # Rows without images cannot share a multimodal prefill with rows that have images
+            groups = [[r for r in new_requests if r.images is None],
+                      [r for r in new_requests if r.images is not None]]
+            for group in groups:
+                if not group:
+                    continue
+                try:
+                    self.join(self.prefill(group))
+                except Exception as e:
+                    logger.error(f"prefill error: {e}")
+                    self.fail(group, e)
+
+            if self.batch is None:
+                continue
+            try:
+                self.decode_step()
+            except Exception as e:
+                logger.error(f"decode error: {e}")
+                self.fail(self.batch.requests, e)
+                self.batch = None
+
+    def fail(self, requests, error):
+        for request in requests:
+            request.error = error
+            request.streamer.end()
+
+    def join(self, batch):
+        batch = self.emit(batch)
+        if batch is None:
+            return
+        if self.batch is None:
+            self.batch = batch
+        else:
+            self.batch.merge(batch)
+
+    @torch.inference_mode()
+    def prefill(self, requests):
+        model = self.model
+        device = model.device
+        max_len = max(len(r.input_ids) for r in requests)
+        input_ids = torch.full((len(requests), max_len), self.pad_token_id, dtype=torch.long, device=device)
+        attention_mask = torch.zeros((len(requests), max_len), dtype=torch.long, device=device)
+        for i, request in enumerate(requests):
+            input_ids[i, max_len - len(request.input_ids):] = request.input_ids.to(device)
+            attention_mask[i, max_len - len(request.input_ids):] = 1
+
+        if requests[0].images is not None:
+            images = [image for r in requests for image in r.images]
+            image_sizes = [image_size for r in requests for image_size in r.image_sizes]
+            if all(x.shape == images[0].shape for x in images):
+                images = torch.stack(images, dim=0)
+            _, _, attention_mask, _, inputs_embeds, _ = model.prepare_inputs_labels_for_multimodal(
+                input_ids, None, attention_mask, None, None, images, image_sizes=image_sizes)
+        else:
+            inputs_embeds = model.get_model().embed_tokens(input_ids)
+
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+        outputs = model(inputs_embeds=inputs_embeds, attention_mask=attention_mask,
+                        position_ids=position_ids, use_cache=True)
+        next_tokens = self.sample(requests, outputs.logits[:, -1])
+        return ActiveBatch(requests, attention_mask, legacy_cache(outputs.past_key_values),
+                           next_tokens, attention_mask.sum(dim=-1))
+
+    @torch.inference_mode()
+    def decode_step(self):
+        batch = self.batch
+        batch.attention_mask = F.pad(batch.attention_mask, (0, 1), value=1)
+        outputs = self.model(input_ids=batch.next_tokens[:, None], attention_mask=batch.attention_mask,
+                             position_ids=batch.positions[:, None], past_key_values=batch.past_key_values,
+                             use_cache=True)
+        batch.past_key_values = legacy_cache(outputs.past_key_values)
+        batch.positions = batch.positions + 1
+        batch.next_tokens = self.sample(batch.requests, outputs.logits[:, -1])
+        self.batch = self.emit(batch)
+
+    def sample(self, requests, logits):
+        temperature = torch.tensor([r.temperature for r in requests], device=logits.device)
+        top_p = torch.tensor([r.top_p for r in requests], device=logits.device)
+        return sample_next_tokens(logits, temperature, top_p)
+
+    def emit(self, batch):
+        """Stream the sampled tokens; returns the batch without finished rows, or None."""
+        keep = []
+        now = time.time()
+        for i, (request, token) in enumerate(zip(batch.requests, batch.next_tokens.tolist())):
+            if token == self.tokenizer.eos_token_id:
+                request.streamer.end()
+                continue
+            if request.deadline is not None and now >= request.deadline:
+                request.expired = True
+                request.streamer.end()
+                continue
+            if request.cancel_event is not None and request.cancel_event.is_set():
+                request.streamer.end()
+                continue
+            request.streamer.put(torch.tensor([token]))
+            request.num_new_tokens += 1
+            if request.num_new_tokens >= request.max_new_tokens:
+                request.streamer.end()
+                continue
+            keep.append(i)
+        if not keep:
+            return None
+        if len(keep) < len(batch.requests):
+            batch.keep(keep)
+        return batch
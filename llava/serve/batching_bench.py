@@ -0,0 +1,114 @@
+"""
+Measure worker throughput as the number of concurrent requests grows.
+
+Run it once against a worker started with `--max-batch-size 1` and once with
+batching enabled, e.g. `--max-batch-size 16 --limit-model-concurrency 16`, to
+compare the throughput vs concurrency curves. Tokens are counted as streamed
+delta frames, one per decoded token up to detokenization merges.
+
+Usage:
+python3 -m llava.serve.batching_bench --worker-address http://localhost:21002 --concurrency 1 2 4 8 16
+"""
+import argparse
+import asyncio
+import base64
+from io import BytesIO
+import json
+import time
+
+import httpx
+from PIL import Image
+
+from llava.constants import DEFAULT_IMAGE_TOKEN
+
+
+def encode_image(path):
+    image = Image.open(path).convert("RGB")
+    buffered = BytesIO()
+    image.save(buffered, format="PNG")
+    return base64.b64encode(buffered.getvalue()).decode()
+
+
+async def one_request(client, url, params):
+    start = time.perf_counter()
+    first_token, tokens = None, 0
+    async with client.stream("POST", url, json=params) as response:
+        buffer = b""
+        async for data in response.aiter_raw():
+            *chunks, buffer = (buffer + data).split(b"\0")
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                frame = json.loads(chunk.decode())
+                if frame["error_code"] != 0:
+                    raise RuntimeError(f"worker error: {frame}")
+                if "delta" in frame:
+                    tokens += 1
+                    if first_token is None:
+                        first_token = time.perf_counter()
+    end = time.perf_counter()
+    return end - start, (first_token or end) - start, tokens
+
+
+async def run_level(url, params, concurrency, num_requests):
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=600) as client:
+        async def bounded():
+            async with semaphore:
+                return await one_request(client, url, params)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*[bounded() for _ in range(num_requests)])
+        elapsed = time.perf_counter() - start
+
+    latencies = sorted(r[0] for r in results)
+    ttfts = sorted(r[1] for r in results)
+    tokens = sum(r[2] for r in results)
+    return {
+        "concurrency": concurrency,
+        "requests": num_requests,
+        "requests_per_s": round(num_requests / elapsed, 3),
+        "tokens_per_s": round(tokens / elapsed, 1),
+        "mean_latency_s": round(sum(latencies) / len(latencies), 3),
+        "p95_latency_s": round(latencies[int(0.95 * (len(latencies) - 1))], 3),
+        "mean_ttft_s": round(sum(ttfts) / len(ttfts), 3),
+    }
+
+
+async def main(args):
+    url = args.worker_address + "/worker_generate_stream"
+    status = httpx.post(args.worker_address + "/worker_get_status", timeout=10).json()
+    prompt = f"USER: {args.question} ASSISTANT:"
+    params = {
+        "model": status["model_names"][0],
+        "prompt": prompt,
+        "temperature": args.temperature,
+        "top_p": 1.0,
+        "max_new_tokens": args.max_new_tokens,
+        "stop": "</s>",
+        "stream_delta": True,
+    }
+    if args.image_file:
+        params["prompt"] = f"USER: {DEFAULT_IMAGE_TOKEN}\n{args.question} ASSISTANT:"
+        params["images"] = [encode_image(args.image_file)]
+
+    for concurrency in args.concurrency:
+        num_requests = max(args.requests_per_level, concurrency * args.rounds)
+        print(json.dumps(await run_level(url, params, concurrency, num_requests)), flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--worker-address", type=str, default="http://localhost:21002")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--requests-per-level", type=int, default=16)
+    parser.add_argument("--rounds", type=int, default=2,
+        help="Send at least this many requests per concurrent client.")
+    parser.add_argument("--question", type=str, default="Describe the image in detail.")
+    parser.add_argument("--image-file", type=str, default=None)
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -6,16 +6,17 @@ import argparse
 import asyncio
 import dataclasses
 from enum import Enum, auto
+import hashlib
 import json
 import logging
 import time
-from typing import List, Union
+from typing import List, Optional, Union
 import threading
 
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
+import httpx
 import numpy as np
-import requests
 import uvicorn
 
 from llava.constants import CONTROLLER_HEART_BEAT_EXPIRATION
@@ -28,6 +29,7 @@ logger = build_logger("controller", "controller.log")
 class DispatchMethod(Enum):
     LOTTERY = auto()
     SHORTEST_QUEUE = auto()
+    LEAST_EXPECTED_LATENCY = auto()
 
     @classmethod
     def from_str(cls, name):
@@ -35,6 +37,8 @@ class DispatchMethod(Enum):
             return cls.LOTTERY
         elif name == "shortest_queue":
             return cls.SHORTEST_QUEUE
+        elif name == "least_expected_latency":
+            return cls.LEAST_EXPECTED_LATENCY
         else:
             raise ValueError(f"Invalid dispatch method")
 
@@ -46,6 +50,26 @@ class WorkerInfo:
     queue_length: int
     check_heart_beat: bool
     last_heart_beat: str
+    # Measured by the worker, None until it finished a request
+    ttft: Optional[float] = None
+    tokens_per_second: Optional[float] = None
+    avg_new_tokens: Optional[float] = None
+    # Reported by workers with an image cache, see `llava.serve.image_cache`
+    max_concurrency: Optional[int] = None
+    cached_images: frozenset = frozenset()
+
+    def update_status(self, worker_status: dict):
+        self.ttft = worker_status.get("ttft")
+        self.tokens_per_second = worker_status.get("tokens_per_second")
+        self.avg_new_tokens = worker_status.get("avg_new_tokens")
+        self.max_concurrency = worker_status.get("max_concurrency")
+        self.cached_images = frozenset(worker_status.get("cached_images", ()))
+
+    def request_time(self):
+        """Expected seconds to serve one average request, None if not measured yet."""
+        if not self.tokens_per_second or self.avg_new_tokens is None:
+            return None
+        return (self.ttft or 0.0) + self.avg_new_tokens / self.tokens_per_second
 
 
 def heart_beat_controller(controller):
@@ -54,11 +78,23 @@ def heart_beat_controller(controller):
         controller.remove_stable_workers_by_expiration()
 
 
+def affinity_score(affinity_key: str, worker_name: str):
+    return hashlib.md5(f"{affinity_key}/{worker_name}".encode()).digest()
+
+
 class Controller:
-    def __init__(self, dispatch_method: str):
+    def __init__(self, dispatch_method: str, max_connections: int = 1024,
+                 affinity_max_queue: int = 4):
         # Dict[str -> WorkerInfo]
         self.worker_info = {}
         self.dispatch_method = DispatchMethod.from_str(dispatch_method)
+        # Queue length at which a worker without a reported concurrency limit counts as saturated
+        self.affinity_max_queue = affinity_max_queue
+        # A single pooled client keeps connections to workers alive across requests
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(5.0))
 
         self.heart_beat_thread = threading.Thread(
             target=heart_beat_controller, args=(self,), daemon=True)
@@ -66,29 +102,30 @@ class Controller:
 
         logger.info("Init controller")
 
-    def register_worker(self, worker_name: str, check_heart_beat: bool,
-                        worker_status: dict):
+    async def register_worker(self, worker_name: str, check_heart_beat: bool,
+                              worker_status: dict):
         if worker_name not in self.worker_info:
             logger.info(f"Register a new worker: {worker_name}")
         else:
             logger.info(f"Register an existing worker: {worker_name}")
 
         if not worker_status:
-            worker_status = self.get_worker_status(worker_name)
+            worker_status = await self.get_worker_status(worker_name)
         if not worker_status:
             return False
 
         self.worker_info[worker_name] = WorkerInfo(
             worker_status["model_names"], worker_status["speed"], worker_status["queue_length"],
             check_heart_beat, time.time())
+        self.worker_info[worker_name].update_status(worker_status)
 
         logger.info(f"Register done: {worker_name}, {worker_status}")
         return True
 
-    def get_worker_status(self, worker_name: str):
+    async def get_worker_status(self, worker_name: str):
         try:
-            r = requests.post(worker_name + "/worker_get_status", timeout=5)
-        except requests.exceptions.RequestException as e:
+            r = await self.client.post(worker_name + "/worker_get_status", timeout=5)
+        except httpx.HTTPError as e:
             logger.error(f"Get status fails: {worker_name}, {e}")
             return None
 
@@ -101,12 +138,15 @@ class Controller:
     def remove_worker(self, worker_name: str):
         del self.worker_info[worker_name]
 
-    def refresh_all_workers(self):
+    async def refresh_all_workers(self):
         old_info = dict(self.worker_info)
         self.worker_info = {}
 
-        for w_name, w_info in old_info.items():
-            if not self.register_worker(w_name, w_info.check_heart_beat, None):
+        registered = await asyncio.gather(*[
+            self.register_worker(w_name, w_info.check_heart_beat, None)
+            for w_name, w_info in old_info.items()])
+        for w_name, ok in zip(old_info, registered):
+            if not ok:
                 logger.info(f"Remove stale worker: {w_name}")
 
     def list_models(self):
@@ -117,7 +157,52 @@ class Controller:
 
         return list(model_names)
 
-    def get_worker_address(self, model_name: str):
+    def get_affinity_worker(self, model_name: str, affinity_key: str):
+        """
+        Route requests about the same image or session to the same worker, so
+        its image cache is reused. Workers that report the image as cached are
+        preferred; otherwise the worker is picked by rendezvous (consistent)
+        hashing, which only remaps the keys of workers that join or leave.
+        Returns "" if the preferred worker is saturated.
+        """
+        worker_names = [w_name for w_name, w_info in self.worker_info.items()
+                        if model_name in w_info.model_names]
+        if len(worker_names) == 0:
+            return ""
+        cached = [w_name for w_name in worker_names
+                  if affinity_key in self.worker_info[w_name].cached_images]
+        w_name = max(cached or worker_names, key=lambda w: affinity_score(affinity_key, w))
+        w_info = self.worker_info[w_name]
+        max_queue = w_info.max_concurrency or self.affinity_max_queue
+        if w_info.queue_length >= max_queue:
+            logger.info(f"affinity worker saturated: {w_name}, queue_length: {w_info.queue_length}")
+            return ""
+        w_info.queue_length += 1
+        logger.info(f"affinity_key: {affinity_key}, cached: {cached}, ret: {w_name}")
+        return w_name
+
+    def get_least_loaded_worker(self, model_name: str):
+        worker_names = []
+        worker_qlen = []
+        for w_name, w_info in self.worker_info.items():
+            if model_name in w_info.model_names:
+                worker_names.append(w_name)
+                worker_qlen.append(w_info.queue_length / w_info.speed)
+        if len(worker_names) == 0:
+            return ""
+        min_index = np.argmin(worker_qlen)
+        w_name = worker_names[min_index]
+        self.worker_info[w_name].queue_length += 1
+        logger.info(f"names: {worker_names}, queue_lens: {worker_qlen}, ret: {w_name}")
+        return w_name
+
+    async def get_worker_address(self, model_name: str, affinity_key: Optional[str] = None):
+        if affinity_key:
+            w_name = self.get_affinity_worker(model_name, affinity_key)
+            if w_name:
+                return w_name
+            return self.get_least_loaded_worker(model_name)
+
         if self.dispatch_method == DispatchMethod.LOTTERY:
             worker_names = []
             worker_speeds = []
@@ -142,7 +227,7 @@ class Controller:
                     p=worker_speeds)
                 worker_name = worker_names[pt]
 
-                if self.get_worker_status(worker_name):
+                if await self.get_worker_status(worker_name):
                     break
                 else:
                     self.remove_worker(worker_name)
@@ -154,28 +239,40 @@ class Controller:
                     continue
             return worker_name
         elif self.dispatch_method == DispatchMethod.SHORTEST_QUEUE:
-            worker_names = []
-            worker_qlen = []
-            for w_name, w_info in self.worker_info.items():
-                if model_name in w_info.model_names:
-                    worker_names.append(w_name)
-                    worker_qlen.append(w_info.queue_length / w_info.speed)
+            return self.get_least_loaded_worker(model_name)
+        elif self.dispatch_method == DispatchMethod.LEAST_EXPECTED_LATENCY:
+            worker_names = [w_name for w_name, w_info in self.worker_info.items()
+                            if model_name in w_info.model_names]
             if len(worker_names) == 0:
                 return ""
-            min_index = np.argmin(worker_qlen)
+            # Workers without measurements are assumed to be as fast as the median measured one
+            measured = sorted(t for t in (self.worker_info[w].request_time() for w in worker_names) if t is not None)
+            default_time = measured[len(measured) // 2] if measured else 1.0
+            expected = []
+            for w_name in worker_names:
+                w_info = self.worker_info[w_name]
+                request_time = w_info.request_time()
+                if request_time is None:
+                    request_time = default_time
+                # Queued requests are assumed to run one after another
+                expected.append((w_info.queue_length + 1) * request_time)
+            min_index = int(np.argmin(expected))
             w_name = worker_names[min_index]
             self.worker_info[w_name].queue_length += 1
-            logger.info(f"names: {worker_names}, queue_lens: {worker_qlen}, ret: {w_name}")
+            logger.info(f"names: {worker_names}, expected: {expected}, ret: {w_name}")
             return w_name
         else:
             raise ValueError(f"Invalid dispatch method: {self.dispatch_method}")
 
-    def receive_heart_beat(self, worker_name: str, queue_length: int):
+    def receive_heart_beat(self, worker_name: str, queue_length: int,
+                           worker_status: Optional[dict] = None):
         if worker_name not in self.worker_info:
             logger.info(f"Receive unknown heart beat. {worker_name}")
             return False
 
         self.worker_info[worker_name].queue_length = queue_length
+        if worker_status:
+            self.worker_info[worker_name].update_status(worker_status)
         self.worker_info[worker_name].last_heart_beat = time.time()
         logger.info(f"Receive heart beat. {worker_name}")
         return True
@@ -190,8 +287,11 @@ class Controller:
         for worker_name in to_delete:
             self.remove_worker(worker_name)
 
-    def worker_api_generate_stream(self, params):
-        worker_addr = self.get_worker_address(params["model"])
+    async def worker_api_generate_stream(self, params):
+        affinity_key = params.get("affinity_key")
+        if affinity_key is None and params.get("image_hashes"):
+            affinity_key = params["image_hashes"][0]
+        worker_addr = await self.get_worker_address(params["model"], affinity_key)
         if not worker_addr:
             logger.info(f"no worker: {params['model']}")
             ret = {
@@ -199,14 +299,26 @@ class Controller:
                 "error_code": 2,
             }
             yield json.dumps(ret).encode() + b"\0"
+            return
 
         try:
-            response = requests.post(worker_addr + "/worker_generate_stream",
-                json=params, stream=True, timeout=5)
-            for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-                if chunk:
-                    yield chunk + b"\0"
-        except requests.exceptions.RequestException as e:
+            async with self.client.stream("POST", worker_addr + "/worker_generate_stream",
+                                          json=params) as response:
+                if response.status_code != 200:
+                    # Rejected by admission control: a single JSON error frame with retry_after
+                    body = await response.aread()
+                    logger.info(f"worker rejected request: {worker_addr}, {response.status_code}")
+                    yield body.rstrip(b"\0") + b"\0"
+                    return
+                buffer = b""
+                async for data in response.aiter_raw():
+                    *chunks, buffer = (buffer + data).split(b"\0")
+                    for chunk in chunks:
+                        if chunk:
+                            yield chunk + b"\0"
+                if buffer:
+                    yield buffer + b"\0"
+        except httpx.HTTPError as e:
             logger.info(f"worker timeout: {worker_addr}")
             ret = {
                 "text": server_error_msg,
@@ -217,13 +329,14 @@ class Controller:
 
     # Let the controller act as a worker to achieve hierarchical
     # management. This can be used to connect isolated sub networks.
-    def worker_api_get_status(self):
+    async def worker_api_get_status(self):
         model_names = set()
         speed = 0
         queue_length = 0
 
-        for w_name in self.worker_info:
-            worker_status = self.get_worker_status(w_name)
+        all_status = await asyncio.gather(*[
+            self.get_worker_status(w_name) for w_name in list(self.worker_info)])
+        for worker_status in all_status:
             if worker_status is not None:
                 model_names.update(worker_status["model_names"])
                 speed += worker_status["speed"]
@@ -242,14 +355,14 @@ app = FastAPI()
 @app.post("/register_worker")
 async def register_worker(request: Request):
     data = await request.json()
-    controller.register_worker(
+    await controller.register_worker(
         data["worker_name"], data["check_heart_beat"],
         data.get("worker_status", None))
 
 
 @app.post("/refresh_all_workers")
 async def refresh_all_workers():
-    models = controller.refresh_all_workers()
+    models = await controller.refresh_all_workers()
 
 
 @app.post("/list_models")
@@ -261,7 +374,7 @@ async def list_models():
 @app.post("/get_worker_address")
 async def get_worker_address(request: Request):
     data = await request.json()
-    addr = controller.get_worker_address(data["model"])
+    addr = await controller.get_worker_address(data["model"], data.get("affinity_key"))
     return {"address": addr}
 
 
@@ -269,7 +382,7 @@ async def get_worker_address(request: Request):
 async def receive_heart_beat(request: Request):
     data = await request.json()
     exist = controller.receive_heart_beat(
-        data["worker_name"], data["queue_length"])
+        data["worker_name"], data["queue_length"], data.get("worker_status"))
     return {"exist": exist}
 
 
@@ -282,7 +395,12 @@ async def worker_api_generate_stream(request: Request):
 
 @app.post("/worker_get_status")
 async def worker_api_get_status(request: Request):
-    return controller.worker_api_get_status()
+    return await controller.worker_api_get_status()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await controller.client.aclose()
 
 
 if __name__ == "__main__":
@@ -290,9 +408,13 @@ if __name__ == "__main__":
     parser.add_argument("--host", type=str, default="localhost")
     parser.add_argument("--port", type=int, default=21001)
     parser.add_argument("--dispatch-method", type=str, choices=[
-        "lottery", "shortest_queue"], default="shortest_queue")
+        "lottery", "shortest_queue", "least_expected_latency"], default="shortest_queue")
+    parser.add_argument("--max-connections", type=int, default=1024)
+    parser.add_argument("--affinity-max-queue", type=int, default=4,
+        help="Queue length at which image-affinity routing falls back to the least loaded worker, "
+             "for workers that do not report their concurrency limit.")
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
-    controller = Controller(args.dispatch_method)
+    controller = Controller(args.dispatch_method, args.max_connections, args.affinity_max_queue)
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
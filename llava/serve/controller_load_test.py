@@ -0,0 +1,142 @@
+"""
+Measure the per-request overhead of the controller as the number of workers grows.
+
+Fake workers stream a fixed number of chunks. For every worker count, the same
+load is sent once directly to a worker and once through the controller; the
+difference in mean latency is the controller overhead.
+
+Usage:
+python3 -m llava.serve.controller_load_test --worker-counts 1 2 4 8 16 --num-requests 200 --concurrency 32
+"""
+import argparse
+import asyncio
+import json
+import socket
+import threading
+import time
+
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+import httpx
+import uvicorn
+
+from llava.serve import controller as controller_module
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def make_fake_worker(model_name, num_chunks, chunk_delay):
+    app = FastAPI()
+
+    @app.post("/worker_get_status")
+    async def worker_get_status():
+        return {"model_names": [model_name], "speed": 1, "queue_length": 0}
+
+    @app.post("/worker_generate_stream")
+    async def worker_generate_stream():
+        async def generate():
+            text = ""
+            for i in range(num_chunks):
+                await asyncio.sleep(chunk_delay)
+                text += f"token{i} "
+                yield json.dumps({"text": text, "error_code": 0}).encode() + b"\0"
+        return StreamingResponse(generate())
+
+    return app
+
+
+def start_server(app, port):
+    server = uvicorn.Server(uvicorn.Config(app, host="localhost", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+async def run_load(url, params, num_requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        async def one():
+            async with semaphore:
+                start = time.perf_counter()
+                async with client.stream("POST", url, json=params) as response:
+                    async for _ in response.aiter_raw():
+                        pass
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[one() for _ in range(num_requests)])
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "mean_ms": 1000 * sum(latencies) / len(latencies),
+        "p99_ms": 1000 * latencies[int(0.99 * (len(latencies) - 1))],
+        "throughput": num_requests / elapsed,
+    }
+
+
+async def time_status_fanout(controller_url, repeats=20):
+    async with httpx.AsyncClient(timeout=60) as client:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            await client.post(controller_url + "/worker_get_status")
+        return 1000 * (time.perf_counter() - start) / repeats
+
+
+async def main(args):
+    model_name = "fake-model"
+    max_workers = max(args.worker_counts)
+    worker_urls = []
+    for _ in range(max_workers):
+        port = free_port()
+        start_server(make_fake_worker(model_name, args.num_chunks, args.chunk_delay), port)
+        worker_urls.append(f"http://localhost:{port}")
+
+    controller_module.controller = controller_module.Controller(args.dispatch_method)
+    controller_port = free_port()
+    start_server(controller_module.app, controller_port)
+    controller_url = f"http://localhost:{controller_port}"
+
+    params = {"model": model_name, "prompt": "hello"}
+    registered = 0
+    async with httpx.AsyncClient(timeout=60) as client:
+        for num_workers in sorted(args.worker_counts):
+            for worker_url in worker_urls[registered:num_workers]:
+                await client.post(controller_url + "/register_worker", json={
+                    "worker_name": worker_url, "check_heart_beat": False, "worker_status": None})
+            registered = num_workers
+
+            direct = await run_load(worker_urls[0] + "/worker_generate_stream", params,
+                                    args.num_requests, args.concurrency)
+            routed = await run_load(controller_url + "/worker_generate_stream", params,
+                                    args.num_requests, args.concurrency)
+            status_ms = await time_status_fanout(controller_url)
+            print(json.dumps({
+                "num_workers": num_workers,
+                "direct_mean_ms": round(direct["mean_ms"], 2),
+                "controller_mean_ms": round(routed["mean_ms"], 2),
+                "controller_p99_ms": round(routed["p99_ms"], 2),
+                "overhead_ms": round(routed["mean_ms"] - direct["mean_ms"], 2),
+                "controller_throughput": round(routed["throughput"], 1),
+                "status_fanout_ms": round(status_ms, 2),
+            }), flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--worker-counts", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--num-requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--num-chunks", type=int, default=16)
+    parser.add_argument("--chunk-delay", type=float, default=0.005)
+    parser.add_argument("--dispatch-method", type=str, default="shortest_queue")
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,132 @@
+"""
+Simulate the controller dispatch policies on a pool of fake workers.
+
+Every worker serves its requests one after another with its own time to first
+token and decode speed. Requests arrive as a Poisson process and are routed by
+`Controller.get_worker_address`; workers send a heart beat with their queue
+length and measured speed every `--heart-beat-interval` simulated seconds.
+The same arrival trace is replayed for every policy.
+
+Usage:
+python3 -m llava.serve.dispatch_simulator --fast-workers 2 --slow-workers 4 --rate 1.5
+"""
+import argparse
+import asyncio
+import json
+import random
+
+from llava.serve.controller import Controller, WorkerInfo
+from llava.utils import WorkerSpeedMeter
+
+
+class FakeWorker:
+    def __init__(self, name, ttft, tokens_per_second, jitter, rng):
+        self.name = name
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.jitter = jitter
+        self.rng = rng
+        self.free_at = 0.0
+        # Completion times of accepted requests
+        self.completions = []
+        self.speed_meter = WorkerSpeedMeter()
+
+    def submit(self, arrival, num_new_tokens):
+        scale = 1.0 + self.rng.uniform(-self.jitter, self.jitter)
+        start = max(arrival, self.free_at)
+        first_token = start + self.ttft * scale
+        done = first_token + num_new_tokens / self.tokens_per_second * scale
+        self.free_at = done
+        self.completions.append((arrival, first_token, done, num_new_tokens))
+        return done
+
+    def queue_length(self, now):
+        return sum(1 for arrival, _, done, _ in self.completions if arrival <= now < done)
+
+    def status(self, now):
+        # Only requests finished by `now` have been measured
+        meter = WorkerSpeedMeter(self.speed_meter.alpha)
+        for arrival, first_token, done, num_new_tokens in self.completions:
+            if done <= now:
+                meter.update(arrival, first_token, done, num_new_tokens)
+        return meter.status()
+
+
+def make_trace(args):
+    rng = random.Random(args.seed)
+    now, trace = 0.0, []
+    for _ in range(args.num_requests):
+        now += rng.expovariate(args.rate)
+        trace.append((now, rng.randint(args.min_new_tokens, args.max_new_tokens)))
+    return trace
+
+
+def make_workers(args, rng):
+    workers = []
+    for i in range(args.fast_workers):
+        workers.append(FakeWorker(f"fast-{i}", args.fast_ttft, args.fast_speed, args.jitter, rng))
+    for i in range(args.slow_workers):
+        workers.append(FakeWorker(f"slow-{i}", args.slow_ttft, args.slow_speed, args.jitter, rng))
+    return workers
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def simulate(policy, trace, args):
+    rng = random.Random(args.seed + 1)
+    workers = {w.name: w for w in make_workers(args, rng)}
+    controller = Controller(policy)
+    for name in workers:
+        controller.worker_info[name] = WorkerInfo(["fake-model"], 1, 0, False, 0.0)
+
+    next_heart_beat = args.heart_beat_interval
+    latencies = []
+    for arrival, num_new_tokens in trace:
+        while next_heart_beat <= arrival:
+            for name, worker in workers.items():
+                controller.receive_heart_beat(name, worker.queue_length(next_heart_beat),
+                                              worker.status(next_heart_beat))
+            next_heart_beat += args.heart_beat_interval
+        name = await controller.get_worker_address("fake-model")
+        latencies.append(workers[name].submit(arrival, num_new_tokens) - arrival)
+    await controller.client.aclose()
+
+    return {
+        "policy": policy,
+        "mean_s": round(sum(latencies) / len(latencies), 2),
+        "p50_s": round(percentile(latencies, 0.50), 2),
+        "p95_s": round(percentile(latencies, 0.95), 2),
+        "p99_s": round(percentile(latencies, 0.99), 2),
+        "requests_per_worker": {name: len(w.completions) for name, w in workers.items()},
+    }
+
+
+async def main(args):
+    trace = make_trace(args)
+    for policy in args.policies:
+        print(json.dumps(await simulate(policy, trace, args)), flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--policies", type=str, nargs="+",
+        default=["lottery", "shortest_queue", "least_expected_latency"])
+    parser.add_argument("--fast-workers", type=int, default=2)
+    parser.add_argument("--fast-ttft", type=float, default=0.2)
+    parser.add_argument("--fast-speed", type=float, default=40.0)
+    parser.add_argument("--slow-workers", type=int, default=4)
+    parser.add_argument("--slow-ttft", type=float, default=1.5)
+    parser.add_argument("--slow-speed", type=float, default=6.0)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--rate", type=float, default=1.5, help="Requests per second.")
+    parser.add_argument("--num-requests", type=int, default=2000)
+    parser.add_argument("--min-new-tokens", type=int, default=32)
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--heart-beat-interval", type=float, default=15.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -1,5 +1,6 @@
 import argparse
 import datetime
+from io import BytesIO
 import json
 import os
 import time
@@ -35,6 +36,33 @@ def get_conv_log_filename():
     return name
 
 
+def upload_images(worker_addr, images, image_hashes, missing):
+    """Upload the images whose hash is in `missing` as raw PNG bytes."""
+    for image, image_hash in zip(images, image_hashes):
+        if image_hash in missing:
+            buffered = BytesIO()
+            image.save(buffered, format="PNG")
+            ret = requests.post(worker_addr + f"/worker_upload_image/{image_hash}",
+                headers={**headers, "Content-Type": "application/octet-stream"},
+                data=buffered.getvalue(), timeout=30)
+            ret.raise_for_status()
+            missing.discard(image_hash)
+
+
+def send_images(worker_addr, images, image_hashes):
+    """
+    Upload the images the worker has not cached yet as raw PNG bytes.
+    Returns False if the worker only accepts base64 images.
+    """
+    ret = requests.post(worker_addr + "/worker_check_images",
+        headers=headers, json={"image_hashes": image_hashes}, timeout=10)
+    if ret.status_code == 404:
+        return False
+    ret.raise_for_status()
+    upload_images(worker_addr, images, image_hashes, set(ret.json()["missing"]))
+    return True
+
+
 def get_model_list():
     ret = requests.post(args.controller_url + "/refresh_all_workers")
     assert ret.status_code == 200
@@ -202,10 +230,14 @@ def http_bot(state, model_selector, temperature, top_p, max_new_tokens, request:
         new_state.append_message(new_state.roles[1], None)
         state = new_state
 
-    # Query worker address
+    all_images = state.get_images(return_pil=True)
+    all_image_hash = [hashlib.md5(image.tobytes()).hexdigest() for image in all_images]
+
+    # Query worker address, keeping a study or session on the worker that has its images cached
     controller_url = args.controller_url
+    affinity_key = all_image_hash[0] if all_image_hash else request.session_hash
     ret = requests.post(controller_url + "/get_worker_address",
-            json={"model": model_name})
+            json={"model": model_name, "affinity_key": affinity_key})
     worker_addr = ret.json()["address"]
     logger.info(f"model_name: {model_name}, worker_addr: {worker_addr}")
 
@@ -218,8 +250,6 @@ def http_bot(state, model_selector, temperature, top_p, max_new_tokens, request:
     # Construct prompt
     prompt = state.get_prompt()
 
-    all_images = state.get_images(return_pil=True)
-    all_image_hash = [hashlib.md5(image.tobytes()).hexdigest() for image in all_images]
     for image, hash in zip(all_images, all_image_hash):
         t = datetime.datetime.now()
         filename = os.path.join(LOGDIR, "serve_images", f"{t.year}-{t.month:02d}-{t.day:02d}", f"{hash}.jpg")
@@ -236,37 +266,71 @@ def http_bot(state, model_selector, temperature, top_p, max_new_tokens, request:
         "max_new_tokens": min(int(max_new_tokens), 1536),
         "stop": state.sep if state.sep_style in [SeparatorStyle.SINGLE, SeparatorStyle.MPT] else state.sep2,
         "images": f'List of {len(state.get_images())} images: {all_image_hash}',
+        "stream_delta": True,
     }
     logger.info(f"==== request ====\n{pload}")
 
-    pload['images'] = state.get_images()
+    pload.pop("images")
 
     state.messages[-1][-1] = "▌"
     yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
 
     try:
-        # Stream output
-        response = requests.post(worker_addr + "/worker_generate_stream",
-            headers=headers, json=pload, stream=True, timeout=10)
-        for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-            if chunk:
-                data = json.loads(chunk.decode())
-                if data["error_code"] == 0:
-                    output = data["text"][len(prompt):].strip()
-                    state.messages[-1][-1] = output + "▌"
-                    yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
-                else:
-                    output = data["text"] + f" (error_code: {data['error_code']})"
-                    state.messages[-1][-1] = output
-                    yield (state, state.to_gradio_chatbot()) + (disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
-                    return
-                time.sleep(0.03)
+        # Send image hashes; image bytes are only uploaded on a worker cache miss
+        if len(all_images) > 0 and send_images(worker_addr, all_images, all_image_hash):
+            pload["image_hashes"] = all_image_hash
+        else:
+            pload["images"] = state.get_images()
+
+        # Stream output. The worker can evict uploaded images before the request reaches it;
+        # it then answers error_code 4 with the missing hashes, which are uploaded for one retry
+        for attempt in range(2):
+            response = requests.post(worker_addr + "/worker_generate_stream",
+                headers=headers, json=pload, stream=True, timeout=10)
+            output = ""
+            next_seq = 0
+            last_render = 0.0
+            retry = False
+            for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
+                if chunk:
+                    data = json.loads(chunk.decode())
+                    if data["error_code"] == 0:
+                        if "delta" in data:
+                            # Delta frames: append the new text, re-render at most every 30 ms
+                            if data["seq"] != next_seq:
+                                raise requests.exceptions.RequestException(
+                                    f"Missing stream frames: expected seq {next_seq}, got {data['seq']}")
+                            next_seq += 1
+                            output += data["delta"]
+                            if time.time() - last_render < 0.03:
+                                continue
+                        elif data.get("done"):
+                            output = data["output"]
+                        else:
+                            output = data["text"][len(prompt):]
+                            time.sleep(0.03)
+                        state.messages[-1][-1] = output.strip() + "▌"
+                        yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
+                        last_render = time.time()
+                    elif data["error_code"] == 4 and data.get("missing_images") and attempt == 0:
+                        upload_images(worker_addr, all_images, all_image_hash, set(data["missing_images"]))
+                        retry = True
+                        break
+                    else:
+                        output = data["text"] + f" (error_code: {data['error_code']})"
+                        state.messages[-1][-1] = output
+                        yield (state, state.to_gradio_chatbot()) + (disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
+                        return
+            response.close()
+            if not retry:
+                break
     except requests.exceptions.RequestException as e:
         state.messages[-1][-1] = server_error_msg
         yield (state, state.to_gradio_chatbot()) + (disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
         return
 
-    state.messages[-1][-1] = state.messages[-1][-1][:-1]
+    output = output.strip()
+    state.messages[-1][-1] = output
     yield (state, state.to_gradio_chatbot()) + (enable_btn,) * 5
 
     finish_tstamp = time.time()
@@ -0,0 +1,318 @@
+"""
+A model worker that serves HealthGPT variants (H-LoRA on Phi-3 / Phi-4) behind the controller.
+
+Every variant listed in `--model-names` is advertised as its own model, e.g.
+HealthGPT-M3-COM and HealthGPT-M3-GEN. The prompt of a request is the user
+question; HealthGPT applies its own instruct template. COM variants stream
+their answer; GEN variants return the generated image as a base64 PNG in a
+single final frame.
+"""
+import argparse
+import base64
+import contextlib
+from io import BytesIO
+import json
+import os
+import sys
+import time
+import threading
+import uuid
+
+from fastapi import FastAPI, Request, BackgroundTasks
+from fastapi.responses import JSONResponse, StreamingResponse
+import requests
+import torch
+import uvicorn
+from functools import partial
+
+from llava.constants import WORKER_HEART_BEAT_INTERVAL, DEFAULT_IMAGE_TOKEN
+from llava.utils import (build_logger, server_error_msg,
+    WorkerSpeedMeter, StreamFrameEncoder, stream_until_disconnect)
+from llava.serve.admission import AdmissionController, RequestRejected
+from llava.mm_utils import load_image_from_base64
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from model import HealthGPT, HealthGPT_Agent
+from config import (HealthGPTConfig_M3_COM, HealthGPTConfig_M3_COM_CPU,
+    HealthGPTConfig_M3_GEN, HealthGPTConfig_L14_COM)
+
+
+worker_id = str(uuid.uuid4())[:6]
+logger = build_logger("model_worker", f"model_worker_{worker_id}.log")
+global_counter = 0
+
+configs = {
+    "HealthGPT-M3-COM": HealthGPTConfig_M3_COM(),
+    "HealthGPT-M3-COM-CPU": HealthGPTConfig_M3_COM_CPU(),
+    "HealthGPT-M3-GEN": HealthGPTConfig_M3_GEN(),
+    "HealthGPT-L14-COM": HealthGPTConfig_L14_COM(),
+}
+
+
+def heart_beat_worker(controller):
+
+    while True:
+        time.sleep(WORKER_HEART_BEAT_INTERVAL)
+        controller.send_heart_beat()
+
+
+class HealthGPTWorker:
+    def __init__(self, controller_addr, worker_addr,
+                 worker_id, no_register, model_names, swap_models=False,
+                 limit_model_concurrency=5, max_queue_length=None, default_timeout=None,
+                 stub_model=False):
+        self.controller_addr = controller_addr
+        self.worker_addr = worker_addr
+        self.worker_id = worker_id
+        self.speed_meter = WorkerSpeedMeter()
+        self.admission = AdmissionController(limit_model_concurrency, max_queue_length,
+                                             self.speed_meter, default_timeout)
+        for model_name in model_names:
+            if model_name not in configs:
+                raise ValueError(f"Invalid model type: {model_name}, choose from {list(configs)}")
+        self.model_names = model_names
+
+        logger.info(f"Loading the models {model_names} on worker {worker_id} ...")
+        if stub_model:
+            # No weights, for load tests and CI, see stub_model.py
+            from stub_model import StubHealthGPT as model_cls, StubHealthGPT_Agent as agent_cls
+        else:
+            model_cls, agent_cls = HealthGPT, HealthGPT_Agent
+        if swap_models:
+            # One variant resident at a time, loaded on demand; requests are served one by one
+            self.agent = agent_cls(configs, model_name=model_names[0])
+            self.models = None
+            self.swap_lock = threading.Lock()
+        else:
+            self.agent = None
+            self.models = {model_name: model_cls(configs[model_name]) for model_name in model_names}
+        # GEN writes the decoded image to the config's save_path, so it runs one request at a time
+        self.gen_locks = {model_name: threading.Lock() for model_name in model_names}
+
+        if not no_register:
+            self.register_to_controller()
+            self.heart_beat_thread = threading.Thread(
+                target=heart_beat_worker, args=(self,), daemon=True)
+            self.heart_beat_thread.start()
+
+    def register_to_controller(self):
+        logger.info("Register to controller")
+
+        url = self.controller_addr + "/register_worker"
+        data = {
+            "worker_name": self.worker_addr,
+            "check_heart_beat": True,
+            "worker_status": self.get_status()
+        }
+        r = requests.post(url, json=data)
+        assert r.status_code == 200
+
+    def send_heart_beat(self):
+        logger.info(f"Send heart beat. Models: {self.model_names}. "
+                    f"Admission: {self.admission.stats()}. "
+                    f"global_counter: {global_counter}")
+
+        url = self.controller_addr + "/receive_heart_beat"
+
+        while True:
+            try:
+                ret = requests.post(url, json={
+                    "worker_name": self.worker_addr,
+                    "queue_length": self.get_queue_length(),
+                    "worker_status": self.get_status()}, timeout=5)
+                exist = ret.json()["exist"]
+                break
+            except requests.exceptions.RequestException as e:
+                logger.error(f"heart beat error: {e}")
+            time.sleep(5)
+
+        if not exist:
+            self.register_to_controller()
+
+    def get_queue_length(self):
+        return self.admission.queue_length()
+
+    def get_status(self):
+        return {
+            "model_names": self.model_names,
+            "speed": 1,
+            "queue_length": self.get_queue_length(),
+            **self.speed_meter.status(),
+            "max_concurrency": self.admission.limit_model_concurrency,
+            "admission": self.admission.stats(),
+        }
+
+    @contextlib.contextmanager
+    def use_model(self, model_name):
+        if self.agent is not None:
+            with self.swap_lock:
+                self.agent.load_model(model_name)
+                yield self.agent.agent
+        elif configs[model_name].task_type == "generation":
+            with self.gen_locks[model_name]:
+                yield self.models[model_name]
+        else:
+            yield self.models[model_name]
+
+    def generate_stream(self, params, cancel_event=None):
+        model_name = params["model"]
+        if model_name not in self.model_names:
+            raise ValueError(f"Model {model_name} is not served by this worker")
+
+        prompt = params["prompt"]
+        ori_prompt = prompt
+        question = prompt.replace(DEFAULT_IMAGE_TOKEN, "").strip()
+        images = params.get("images", None) or []
+        if len(images) > 1:
+            raise ValueError("HealthGPT takes at most one image per request")
+        image = load_image_from_base64(images[0]).convert('RGB') if images else None
+
+        task = "generate" if configs[model_name].task_type == "generation" else "infer"
+        deadline = params.get("deadline")
+        encoder = StreamFrameEncoder(ori_prompt, delta=params.get("stream_delta", False))
+        start_time = time.time()
+        first_token_time = None
+        output = None
+        # Leaving the block closes the stream, which stops decoding at the next step
+        with self.use_model(model_name) as model, \
+                contextlib.closing(model.stream(task, question, image, cancel_event)) as stream:
+            for text, output in stream:
+                # The last item carries the finished answer, only the steps before it can expire
+                if output is None and deadline is not None and time.time() >= deadline:
+                    self.admission.mark_expired()
+                    yield json.dumps({"text": "Request deadline exceeded.", "error_code": 5}).encode() + b"\0"
+                    return
+                if first_token_time is None:
+                    first_token_time = time.time()
+                if task == "infer" and output is None:
+                    frame = encoder.update(ori_prompt + text)
+                    if frame:
+                        yield frame
+        if cancel_event is not None and cancel_event.is_set():
+            return
+        if output is None:
+            # The stream ended without its final answer or image
+            yield json.dumps({
+                "text": "No image was generated." if task == "generate" else server_error_msg,
+                "error_code": 1,
+            }).encode() + b"\0"
+            return
+
+        if task == "generate":
+            buffered = BytesIO()
+            output.save(buffered, format="PNG")
+            yield json.dumps({
+                "text": ori_prompt,
+                "output": "",
+                "image": base64.b64encode(buffered.getvalue()).decode(),
+                "seq": 0,
+                "done": True,
+                "error_code": 0,
+            }).encode() + b"\0"
+            return
+
+        # The answer `infer` returns is the final one, as in app.py
+        generated_text = ori_prompt + output
+        for frame in (encoder.update(generated_text), encoder.finish(generated_text)):
+            if frame:
+                yield frame
+
+        num_new_tokens = len(model.tokenizer(output, add_special_tokens=False).input_ids)
+        self.speed_meter.update(start_time, first_token_time, time.time(), num_new_tokens)
+
+    def generate_stream_gate(self, params, cancel_event=None):
+        try:
+            for x in self.generate_stream(params, cancel_event):
+                yield x
+        except ValueError as e:
+            print("Caught ValueError:", e)
+            ret = {
+                "text": server_error_msg,
+                "error_code": 1,
+            }
+            yield json.dumps(ret).encode() + b"\0"
+        except torch.cuda.CudaError as e:
+            print("Caught torch.cuda.CudaError:", e)
+            ret = {
+                "text": server_error_msg,
+                "error_code": 1,
+            }
+            yield json.dumps(ret).encode() + b"\0"
+        except Exception as e:
+            print("Caught Unknown Error", e)
+            ret = {
+                "text": server_error_msg,
+                "error_code": 1,
+            }
+            yield json.dumps(ret).encode() + b"\0"
+
+
+app = FastAPI()
+
+
+def release_model_slot(fn=None):
+    worker.admission.release()
+    if fn is not None:
+        fn()
+
+
+@app.post("/worker_generate_stream")
+async def generate_stream(request: Request):
+    global global_counter
+    global_counter += 1
+    params = await request.json()
+
+    try:
+        params["deadline"] = await worker.admission.acquire(params)
+    except RequestRejected as e:
+        logger.info(f"Reject request: {e.reason} Retry after {e.retry_after}s.")
+        return JSONResponse({"text": e.reason, "error_code": 5, "retry_after": e.retry_after},
+                            status_code=e.status_code, headers={"Retry-After": str(e.retry_after)})
+    worker.send_heart_beat()
+    # Set when the client disconnects, generation then stops within one decode step
+    cancel_event = threading.Event()
+    generator = worker.generate_stream_gate(params, cancel_event)
+    background_tasks = BackgroundTasks()
+    background_tasks.add_task(partial(release_model_slot, fn=worker.send_heart_beat))
+    return StreamingResponse(stream_until_disconnect(generator, cancel_event), background=background_tasks)
+
+
+@app.post("/worker_get_status")
+async def get_status(request: Request):
+    return worker.get_status()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=21002)
+    parser.add_argument("--worker-address", type=str,
+        default="http://localhost:21002")
+    parser.add_argument("--controller-address", type=str,
+        default="http://localhost:21001")
+    parser.add_argument("--model-names", type=str, nargs="+", default=["HealthGPT-M3-COM"],
+        choices=list(configs))
+    parser.add_argument("--swap-models", action="store_true",
+        help="Keep only one variant in memory and load the requested one on demand, as app.py does.")
+    parser.add_argument("--limit-model-concurrency", type=int, default=5)
+    parser.add_argument("--max-queue-length", type=int, default=None,
+        help="Reject requests with 503 once this many are waiting for a slot.")
+    parser.add_argument("--default-timeout", type=float, default=None,
+        help="Deadline in seconds for requests that set neither `deadline` nor `timeout`.")
+    parser.add_argument("--stub-model", action="store_true",
+        help="Serve the weightless stand-in of stub_model.py, for load tests and CI.")
+    parser.add_argument("--no-register", action="store_true")
+    args = parser.parse_args()
+    logger.info(f"args: {args}")
+
+    worker = HealthGPTWorker(args.controller_address,
+                             args.worker_address,
+                             worker_id,
+                             args.no_register,
+                             args.model_names,
+                             swap_models=args.swap_models,
+                             limit_model_concurrency=args.limit_model_concurrency,
+                             max_queue_length=args.max_queue_length,
+                             default_timeout=args.default_timeout,
+                             stub_model=args.stub_model)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="info")
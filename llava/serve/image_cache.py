@@ -0,0 +1,90 @@
+"""
+LRU cache of decoded and preprocessed images on a model worker, keyed by
+content hash, so images are sent and preprocessed once per conversation
+instead of once per turn.
+"""
+from collections import OrderedDict
+import hashlib
+from io import BytesIO
+import threading
+
+from PIL import Image
+
+
+def image_hash(image):
+    """Content hash of a PIL image, the same one `gradio_web_server.http_bot` logs images under."""
+    return hashlib.md5(image.tobytes()).hexdigest()
+
+
+def load_image_from_bytes(data):
+    return Image.open(BytesIO(data))
+
+
+class ImageCache:
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        # Dict[str -> (preprocessed tensor, image size)], least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Keys whose lookup `missing` already counted, so the `get` of the request
+        # that follows (after uploading the missing images) does not count it again
+        self.counted = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            counted = self.counted.pop(key, False) is None
+            if entry is None:
+                if not counted:
+                    self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            if not counted:
+                self.hits += 1
+            return entry
+
+    def put(self, key, tensor, image_size):
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (tensor, image_size)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries)
+
+    def missing(self, keys):
+        """The keys that are not cached; counts a hit or a miss for each key."""
+        with self.lock:
+            missing = []
+            for key in keys:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    missing.append(key)
+                self.counted[key] = None
+                self.counted.move_to_end(key)
+            while len(self.counted) > max(self.capacity, 1):
+                self.counted.popitem(last=False)
+            return missing
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,268 @@
+"""
+Replay a request log against the HealthGPT serving stack and report latencies.
+
+The log is a JSON lines file, one request per line:
+
+    {"question": "What problems are there with this brain CT?", "image": "images/brain.jpg",
+     "task": "Analyze Image", "model": "HealthGPT-M3"}
+
+`image` (relative to the log file), `task` and `model` are optional. Targets:
+
+- gradio:     app.py through gradio_client, `/process_input`
+- rest:       the REST API of app.py, `/v1/chat/completions` (streamed) and `/v1/images/generations`
+- controller: `/worker_generate_stream` of the controller, HealthGPT workers behind it
+
+Requests are sent by `--concurrency` closed loop clients, or at `--rate`
+requests per second with Poisson arrivals. Every streamed chunk counts as a
+token; TTFT is the time to the first one and the inter-token latency the gap
+between consecutive ones. The summary is printed as JSON.
+
+For CI, serve the stub model (stub_model.py), e.g.
+HEALTHGPT_STUB_MODEL=1 python3 app.py
+
+Usage:
+python3 -m llava.serve.load_generator --target rest --url http://localhost:5011 --log requests.jsonl --concurrency 4
+python3 -m llava.serve.load_generator --target controller --url http://localhost:21001 --image-file brain.jpg --rate 2 --num-requests 100
+"""
+import argparse
+import asyncio
+import base64
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import random
+import time
+
+import httpx
+
+from llava.constants import DEFAULT_IMAGE_TOKEN
+
+
+def load_requests(args):
+    if args.log is None:
+        return [{"question": args.question, "image": args.image_file}]
+    requests = []
+    base_dir = os.path.dirname(os.path.abspath(args.log))
+    with open(args.log) as f:
+        for line in f:
+            if line.strip():
+                request = json.loads(line)
+                if request.get("image"):
+                    request["image"] = os.path.join(base_dir, request["image"])
+                requests.append(request)
+    return requests
+
+
+def prepare(request, image_cache):
+    request = {
+        "question": request["question"],
+        "image": request.get("image"),
+        "task": request.get("task", "Analyze Image"),
+        "model": request.get("model", "HealthGPT-M3"),
+    }
+    if request["image"] and request["image"] not in image_cache:
+        with open(request["image"], "rb") as f:
+            image_cache[request["image"]] = f.read()
+    request["image_bytes"] = image_cache.get(request["image"])
+    return request
+
+
+class Result(object):
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.end = None
+        self.token_times = []
+        self.error = None
+
+    def token(self):
+        self.token_times.append(time.perf_counter())
+
+
+async def rest_request(client, url, request, result):
+    if request["task"] == "Generate Image":
+        r = await client.post(url + "/v1/images/generations", content=request["image_bytes"] or b"",
+                              params={"prompt": request["question"], "model": request["model"]})
+        r.raise_for_status()
+        result.token()
+        return
+
+    content = [{"type": "text", "text": request["question"]}]
+    if request["image_bytes"]:
+        content.append({"type": "image_url", "image_url": {
+            "url": "data:image/png;base64," + base64.b64encode(request["image_bytes"]).decode()}})
+    body = {"model": request["model"], "stream": True, "messages": [{"role": "user", "content": content}]}
+    async with client.stream("POST", url + "/v1/chat/completions", json=body) as r:
+        if r.status_code != 200:
+            raise RuntimeError(f"HTTP {r.status_code}")
+        async for line in r.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            if line == "data: [DONE]":
+                break
+            event = json.loads(line[len("data: "):])
+            if "error" in event:
+                raise RuntimeError(event["error"]["message"])
+            if event["choices"][0]["delta"].get("content"):
+                result.token()
+
+
+async def controller_request(client, url, request, result):
+    suffix = "COM" if request["task"] == "Analyze Image" else "GEN"
+    params = {
+        "model": f"{request['model']}-{suffix}",
+        "prompt": request["question"],
+        "temperature": 0.0,
+        "top_p": 1.0,
+        "max_new_tokens": 512,
+        "stop": None,
+        "stream_delta": True,
+    }
+    if request["image_bytes"]:
+        params["prompt"] = DEFAULT_IMAGE_TOKEN + "\n" + request["question"]
+        params["images"] = [base64.b64encode(request["image_bytes"]).decode()]
+    async with client.stream("POST", url + "/worker_generate_stream", json=params) as r:
+        buffer = b""
+        async for data in r.aiter_raw():
+            *chunks, buffer = (buffer + data).split(b"\0")
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                frame = json.loads(chunk.decode())
+                if frame["error_code"] != 0:
+                    raise RuntimeError(f"error_code {frame['error_code']}: {frame['text']}")
+                if frame.get("delta") or frame.get("image"):
+                    result.token()
+
+
+def gradio_request(client, request, result):
+    from gradio_client import handle_file
+
+    image = handle_file(request["image"]) if request["image"] else None
+    job = client.submit(request["task"], request["model"], request["question"], image,
+                        api_name="/process_input")
+    # Every update of a streamed output is a chunk
+    for _ in job:
+        result.token()
+    job.result()
+
+
+async def timed(send, request):
+    result = Result()
+    try:
+        await send(request, result)
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    result.end = time.perf_counter()
+    return result
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))], 4)
+
+    return {
+        "mean": round(sum(values) / len(values), 4),
+        "p50": at(0.50),
+        "p95": at(0.95),
+        "p99": at(0.99),
+        "max": round(values[-1], 4),
+    }
+
+
+def summarize(args, results, elapsed):
+    ok = [r for r in results if r.error is None]
+    tokens = sum(len(r.token_times) for r in ok)
+    return {
+        "target": args.target,
+        "url": args.url,
+        "concurrency": None if args.rate else args.concurrency,
+        "rate": args.rate,
+        "requests": len(results),
+        "succeeded": len(ok),
+        "failed": len(results) - len(ok),
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(ok) / elapsed, 3),
+        "output_tokens_per_s": round(tokens / elapsed, 1),
+        "latency_s": percentiles([r.end - r.start for r in ok]),
+        "ttft_s": percentiles([r.token_times[0] - r.start for r in ok if r.token_times]),
+        "itl_s": percentiles([b - a for r in ok for a, b in zip(r.token_times, r.token_times[1:])]),
+        "errors": dict(Counter(r.error for r in results if r.error is not None).most_common(10)),
+    }
+
+
+async def main(args):
+    image_cache = {}
+    log = [prepare(r, image_cache) for r in load_requests(args)]
+    num_requests = args.num_requests or len(log)
+    requests = [log[i % len(log)] for i in range(num_requests)]
+    workers = args.concurrency if not args.rate else max(args.concurrency, 64)
+
+    limits = httpx.Limits(max_connections=workers, max_keepalive_connections=workers)
+    async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client:
+        if args.target == "gradio":
+            from gradio_client import Client
+
+            gradio_client = Client(args.url)
+            # gradio_client blocks, every in-flight request gets a thread
+            executor = ThreadPoolExecutor(max_workers=workers)
+            loop = asyncio.get_running_loop()
+
+            async def send(request, result):
+                await loop.run_in_executor(executor, gradio_request, gradio_client, request, result)
+        else:
+            send_fn = rest_request if args.target == "rest" else controller_request
+
+            async def send(request, result):
+                await send_fn(client, args.url, request, result)
+
+        start = time.perf_counter()
+        if args.rate:
+            # Open loop: arrivals do not wait for earlier requests to finish
+            tasks = []
+            for request in requests:
+                tasks.append(asyncio.create_task(timed(send, request)))
+                await asyncio.sleep(random.expovariate(args.rate))
+            results = await asyncio.gather(*tasks)
+        else:
+            queue = list(reversed(requests))
+            results = []
+
+            async def client_loop():
+                while queue:
+                    results.append(await timed(send, queue.pop()))
+
+            await asyncio.gather(*[client_loop() for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - start
+
+    summary = summarize(args, results, elapsed)
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", type=str, default="rest", choices=["gradio", "rest", "controller"])
+    parser.add_argument("--url", type=str, default="http://localhost:5011")
+    parser.add_argument("--log", type=str, default=None,
+        help="JSON lines request log; without it --question and --image-file are sent.")
+    parser.add_argument("--question", type=str, default="What problems are there with this brain CT?")
+    parser.add_argument("--image-file", type=str, default=None)
+    parser.add_argument("--num-requests", type=int, default=None,
+        help="Number of requests to send, cycling through the log (default: the log once).")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--rate", type=float, default=None,
+        help="Requests per second with Poisson arrivals, instead of closed loop clients.")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="Also write the summary to this file.")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    asyncio.run(main(args))
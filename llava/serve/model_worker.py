@@ -9,7 +9,7 @@ import threading
 import uuid
 
 from fastapi import FastAPI, Request, BackgroundTasks
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import requests
 import torch
 import uvicorn
@@ -17,11 +17,14 @@ from functools import partial
 
 from llava.constants import WORKER_HEART_BEAT_INTERVAL
 from llava.utils import (build_logger, server_error_msg,
-    pretty_print_semaphore)
+    WorkerSpeedMeter, StreamFrameEncoder, stream_until_disconnect)
+from llava.serve.admission import AdmissionController, RequestRejected
 from llava.model.builder import load_pretrained_model
-from llava.mm_utils import process_images, load_image_from_base64, tokenizer_image_token
+from llava.mm_utils import process_images, load_image_from_base64, tokenizer_image_token, CancelStoppingCriteria, DeadlineStoppingCriteria
+from llava.serve.image_cache import ImageCache, image_hash, load_image_from_bytes
+from llava.serve.batch_generator import BatchGenerator, GenerationRequest
 from llava.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
-from transformers import TextIteratorStreamer
+from transformers import TextIteratorStreamer, StoppingCriteriaList
 from threading import Thread
 
 
@@ -31,8 +34,6 @@ worker_id = str(uuid.uuid4())[:6]
 logger = build_logger("model_worker", f"model_worker_{worker_id}.log")
 global_counter = 0
 
-model_semaphore = None
-
 
 def heart_beat_worker(controller):
 
@@ -45,10 +46,16 @@ class ModelWorker:
     def __init__(self, controller_addr, worker_addr,
                  worker_id, no_register,
                  model_path, model_base, model_name,
-                 load_8bit, load_4bit, device, use_flash_attn=False):
+                 load_8bit, load_4bit, device, use_flash_attn=False,
+                 image_cache_size=64, max_batch_size=1, max_wait=0.01,
+                 limit_model_concurrency=5, max_queue_length=None, default_timeout=None):
         self.controller_addr = controller_addr
         self.worker_addr = worker_addr
         self.worker_id = worker_id
+        self.speed_meter = WorkerSpeedMeter()
+        self.image_cache = ImageCache(image_cache_size)
+        self.admission = AdmissionController(limit_model_concurrency, max_queue_length,
+                                             self.speed_meter, default_timeout)
         if model_path.endswith("/"):
             model_path = model_path[:-1]
         if model_name is None:
@@ -65,6 +72,10 @@ class ModelWorker:
         self.tokenizer, self.model, self.image_processor, self.context_len = load_pretrained_model(
             model_path, model_base, self.model_name, load_8bit, load_4bit, device=self.device, use_flash_attn=use_flash_attn)
         self.is_multimodal = 'llava' in self.model_name.lower()
+        if max_batch_size > 1:
+            self.batch_generator = BatchGenerator(self.model, self.tokenizer, max_batch_size, max_wait)
+        else:
+            self.batch_generator = None
 
         if not no_register:
             self.register_to_controller()
@@ -86,8 +97,9 @@ class ModelWorker:
 
     def send_heart_beat(self):
         logger.info(f"Send heart beat. Models: {[self.model_name]}. "
-                    f"Semaphore: {pretty_print_semaphore(model_semaphore)}. "
-                    f"global_counter: {global_counter}")
+                    f"Admission: {self.admission.stats()}. "
+                    f"global_counter: {global_counter}. "
+                    f"Image cache: {self.image_cache.stats()}")
 
         url = self.controller_addr + "/receive_heart_beat"
 
@@ -95,7 +107,8 @@ class ModelWorker:
             try:
                 ret = requests.post(url, json={
                     "worker_name": self.worker_addr,
-                    "queue_length": self.get_queue_length()}, timeout=5)
+                    "queue_length": self.get_queue_length(),
+                    "worker_status": self.get_status()}, timeout=5)
                 exist = ret.json()["exist"]
                 break
             except requests.exceptions.RequestException as e:
@@ -106,40 +119,78 @@ class ModelWorker:
             self.register_to_controller()
 
     def get_queue_length(self):
-        if model_semaphore is None:
-            return 0
-        else:
-            return args.limit_model_concurrency - model_semaphore._value + (len(
-                model_semaphore._waiters) if model_semaphore._waiters is not None else 0)
+        return self.admission.queue_length()
 
     def get_status(self):
         return {
             "model_names": [self.model_name],
             "speed": 1,
             "queue_length": self.get_queue_length(),
+            **self.speed_meter.status(),
+            "max_concurrency": self.admission.limit_model_concurrency,
+            "admission": self.admission.stats(),
+            "image_cache": self.image_cache.stats(),
+            "cached_images": self.image_cache.keys(),
         }
 
+    def preprocess_image(self, image):
+        image_tensor = process_images([image], self.image_processor, self.model.config)[0]
+        return image_tensor.to(self.model.device, dtype=torch.float16), image.size
+
+    def add_image(self, key, data):
+        image = load_image_from_bytes(data)
+        if image_hash(image) != key:
+            raise ValueError(f"Image content does not match hash {key}")
+        self.image_cache.put(key, *self.preprocess_image(image))
+
+    def get_images(self, params):
+        """
+        Preprocessed images of a request and their sizes, or the hashes that are
+        not cached. Clients send `image_hashes` and upload the missing images
+        with `/worker_upload_image`; legacy clients send base64 `images`.
+        """
+        if "image_hashes" in params:
+            keys = params["image_hashes"]
+            entries = [self.image_cache.get(key) for key in keys]
+            missing = [key for key, entry in zip(keys, entries) if entry is None]
+            if missing:
+                return None, None, missing
+        else:
+            entries = []
+            for image in params["images"]:
+                # Keyed by the pixels like uploads are, so both kinds of clients share the cache entry
+                image = load_image_from_base64(image)
+                key = image_hash(image)
+                entry = self.image_cache.get(key)
+                if entry is None:
+                    entry = self.preprocess_image(image)
+                    self.image_cache.put(key, *entry)
+                entries.append(entry)
+
+        images = [image for image, _ in entries]
+        image_sizes = [image_size for _, image_size in entries]
+        if all(x.shape == images[0].shape for x in images):
+            images = torch.stack(images, dim=0)
+        return images, image_sizes, []
+
     @torch.inference_mode()
-    def generate_stream(self, params):
+    def generate_stream(self, params, cancel_event=None):
         tokenizer, model, image_processor = self.tokenizer, self.model, self.image_processor
 
         prompt = params["prompt"]
         ori_prompt = prompt
-        images = params.get("images", None)
+        images = params.get("image_hashes", params.get("images", None))
         num_image_tokens = 0
         if images is not None and len(images) > 0 and self.is_multimodal:
             if len(images) > 0:
                 if len(images) != prompt.count(DEFAULT_IMAGE_TOKEN):
                     raise ValueError("Number of images does not match number of <image> tokens in prompt")
 
-                images = [load_image_from_base64(image) for image in images]
-                image_sizes = [image.size for image in images]
-                images = process_images(images, image_processor, model.config)
-
-                if type(images) is list:
-                    images = [image.to(self.model.device, dtype=torch.float16) for image in images]
-                else:
-                    images = images.to(self.model.device, dtype=torch.float16)
+                images, image_sizes, missing = self.get_images(params)
+                if missing:
+                    yield json.dumps({"text": "Images are not cached on the worker, please upload them.",
+                                      "error_code": 4, "missing_images": missing}).encode() + b"\0"
+                    return
 
                 replace_token = DEFAULT_IMAGE_TOKEN
                 if getattr(self.model.config, 'mm_use_im_start_end', False):
@@ -173,28 +224,74 @@ class ModelWorker:
             yield json.dumps({"text": ori_prompt + "Exceeds max token length. Please start a new conversation, thanks.", "error_code": 0}).encode() + b"\0"
             return
 
-        thread = Thread(target=model.generate, kwargs=dict(
-            inputs=input_ids,
-            do_sample=do_sample,
-            temperature=temperature,
-            top_p=top_p,
-            max_new_tokens=max_new_tokens,
-            streamer=streamer,
-            use_cache=True,
-            **image_args
-        ))
-        thread.start()
-
+        start_time = time.time()
+        deadline = params.get("deadline")
+        request = None
+        deadline_criteria = None
+        if self.batch_generator is not None:
+            # Tokens come from the shared batched decode; the prompt is never put on the streamer
+            streamer = TextIteratorStreamer(tokenizer, skip_prompt=False, skip_special_tokens=True)
+            request = GenerationRequest(input_ids[0], image_args.get("images"), image_args.get("image_sizes"),
+                                        temperature, top_p, max_new_tokens, streamer, deadline=deadline,
+                                        cancel_event=cancel_event)
+            self.batch_generator.submit(request)
+        else:
+            stopping_criteria = [CancelStoppingCriteria(cancel_event)] if cancel_event is not None else []
+            if deadline is not None:
+                # Stop decoding once the deadline passes, nobody is waiting for the answer anymore
+                deadline_criteria = DeadlineStoppingCriteria(deadline, tokenizer.eos_token_id)
+                stopping_criteria.append(deadline_criteria)
+            thread = Thread(target=model.generate, kwargs=dict(
+                inputs=input_ids,
+                do_sample=do_sample,
+                temperature=temperature,
+                top_p=top_p,
+                max_new_tokens=max_new_tokens,
+                streamer=streamer,
+                use_cache=True,
+                stopping_criteria=StoppingCriteriaList(stopping_criteria),
+                **image_args
+            ))
+            thread.start()
+
+        first_token_time = None
         generated_text = ori_prompt
+        encoder = StreamFrameEncoder(ori_prompt, delta=params.get("stream_delta", False), stop_str=stop_str)
         for new_text in streamer:
+            if first_token_time is None:
+                first_token_time = time.time()
             generated_text += new_text
             if generated_text.endswith(stop_str):
                 generated_text = generated_text[:-len(stop_str)]
-            yield json.dumps({"text": generated_text, "error_code": 0}).encode() + b"\0"
+            frame = encoder.update(generated_text)
+            if frame:
+                yield frame
+        if request is not None and request.error is not None:
+            raise request.error
+        if cancel_event is not None and cancel_event.is_set():
+            return
+        # Decoding checks the deadline at each step; an answer that finished in time is sent in full
+        if request is not None:
+            expired = request.expired
+        else:
+            expired = deadline_criteria is not None and deadline_criteria.expired
+        if expired:
+            self.admission.mark_expired()
+            yield json.dumps({"text": "Request deadline exceeded.", "error_code": 5}).encode() + b"\0"
+            return
+        frame = encoder.finish(generated_text)
+        if frame:
+            yield frame
 
-    def generate_stream_gate(self, params):
+        if request is not None:
+            num_new_tokens = request.num_new_tokens
+        else:
+            num_new_tokens = len(tokenizer(generated_text[len(ori_prompt):], add_special_tokens=False).input_ids)
+        self.speed_meter.update(start_time, first_token_time, time.time(), num_new_tokens)
+
+    def generate_stream_gate(self, params, cancel_event=None):
         try:
-            for x in self.generate_stream(params):
+            for x in self.generate_stream(params, cancel_event):
                 yield x
         except ValueError as e:
             print("Caught ValueError:", e)
@@ -222,26 +319,31 @@ class ModelWorker:
 app = FastAPI()
 
 
-def release_model_semaphore(fn=None):
-    model_semaphore.release()
+def release_model_slot(fn=None):
+    worker.admission.release()
     if fn is not None:
         fn()
 
 
 @app.post("/worker_generate_stream")
 async def generate_stream(request: Request):
-    global model_semaphore, global_counter
+    global global_counter
     global_counter += 1
     params = await request.json()
 
-    if model_semaphore is None:
-        model_semaphore = asyncio.Semaphore(args.limit_model_concurrency)
-    await model_semaphore.acquire()
+    try:
+        params["deadline"] = await worker.admission.acquire(params)
+    except RequestRejected as e:
+        logger.info(f"Reject request: {e.reason} Retry after {e.retry_after}s.")
+        return JSONResponse({"text": e.reason, "error_code": 5, "retry_after": e.retry_after},
+                            status_code=e.status_code, headers={"Retry-After": str(e.retry_after)})
     worker.send_heart_beat()
-    generator = worker.generate_stream_gate(params)
+    # Set when the client disconnects, generation then stops within one decode step
+    cancel_event = threading.Event()
+    generator = worker.generate_stream_gate(params, cancel_event)
     background_tasks = BackgroundTasks()
-    background_tasks.add_task(partial(release_model_semaphore, fn=worker.send_heart_beat))
-    return StreamingResponse(generator, background=background_tasks)
+    background_tasks.add_task(partial(release_model_slot, fn=worker.send_heart_beat))
+    return StreamingResponse(stream_until_disconnect(generator, cancel_event), background=background_tasks)
 
 
 @app.post("/worker_get_status")
@@ -249,6 +351,28 @@ async def get_status(request: Request):
     return worker.get_status()
 
 
+@app.post("/worker_check_images")
+async def check_images(request: Request):
+    params = await request.json()
+    if worker.image_cache.capacity <= 0:
+        # Cache disabled: clients fall back to sending base64 images
+        return JSONResponse({"error": "image cache disabled"}, status_code=404)
+    return {"missing": worker.image_cache.missing(params["image_hashes"])}
+
+
+@app.post("/worker_upload_image/{image_hash}")
+async def upload_image(image_hash: str, request: Request):
+    # Raw image file bytes; decoding and preprocessing run off the event loop
+    data = await request.body()
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, worker.add_image, image_hash, data)
+    except Exception as e:
+        logger.error(f"upload image error: {e}")
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return {"image_hash": image_hash}
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", type=str, default="localhost")
@@ -263,11 +387,22 @@ if __name__ == "__main__":
     parser.add_argument("--device", type=str, default="cuda")
     parser.add_argument("--multi-modal", action="store_true", help="Multimodal mode is automatically detected with model name, please make sure `llava` is included in the model path.")
     parser.add_argument("--limit-model-concurrency", type=int, default=5)
+    parser.add_argument("--max-queue-length", type=int, default=None,
+        help="Reject requests with 503 once this many are waiting for a slot.")
+    parser.add_argument("--default-timeout", type=float, default=None,
+        help="Deadline in seconds for requests that set neither `deadline` nor `timeout`.")
     parser.add_argument("--stream-interval", type=int, default=1)
     parser.add_argument("--no-register", action="store_true")
     parser.add_argument("--load-8bit", action="store_true")
     parser.add_argument("--load-4bit", action="store_true")
     parser.add_argument("--use-flash-attn", action="store_true")
+    parser.add_argument("--image-cache-size", type=int, default=64,
+        help="Number of preprocessed images kept on the worker; 0 disables the cache.")
+    parser.add_argument("--max-batch-size", type=int, default=1,
+        help="Decode up to this many concurrent requests as one batch; 1 runs a separate generate per request. "
+             "Concurrency is still capped by --limit-model-concurrency.")
+    parser.add_argument("--max-wait-ms", type=float, default=10,
+        help="How long an idle worker waits for more requests to prefill together.")
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
@@ -284,5 +419,11 @@ if __name__ == "__main__":
                          args.load_8bit,
                          args.load_4bit,
                          args.device,
-                         use_flash_attn=args.use_flash_attn)
+                         use_flash_attn=args.use_flash_attn,
+                         image_cache_size=args.image_cache_size,
+                         max_batch_size=args.max_batch_size,
+                         max_wait=args.max_wait_ms / 1000,
+                         limit_model_concurrency=args.limit_model_concurrency,
+                         max_queue_length=args.max_queue_length,
+                         default_timeout=args.default_timeout)
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
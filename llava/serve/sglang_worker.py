@@ -10,7 +10,7 @@ import threading
 import uuid
 
 from fastapi import FastAPI, Request, BackgroundTasks
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import requests
 import re
 import uvicorn
@@ -18,7 +18,8 @@ from functools import partial
 
 from llava.constants import WORKER_HEART_BEAT_INTERVAL
 from llava.utils import (build_logger, server_error_msg,
-    pretty_print_semaphore)
+    WorkerSpeedMeter, StreamFrameEncoder)
+from llava.serve.admission import AdmissionController, RequestRejected
 from llava.mm_utils import process_images, load_image_from_base64, tokenizer_image_token, expand2square
 from llava.constants import DEFAULT_IMAGE_TOKEN
 
@@ -32,8 +33,6 @@ worker_id = str(uuid.uuid4())[:6]
 logger = build_logger("model_worker", f"model_worker_{worker_id}.log")
 global_counter = 0
 
-model_semaphore = None
-
 
 def heart_beat_worker(controller):
     while True:
@@ -53,10 +52,14 @@ def pipeline(s, prompt, max_tokens):
 
 class ModelWorker:
     def __init__(self, controller_addr, worker_addr, sgl_endpoint,
-                 worker_id, no_register, model_name):
+                 worker_id, no_register, model_name,
+                 limit_model_concurrency=5, max_queue_length=None, default_timeout=None):
         self.controller_addr = controller_addr
         self.worker_addr = worker_addr
         self.worker_id = worker_id
+        self.speed_meter = WorkerSpeedMeter()
+        self.admission = AdmissionController(limit_model_concurrency, max_queue_length,
+                                             self.speed_meter, default_timeout)
 
         # Select backend
         backend = RuntimeEndpoint(sgl_endpoint)
@@ -96,7 +99,7 @@ class ModelWorker:
 
     def send_heart_beat(self):
         logger.info(f"Send heart beat. Models: {[self.model_name]}. "
-                    f"Semaphore: {pretty_print_semaphore(model_semaphore)}. "
+                    f"Admission: {self.admission.stats()}. "
                     f"global_counter: {global_counter}")
 
         url = self.controller_addr + "/receive_heart_beat"
@@ -105,7 +108,8 @@ class ModelWorker:
             try:
                 ret = requests.post(url, json={
                     "worker_name": self.worker_addr,
-                    "queue_length": self.get_queue_length()}, timeout=5)
+                    "queue_length": self.get_queue_length(),
+                    "worker_status": self.get_status()}, timeout=5)
                 exist = ret.json()["exist"]
                 break
             except requests.exceptions.RequestException as e:
@@ -116,17 +120,16 @@ class ModelWorker:
             self.register_to_controller()
 
     def get_queue_length(self):
-        if model_semaphore is None:
-            return 0
-        else:
-            return args.limit_model_concurrency - model_semaphore._value + (len(
-                model_semaphore._waiters) if model_semaphore._waiters is not None else 0)
+        return self.admission.queue_length()
 
     def get_status(self):
         return {
             "model_names": [self.model_name],
             "speed": 1,
             "queue_length": self.get_queue_length(),
+            **self.speed_meter.status(),
+            "max_concurrency": self.admission.limit_model_concurrency,
+            "admission": self.admission.stats(),
         }
 
     async def generate_stream(self, params):
@@ -164,10 +167,31 @@ class ModelWorker:
         print({'prompt': prompt, 'max_new_tokens': max_new_tokens, 'temperature': temperature, 'top_p': top_p})
         state = pipeline.run(prompt, max_new_tokens, temperature=temperature, top_p=top_p, stream=True)
 
+        start_time = time.time()
+        first_token_time = None
+        # Each streamed piece is counted as one token
+        num_new_tokens = 0
         generated_text = ori_prompt
+        encoder = StreamFrameEncoder(ori_prompt, delta=params.get("stream_delta", False))
+        deadline = params.get("deadline")
         async for text_outputs in state.text_async_iter(var_name="response"):
+            if deadline is not None and time.time() >= deadline:
+                # Stop streaming once nobody is waiting for the answer anymore
+                self.admission.mark_expired()
+                yield json.dumps({"text": "Request deadline exceeded.", "error_code": 5}).encode() + b"\0"
+                return
+            if first_token_time is None:
+                first_token_time = time.time()
+            num_new_tokens += 1
             generated_text += text_outputs
-            yield json.dumps({"text": generated_text, "error_code": 0}).encode() + b"\0"
+            frame = encoder.update(generated_text)
+            if frame:
+                yield frame
+        frame = encoder.finish(generated_text)
+        if frame:
+            yield frame
+
+        self.speed_meter.update(start_time, first_token_time, time.time(), num_new_tokens)
 
     async def generate_stream_gate(self, params):
         try:
@@ -192,25 +216,28 @@ class ModelWorker:
 app = FastAPI()
 
 
-def release_model_semaphore(fn=None):
-    model_semaphore.release()
+def release_model_slot(fn=None):
+    worker.admission.release()
     if fn is not None:
         fn()
 
 
 @app.post("/worker_generate_stream")
 async def generate_stream(request: Request):
-    global model_semaphore, global_counter
+    global global_counter
     global_counter += 1
     params = await request.json()
 
-    if model_semaphore is None:
-        model_semaphore = asyncio.Semaphore(args.limit_model_concurrency)
-    await model_semaphore.acquire()
+    try:
+        params["deadline"] = await worker.admission.acquire(params)
+    except RequestRejected as e:
+        logger.info(f"Reject request: {e.reason} Retry after {e.retry_after}s.")
+        return JSONResponse({"text": e.reason, "error_code": 5, "retry_after": e.retry_after},
+                            status_code=e.status_code, headers={"Retry-After": str(e.retry_after)})
     worker.send_heart_beat()
     generator = worker.generate_stream_gate(params)
     background_tasks = BackgroundTasks()
-    background_tasks.add_task(partial(release_model_semaphore, fn=worker.send_heart_beat))
+    background_tasks.add_task(partial(release_model_slot, fn=worker.send_heart_beat))
     return StreamingResponse(generator, background=background_tasks)
 
 
@@ -230,6 +257,10 @@ if __name__ == "__main__":
     parser.add_argument("--model-name", type=str)
     parser.add_argument("--sgl-endpoint", type=str)
     parser.add_argument("--limit-model-concurrency", type=int, default=5)
+    parser.add_argument("--max-queue-length", type=int, default=None,
+        help="Reject requests with 503 once this many are waiting for a slot.")
+    parser.add_argument("--default-timeout", type=float, default=None,
+        help="Deadline in seconds for requests that set neither `deadline` nor `timeout`.")
     parser.add_argument("--stream-interval", type=int, default=1)
     parser.add_argument("--no-register", action="store_true")
     args = parser.parse_args()
@@ -240,5 +271,8 @@ if __name__ == "__main__":
                          args.sgl_endpoint,
                          worker_id,
                          args.no_register,
-                         args.model_name)
+                         args.model_name,
+                         limit_model_concurrency=args.limit_model_concurrency,
+                         max_queue_length=args.max_queue_length,
+                         default_timeout=args.default_timeout)
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
@@ -0,0 +1,87 @@
+"""
+Compare bytes sent and CPU time of the full-text and delta streaming protocols.
+
+A fake answer of `--num-tokens` tokens is streamed one token per frame after a
+prompt of `--prompt-chars` characters. CPU time covers encoding on the worker
+and decoding plus text reassembly on the client.
+
+Usage:
+python3 -m llava.serve.stream_protocol_bench --num-tokens 2000
+"""
+import argparse
+import json
+import random
+import string
+import time
+
+from llava.utils import StreamFrameEncoder
+
+
+def fake_tokens(num_tokens, seed):
+    rng = random.Random(seed)
+    return [" " + "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(1, 7)))
+            for _ in range(num_tokens)]
+
+
+def run(prompt, tokens, delta):
+    start = time.process_time()
+    encoder = StreamFrameEncoder(prompt, delta=delta, stop_str="</s>")
+    frames = []
+    text = prompt
+    for token in tokens:
+        text += token
+        frame = encoder.update(text)
+        if frame:
+            frames.append(frame)
+    frame = encoder.finish(text)
+    if frame:
+        frames.append(frame)
+    encode_s = time.process_time() - start
+
+    start = time.process_time()
+    output = ""
+    for chunk in b"".join(frames).split(b"\0"):
+        if not chunk:
+            continue
+        data = json.loads(chunk.decode())
+        if "delta" in data:
+            output += data["delta"]
+        elif data.get("done"):
+            output = data["output"]
+        else:
+            output = data["text"][len(prompt):]
+    decode_s = time.process_time() - start
+
+    assert output == text[len(prompt):]
+    return {
+        "frames": len(frames),
+        "bytes": sum(len(f) for f in frames),
+        "encode_ms": round(1000 * encode_s, 2),
+        "decode_ms": round(1000 * decode_s, 2),
+    }
+
+
+def main(args):
+    prompt = "x" * args.prompt_chars
+    tokens = fake_tokens(args.num_tokens, args.seed)
+    legacy = run(prompt, tokens, delta=False)
+    delta = run(prompt, tokens, delta=True)
+    print(json.dumps({
+        "num_tokens": args.num_tokens,
+        "prompt_chars": args.prompt_chars,
+        "full_text": legacy,
+        "delta": delta,
+        "bytes_ratio": round(legacy["bytes"] / delta["bytes"], 1),
+        "cpu_ratio": round((legacy["encode_ms"] + legacy["decode_ms"]) /
+                           max(delta["encode_ms"] + delta["decode_ms"], 1e-3), 1),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-tokens", type=int, default=2000)
+    parser.add_argument("--prompt-chars", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(args)
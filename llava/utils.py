@@ -1,8 +1,11 @@
 import datetime
+import json
 import logging
 import logging.handlers
 import os
+import queue
 import sys
+import threading
 
 import requests
 
@@ -124,3 +127,141 @@ def pretty_print_semaphore(semaphore):
     if semaphore is None:
         return "None"
     return f"Semaphore(value={semaphore._value}, locked={semaphore.locked()})"
+
+
+class WorkerSpeedMeter(object):
+    """
+    Exponentially weighted averages of time to first token, decode throughput and
+    number of new tokens over finished requests. Workers report them to the controller.
+    """
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.ttft = None
+        self.tokens_per_second = None
+        self.avg_new_tokens = None
+        self.lock = threading.Lock()
+
+    def _ewma(self, old, new):
+        return new if old is None else (1 - self.alpha) * old + self.alpha * new
+
+    def update(self, start_time, first_token_time, end_time, num_new_tokens):
+        if first_token_time is None:
+            return
+        with self.lock:
+            self.ttft = self._ewma(self.ttft, first_token_time - start_time)
+            if num_new_tokens > 1 and end_time > first_token_time:
+                self.tokens_per_second = self._ewma(
+                    self.tokens_per_second, (num_new_tokens - 1) / (end_time - first_token_time))
+            self.avg_new_tokens = self._ewma(self.avg_new_tokens, num_new_tokens)
+
+    def status(self):
+        with self.lock:
+            return {
+                "ttft": self.ttft,
+                "tokens_per_second": self.tokens_per_second,
+                "avg_new_tokens": self.avg_new_tokens,
+            }
+
+
+class StreamFrameEncoder(object):
+    """
+    Encodes the text generated for one request as \\0-delimited JSON frames.
+
+    By default every frame carries the whole text so far (prompt included), as
+    workers always did. With `delta=True` a frame carries only the new text and
+    a sequence number, and `finish` adds one summary frame with the full output.
+    The last `len(stop_str) - 1` characters are held back in delta mode, since a
+    stop string split across chunks is removed from the text once complete.
+    """
+    def __init__(self, prompt, delta=False, stop_str=None):
+        self.prompt = prompt
+        self.delta = delta
+        self.hold_back = max(len(stop_str) - 1, 0) if stop_str else 0
+        self.sent = 0
+        self.seq = 0
+
+    def update(self, text):
+        if not self.delta:
+            return json.dumps({"text": text, "error_code": 0}).encode() + b"\0"
+        output = text[len(self.prompt):]
+        end = len(output) - self.hold_back
+        if end <= self.sent:
+            return b""
+        return self._delta_frame(output[self.sent:end], end)
+
+    def finish(self, text):
+        if not self.delta:
+            return b""
+        output = text[len(self.prompt):]
+        frames = b""
+        if len(output) > self.sent:
+            frames += self._delta_frame(output[self.sent:], len(output))
+        frames += json.dumps({"output": output, "seq": self.seq, "done": True, "error_code": 0}).encode() + b"\0"
+        return frames
+
+    def _delta_frame(self, delta, end):
+        frame = json.dumps({"delta": delta, "seq": self.seq, "error_code": 0}).encode() + b"\0"
+        self.sent = end
+        self.seq += 1
+        return frame
+
+
+async def stream_until_disconnect(iterator, cancel_event):
+    """
+    Iterate a blocking generator in the thread pool for a StreamingResponse. If
+    the response is cancelled before the generator is exhausted, because the
+    client went away, `cancel_event` is set so the generation stops.
+    """
+    from starlette.concurrency import iterate_in_threadpool
+
+    finished = False
+    try:
+        async for chunk in iterate_in_threadpool(iterator):
+            yield chunk
+        finished = True
+    finally:
+        if not finished:
+            cancel_event.set()
+
+
+def locked_stream(lock, start, cancel_event):
+    """
+    Yield the items of the generator `start()` returns, run in a thread that holds
+    `lock` from calling `start` until the generator ends. The caller's generator
+    never holds the lock across a yield: when it is abandoned or closed without
+    being exhausted, e.g. after the client went away, `cancel_event` is set (if
+    closed) and the thread releases the lock once the stream stops, instead of it
+    staying held until the caller's generator is garbage collected.
+    """
+    items = queue.Queue()
+    done = object()
+
+    def pump():
+        try:
+            with lock:
+                if cancel_event.is_set():
+                    return
+                stream = start()
+                try:
+                    for item in stream:
+                        items.put((item, None))
+                        if cancel_event.is_set():
+                            break
+                finally:
+                    stream.close()
+        except Exception as e:
+            items.put((None, e))
+        finally:
+            items.put((done, None))
+
+    threading.Thread(target=pump, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        cancel_event.set()
@@ -13,14 +13,15 @@ from llava.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN
 from torch.utils.data import Dataset
 from llava import conversation as conversation_lib
 from llava.model import *
-from llava.mm_utils import tokenizer_image_token
+from llava.mm_utils import tokenizer_image_token, PromptTokenCache, CancelStoppingCriteria
 from llava.model.language_model.llava_phi3 import LlavaPhiForCausalLM, LlavaPhiConfig
 from PIL import Image
 import pickle
 import argparse
+import threading
 from packaging import version
 IS_TOKENIZER_GREATER_THAN_0_14 = version.parse(tokenizers.__version__) >= version.parse('0.14')
-from llava.demo.utils import find_all_linear_names, add_special_tokens_and_resize_model, load_weights, expand2square
+from llava.demo.utils import find_all_linear_names, add_special_tokens_and_resize_model, load_weights, expand2square, load_fast_tokenizer
 
 
 
@@ -31,8 +32,13 @@ class HealthGPT:
         self.args = args
         self._check_file_exists(args)
         self.model, self.tokenizer = self._load_model(args=args)
+        # Pre-tokenized template pieces, keyed by the text appended after the prompt
+        self.prompt_caches = {}
         # Cache the primary device used for inputs.
         self.device = self._get_model_device()
+        self._prepare_vision_modules()
+        if getattr(args, "compile_decode", False):
+            self._compile_decode()
 
     def _get_model_device(self) -> torch.device:
         # For models loaded with accelerate/device_map, parameters may be sharded;
@@ -43,6 +49,66 @@ class HealthGPT:
             # Extremely defensive; should not happen for a valid model.
             return torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+    def _prepare_vision_modules(self):
+        # Place the vision tower and projector once at load time instead of on every request.
+        vision_tower = self.model.get_vision_tower()
+        vision_tower.to(device=self.device, dtype=self.model_dtype)
+        self.channels_last = getattr(self.args, "channels_last", False)
+        if self.channels_last:
+            # oneDNN picks its fastest convolution kernels for NHWC inputs
+            vision_tower.to(memory_format=torch.channels_last)
+        mm_projector = getattr(self.model.get_model(), 'mm_projector', None)
+        if mm_projector is not None:
+            mm_projector.to(device=self.device, dtype=self.model_dtype)
+        self.image_processor = vision_tower.image_processor
+        self.image_background = tuple(int(x * 255) for x in self.image_processor.image_mean)
+
+    def _compile_decode(self):
+        # Dynamic shapes keep the growing KV cache from triggering a recompile at every decode step.
+        language_model = self.model.get_model()
+        language_model.forward = torch.compile(language_model.forward, dynamic=True)
+
+    def preprocess_image(self, image):
+        """Pixel tensor (C, H, W) on the CPU, e.g. built in DataLoader workers for `infer_batch`."""
+        image = expand2square(image, self.image_background)
+        return self.image_processor.preprocess(image, return_tensors='pt')['pixel_values'][0]
+
+    def _preprocess_image(self, image):
+        image = expand2square(image, self.image_background)
+        image_tensor = self.image_processor.preprocess(image, return_tensors='pt')['pixel_values'][0].unsqueeze_(0)
+        if self.channels_last:
+            image_tensor = image_tensor.contiguous(memory_format=torch.channels_last)
+        image_tensor = image_tensor.to(dtype=self.model_dtype, device=self.device, non_blocking=True)
+        return image, image_tensor
+
+    def _tokenizer_probe_texts(self, args):
+        # Full prompts of the real template: image token splits, leading spaces and newlines
+        # around them, non-ASCII text, and the VQ index tokens of generation answers
+        messages = [
+            ("<image>\nCould you explain what this mass in the MRI means for my health? Is it very serious?",
+             "The scan shows a 2.3 cm lesion; follow-up is recommended."),
+            ("  Compare these two scans:\n<image>\n <image> What changed?", " The effusion has resolved."),
+            ("<image>\n这张胸片显示了什么？ Ist das Röntgenbild auffällig? — 80 µg/m², ≥ 5 mm", "无明显异常。"),
+            ("Reconstruct the MRI image from the CT image.\n<image>", None),
+        ]
+        texts = []
+        for question, answer in messages:
+            conv = conversation_lib.conv_templates[args.instruct_template].copy()
+            conv.append_message(conv.roles[0], question)
+            conv.append_message(conv.roles[1], answer)
+            texts.append(conv.get_prompt())
+        index_tokens = "".join(f"<idx_{i}>" for i in (0, 1, args.vq_idx_nums - 1))
+        texts.append(texts[-1] + "<start_index>" + index_tokens + "<end_index><pixel_newline>")
+        return texts
+
+    def _prompt_input_ids(self, qs, suffix=""):
+        prompt_cache = self.prompt_caches.get(suffix)
+        if prompt_cache is None:
+            prompt_cache = PromptTokenCache(
+                self.tokenizer, conversation_lib.conv_templates[self.args.instruct_template], suffix=suffix)
+            self.prompt_caches[suffix] = prompt_cache
+        return prompt_cache(qs, return_tensors='pt').to(self.device).unsqueeze_(0)
+
     def _check_file_exists(self, config):
         model_name_or_path = getattr(config, "model_name_or_path", None)
         if model_name_or_path and not os.path.exists(model_name_or_path):
@@ -63,6 +129,10 @@ class HealthGPT:
             torch.float16 if args.dtype == 'FP16' else torch.bfloat16)
         self.model_dtype=model_dtype
 
+        num_threads = getattr(args, "num_threads", None)
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
         device = getattr(args, "device", "cuda")
         device_map = getattr(args, "device_map", None)
         from_pretrained_kwargs = {}
@@ -89,6 +159,8 @@ class HealthGPT:
             bias='none',
             task_type="CAUSAL_LM",
             lora_nums=args.hlora_nums,
+            quant_bits=getattr(args, "quant_bits", None),
+            quant_group_size=getattr(args, "quant_group_size", 128),
         )
         model = get_peft_model(model, lora_config)
 
@@ -99,6 +171,9 @@ class HealthGPT:
         )
         num_new_tokens = add_special_tokens_and_resize_model(tokenizer, model, args.vq_idx_nums)
         # print(f"Number of new tokens added for unified task: {num_new_tokens}")
+        if getattr(args, "use_fast_tokenizer", False):
+            # The slow tokenizer scans every added special token on each call, the fast one matches them in one pass
+            tokenizer = load_fast_tokenizer(args.model_name_or_path, tokenizer, self._tokenizer_probe_texts(args))
 
         if args.task_type == "comprehension":
             from llava.demo.utils import com_vision_args
@@ -159,29 +234,20 @@ class HealthGPT:
             if self.tokenizer is not None:
                 del self.tokenizer
 
-    def infer(self, question, image):
+    def _stopping_criteria(self, cancel_event):
+        if cancel_event is None:
+            return None
+        return transformers.StoppingCriteriaList([CancelStoppingCriteria(cancel_event)])
+
+    def infer(self, question, image, streamer=None, cancel_event=None):
         print(f"question: {question}, image: {image is not None}")
         if image:
             qs = DEFAULT_IMAGE_TOKEN + '\n' + question
         else:
             qs = question
-        conv = conversation_lib.conv_templates[self.args.instruct_template].copy()
-        conv.append_message(conv.roles[0], qs)
-        conv.append_message(conv.roles[1], None)
-        prompt = conv.get_prompt()
-        input_ids = tokenizer_image_token(
-            prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt'
-        ).to(self.device).unsqueeze_(0)
+        input_ids = self._prompt_input_ids(qs)
         if image:
-            # Ensure vision tower and mm_projector are on the correct device
-            vision_tower = self.model.get_vision_tower()
-            if vision_tower is not None:
-                vision_tower.to(device=self.device, dtype=self.model_dtype)
-            if hasattr(self.model.get_model(), 'mm_projector') and self.model.get_model().mm_projector is not None:
-                self.model.get_model().mm_projector.to(device=self.device, dtype=self.model_dtype)
-            image = expand2square(image, tuple(int(x * 255) for x in vision_tower.image_processor.image_mean))
-            image_tensor = vision_tower.image_processor.preprocess(image, return_tensors='pt')['pixel_values'][0].unsqueeze_(0)
-            image_tensor = image_tensor.to(dtype=self.model_dtype, device=self.device, non_blocking=True)
+            image, image_tensor = self._preprocess_image(image)
         with torch.inference_mode():
             output_ids = self.model.base_model.model.generate(
                 input_ids,
@@ -192,33 +258,75 @@ class HealthGPT:
                 top_p=self.args.top_p,
                 num_beams=self.args.num_beams,
                 max_new_tokens=self.args.max_new_tokens,
+                streamer=streamer,
+                stopping_criteria=self._stopping_criteria(cancel_event),
                 use_cache=True)
 
         response = self.tokenizer.decode(output_ids[0], skip_special_tokens=True)[:-8]
         return response
 
-    def generate(self, question, image):
+    def infer_batch(self, questions, image_tensors):
+        """
+        `infer` for a batch of questions, decoded together. `image_tensors` holds
+        a `preprocess_image` tensor or None per question; a batch either has an
+        image for every question or for none.
+        """
+        with_images = [x is not None for x in image_tensors]
+        if any(with_images) and not all(with_images):
+            raise ValueError("Questions with and without images cannot share a batch")
+        prompts = [self._prompt_input_ids(DEFAULT_IMAGE_TOKEN + '\n' + q if x is not None else q)[0]
+                   for q, x in zip(questions, image_tensors)]
+        pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+        # Left padded, so that every row continues right after its prompt
+        max_len = max(len(x) for x in prompts)
+        input_ids = torch.full((len(prompts), max_len), pad_token_id, dtype=torch.long, device=self.device)
+        attention_mask = torch.zeros((len(prompts), max_len), dtype=torch.long, device=self.device)
+        for i, x in enumerate(prompts):
+            input_ids[i, max_len - len(x):] = x
+            attention_mask[i, max_len - len(x):] = 1
+        images = None
+        if all(with_images):
+            images = torch.stack(image_tensors, dim=0)
+            if self.channels_last:
+                images = images.contiguous(memory_format=torch.channels_last)
+            images = images.to(dtype=self.model_dtype, device=self.device, non_blocking=True)
+
+        model = self.model.base_model.model
+        # Only this call is left padded, `infer` and `stream` share the model
+        padding_side = getattr(model.config, 'tokenizer_padding_side', 'right')
+        model.config.tokenizer_padding_side = "left"
+        try:
+            with torch.inference_mode():
+                output_ids = model.generate(
+                    input_ids,
+                    attention_mask=attention_mask,
+                    images=images,
+                    do_sample=self.args.do_sample,
+                    temperature=self.args.temperature,
+                    top_p=self.args.top_p,
+                    num_beams=self.args.num_beams,
+                    max_new_tokens=self.args.max_new_tokens,
+                    pad_token_id=pad_token_id,
+                    use_cache=True)
+        finally:
+            model.config.tokenizer_padding_side = padding_side
+
+        responses = []
+        for row in output_ids.tolist():
+            # Rows that finished early are padded up to the longest one
+            while row and row[-1] == pad_token_id:
+                row.pop()
+            responses.append(self.tokenizer.decode(row, skip_special_tokens=True)[:-8])
+        return responses
+
+    def generate(self, question, image, streamer=None, cancel_event=None):
         if image:
             qs = DEFAULT_IMAGE_TOKEN + '\n' + question
         else:
             qs = question
-        conv = conversation_lib.conv_templates[self.args.instruct_template].copy()
-        conv.append_message(conv.roles[0], qs)
-        conv.append_message(conv.roles[1], None)
-        prompt = conv.get_prompt() + '<start_index>'
-        input_ids = tokenizer_image_token(
-            prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt'
-        ).to(self.device).unsqueeze_(0)
+        input_ids = self._prompt_input_ids(qs, suffix='<start_index>')
         if image:
-            # Ensure vision tower and mm_projector are on the correct device
-            vision_tower = self.model.get_vision_tower()
-            if vision_tower is not None:
-                vision_tower.to(device=self.device, dtype=self.model_dtype)
-            if hasattr(self.model.get_model(), 'mm_projector') and self.model.get_model().mm_projector is not None:
-                self.model.get_model().mm_projector.to(device=self.device, dtype=self.model_dtype)
-            image = expand2square(image, tuple(int(x * 255) for x in vision_tower.image_processor.image_mean))
-            image_tensor = vision_tower.image_processor.preprocess(image, return_tensors='pt')['pixel_values'][0].unsqueeze_(0)
-            image_tensor = image_tensor.to(dtype=self.model_dtype, device=self.device, non_blocking=True)
+            image, image_tensor = self._preprocess_image(image)
         with torch.inference_mode():
             output_ids = self.model.base_model.model.generate(
                 input_ids,
@@ -229,7 +337,11 @@ class HealthGPT:
                 top_p=self.args.top_p,
                 num_beams=self.args.num_beams,
                 max_new_tokens=self.args.max_new_tokens,
+                streamer=streamer,
+                stopping_criteria=self._stopping_criteria(cancel_event),
                 use_cache=True)
+        if cancel_event is not None and cancel_event.is_set():
+            return None
 
         response = [int(idx) for idx in re.findall(r'\d+', self.tokenizer.decode(output_ids[0])[:-8])]
         # print("response: ",len(response), response)
@@ -238,6 +350,42 @@ class HealthGPT:
         image = Image.open(self.args.save_path).convert('RGB')
         return image
 
+    def stream(self, task, question, image, cancel_event=None):
+        """
+        Run `infer` or `generate` (`task`) in a background thread. Yields
+        (text so far, None) after every decode step, then (text, result).
+        Closing the generator early, e.g. when the client disconnects, stops
+        decoding at the next step.
+        """
+        cancel_event = cancel_event if cancel_event is not None else threading.Event()
+        streamer = transformers.TextIteratorStreamer(
+            self.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=60)
+        result = {}
+
+        def run():
+            try:
+                result["output"] = getattr(self, task)(question, image, streamer=streamer, cancel_event=cancel_event)
+            except Exception as e:
+                result["error"] = e
+                streamer.end()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        text = ""
+        finished = False
+        try:
+            for new_text in streamer:
+                text += new_text
+                yield text, None
+            finished = True
+        finally:
+            if not finished:
+                cancel_event.set()
+            thread.join()
+        if "error" in result:
+            raise result["error"]
+        yield text, result["output"]
+
 
 # HealthGPT agent
 class HealthGPT_Agent:
@@ -271,3 +419,8 @@ class HealthGPT_Agent:
         elif option == "Generate Image":
             response = self.agent.generate(question, image)
         return response
+
+    def process_stream(self, option, question, image, cancel_event=None):
+        """Like `process`, but yields (partial text, None) while decoding and finally (text, response)."""
+        task = "infer" if option == "Analyze Image" else "generate"
+        return self.agent.stream(task, question, image, cancel_event)
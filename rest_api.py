@@ -0,0 +1,177 @@
+"""
+OpenAI-style REST API for HealthGPT, served by app.py in the same process as the Gradio UI.
+
+- GET  /v1/models               the variants of `configs`
+- POST /v1/chat/completions     OpenAI chat request, the last user message holds the question
+                                and at most one image as a base64 `data:` URL; `"stream": true`
+                                streams the answer as server-sent events
+- POST /v1/images/generations   `?prompt=...&model=HealthGPT-M3`, the request body is the raw
+                                input image (optional), the response the generated PNG
+
+Requests go straight to the agent; there is no Gradio queue, event protocol or
+file upload round trip in between.
+"""
+import base64
+import binascii
+from io import BytesIO
+import json
+import threading
+import time
+import uuid
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+from PIL import Image, UnidentifiedImageError
+from starlette.concurrency import run_in_threadpool
+
+from llava.utils import locked_stream, stream_until_disconnect
+
+
+# `infer` drops the last 8 characters of the decoded answer, so streamed text lags behind by as much
+HOLD_BACK = 8
+
+
+def resolve_model(configs, model, suffix):
+    """`HealthGPT-M3` or `HealthGPT-M3-COM` -> `HealthGPT-M3-COM` for suffix COM."""
+    model_name = model if model.endswith("-" + suffix) else f"{model}-{suffix}"
+    if model_name not in configs:
+        raise HTTPException(404, f"Model {model} does not support this endpoint")
+    return model_name
+
+
+def load_image(data):
+    try:
+        return Image.open(BytesIO(data)).convert("RGB")
+    except (UnidentifiedImageError, OSError):
+        raise HTTPException(400, "Invalid image")
+
+
+def parse_messages(messages):
+    """Question and image (or None) of the last user message."""
+    messages = [m for m in messages if m.get("role") == "user"]
+    if not messages:
+        raise HTTPException(400, "No user message")
+    content = messages[-1].get("content", "")
+    if isinstance(content, str):
+        return content, None
+
+    texts, images = [], []
+    for part in content:
+        if part.get("type") == "text":
+            texts.append(part["text"])
+        elif part.get("type") == "image_url":
+            url = part["image_url"]["url"] if isinstance(part["image_url"], dict) else part["image_url"]
+            if not url.startswith("data:") or "," not in url:
+                raise HTTPException(400, "Images must be sent as base64 data: URLs")
+            try:
+                images.append(base64.b64decode(url.split(",", 1)[1]))
+            except binascii.Error:
+                raise HTTPException(400, "Invalid base64 image")
+    if len(images) > 1:
+        raise HTTPException(400, "HealthGPT takes at most one image per request")
+    return "\n".join(texts), load_image(images[0]) if images else None
+
+
+def create_router(agent, configs, lock):
+    """Routes serving `agent`; `lock` is held while a request uses it, as the agent swaps models."""
+    router = APIRouter(prefix="/v1")
+
+    def run(model_name, option, question, image, cancel_event):
+        # The lock is held by the thread decoding the stream, never across a yield to the response
+        def start():
+            agent.load_model(model_name)
+            return agent.process_stream(option, question, image, cancel_event)
+        return locked_stream(lock, start, cancel_event)
+
+    def final_output(stream):
+        output = None
+        for _, output in stream:
+            pass
+        return output
+
+    @router.get("/models")
+    async def list_models():
+        return {
+            "object": "list",
+            "data": [{"id": name, "object": "model", "owned_by": "HealthGPT"} for name in configs],
+        }
+
+    @router.post("/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model_name = resolve_model(configs, body.get("model", "HealthGPT-M3"), "COM")
+        question, image = parse_messages(body.get("messages", []))
+        if not question.strip():
+            raise HTTPException(400, "Please input your question.")
+
+        completion_id = "chatcmpl-" + uuid.uuid4().hex
+        created = int(time.time())
+        # Set when the client disconnects, decoding then stops at the next step
+        cancel_event = threading.Event()
+        stream = run(model_name, "Analyze Image", question, image, cancel_event)
+
+        if not body.get("stream", False):
+            try:
+                answer = await run_in_threadpool(final_output, stream)
+            except ValueError as e:
+                raise HTTPException(400, str(e))
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model_name,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": answer},
+                    "finish_reason": "stop",
+                }],
+            }
+
+        def chunk(delta, finish_reason=None):
+            return "data: " + json.dumps({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model_name,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }) + "\n\n"
+
+        def events():
+            yield chunk({"role": "assistant"})
+            sent = 0
+            try:
+                for text, answer in stream:
+                    if answer is not None:
+                        if answer[sent:]:
+                            yield chunk({"content": answer[sent:]})
+                        continue
+                    end = len(text) - HOLD_BACK
+                    if end > sent:
+                        yield chunk({"content": text[sent:end]})
+                        sent = end
+            except ValueError as e:
+                yield "data: " + json.dumps({"error": {"message": str(e)}}) + "\n\n"
+                return
+            yield chunk({}, "stop")
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream_until_disconnect(events(), cancel_event),
+                                 media_type="text/event-stream")
+
+    @router.post("/images/generations")
+    async def images_generations(request: Request, prompt: str, model: str = "HealthGPT-M3"):
+        model_name = resolve_model(configs, model, "GEN")
+        data = await request.body()
+        image = load_image(data) if data else None
+        try:
+            output = await run_in_threadpool(
+                final_output, run(model_name, "Generate Image", prompt, image, threading.Event()))
+        except ValueError as e:
+            raise HTTPException(400, str(e))
+        if output is None:
+            raise HTTPException(503, "No image was generated.")
+        buffered = BytesIO()
+        output.save(buffered, format="PNG")
+        return Response(buffered.getvalue(), media_type="image/png")
+
+    return router
@@ -0,0 +1,99 @@
+"""
+A stand-in for HealthGPT that loads no weights, for load tests and CI.
+
+It waits a fixed prefill delay, then streams a canned answer one word per
+token delay; GEN variants return a blank image. Set HEALTHGPT_STUB_MODEL=1 to
+serve it from app.py, or pass --stub-model to llava/serve/healthgpt_worker.py.
+HEALTHGPT_STUB_PREFILL_DELAY, HEALTHGPT_STUB_TOKEN_DELAY (seconds) and
+HEALTHGPT_STUB_NUM_TOKENS tune its speed.
+"""
+import os
+import threading
+from types import SimpleNamespace
+
+from PIL import Image
+
+ANSWER = ("The image shows a well defined lesion with surrounding edema. Its margins are smooth and "
+          "there is no sign of hemorrhage. The findings are most consistent with a benign process, "
+          "but a follow up scan and a consultation with a specialist are recommended to confirm "
+          "the diagnosis and plan further treatment if needed.")
+
+
+class StubTokenizer:
+    def __call__(self, text, add_special_tokens=True):
+        return SimpleNamespace(input_ids=text.split())
+
+
+class StubHealthGPT:
+    def __init__(self, args):
+        self.args = args
+        self.prefill_delay = float(os.environ.get("HEALTHGPT_STUB_PREFILL_DELAY", 0.1))
+        self.token_delay = float(os.environ.get("HEALTHGPT_STUB_TOKEN_DELAY", 0.02))
+        self.num_tokens = int(os.environ.get("HEALTHGPT_STUB_NUM_TOKENS", 32))
+        self.tokenizer = StubTokenizer()
+        # HealthGPT_Agent checks `agent.model.tokenizer` to tell a loaded model
+        self.model = self
+
+    def reset(self):
+        pass
+
+    def stream(self, task, question, image, cancel_event=None):
+        """Same protocol as `HealthGPT.stream`: (text so far, None) per token, then (text, result)."""
+        cancel_event = cancel_event if cancel_event is not None else threading.Event()
+        if cancel_event.wait(self.prefill_delay):
+            return
+        words = (ANSWER.split() * (self.num_tokens // len(ANSWER.split()) + 1))[:self.num_tokens]
+        text = ""
+        for i, word in enumerate(words):
+            if i > 0 and cancel_event.wait(self.token_delay):
+                return
+            if task == "infer":
+                text = f"{text} {word}" if text else word
+            yield text, None
+        if task == "infer":
+            yield text, text
+        else:
+            yield text, Image.new("RGB", (256, 256))
+
+    def infer(self, question, image, streamer=None, cancel_event=None):
+        output = None
+        for _, output in self.stream("infer", question, image, cancel_event):
+            pass
+        return output
+
+    def generate(self, question, image, streamer=None, cancel_event=None):
+        output = None
+        for _, output in self.stream("generate", question, image, cancel_event):
+            pass
+        return output
+
+
+class StubHealthGPT_Agent:
+    """`HealthGPT_Agent` serving `StubHealthGPT`."""
+
+    def __init__(self, configs: dict, model_name: str="HealthGPT-M3-COM"):
+        self.configs = configs
+        self.model_name = None
+        self.agent = None
+        if model_name:
+            self.load_model(model_name)
+
+    def load_model(self, model_name):
+        if self.model_name == model_name:
+            return
+        if model_name == "HealthGPT-L14-GEN":
+            raise ValueError(f"Do not support generation task for HealthGPT-L14.")
+        model_config = self.configs.get(model_name, None)
+        if model_config is None:
+            raise ValueError(f"Invalid model type: {model_name}")
+        self.agent = StubHealthGPT(model_config)
+        self.model_name = model_name
+
+    def process(self, option, question, image):
+        if option == "Analyze Image":
+            return self.agent.infer(question, image)
+        return self.agent.generate(question, image)
+
+    def process_stream(self, option, question, image, cancel_event=None):
+        task = "infer" if option == "Analyze Image" else "generate"
+        return self.agent.stream(task, question, image, cancel_event)
@@ -0,0 +1,150 @@
+"""
+Parity and decode-time benchmark of the attention backends in taming.modules.util.
+
+Parity: AttnBlock and CausalSelfAttention outputs with the "fused" and "chunked"
+backends are compared to the explicit softmax(q k^T / sqrt(d)) v they replaced and
+have to agree within --atol.
+Benchmark: the VQGAN decoder of ckpt/model.yaml decodes random latents of 256 and
+512 px images with "fused", "chunked" and "full" (the whole attention matrix at once,
+as before), reporting time per batch and peak CUDA memory.
+
+python scripts/bench_attention.py --device cuda --batch_size 4
+"""
+import argparse
+import math
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+from omegaconf import OmegaConf
+
+import taming.modules.util as util
+from taming.modules.diffusionmodules.model import AttnBlock, Decoder
+from taming.modules.transformer.mingpt import GPTConfig, CausalSelfAttention
+
+
+BACKENDS = {
+    "fused": ("fused", util.ATTENTION_CHUNK_SIZE),
+    "chunked": ("chunked", util.ATTENTION_CHUNK_SIZE),
+    "full": ("chunked", 2**31),
+    # uneven chunks, to check that the rows are put back together correctly
+    "chunked-100": ("chunked", 100),
+}
+
+
+def assert_parity(errors, atol):
+    failed = {name: error for name, error in errors.items() if not error <= atol}
+    assert not failed, f"attention differs from the reference by more than {atol}: {failed}"
+
+
+def use_backend(name):
+    util.ATTENTION_BACKEND, util.ATTENTION_CHUNK_SIZE = BACKENDS[name]
+
+
+def reference_attn_block(block, x):
+    h_ = block.norm(x)
+    q, k, v = block.q(h_), block.k(h_), block.v(h_)
+    b, c, h, w = q.shape
+    w_ = torch.bmm(q.reshape(b, c, h*w).permute(0, 2, 1), k.reshape(b, c, h*w)) * (int(c)**(-0.5))
+    w_ = F.softmax(w_, dim=2)
+    h_ = torch.bmm(v.reshape(b, c, h*w), w_.permute(0, 2, 1)).reshape(b, c, h, w)
+    return x + block.proj_out(h_)
+
+
+def reference_self_attention(attn, x, layer_past=None):
+    B, T, C = x.size()
+    k = attn.key(x).view(B, T, attn.n_head, C // attn.n_head).transpose(1, 2)
+    q = attn.query(x).view(B, T, attn.n_head, C // attn.n_head).transpose(1, 2)
+    v = attn.value(x).view(B, T, attn.n_head, C // attn.n_head).transpose(1, 2)
+    P = 0
+    if layer_past is not None:
+        P = layer_past[0].size(-2)
+        k = torch.cat((layer_past[0], k), dim=-2)
+        v = torch.cat((layer_past[1], v), dim=-2)
+    att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
+    att = att.masked_fill(~attn.mask[:, :, P:P+T, :P+T], float('-inf'))
+    y = (F.softmax(att, dim=-1) @ v).transpose(1, 2).contiguous().view(B, T, C)
+    return attn.proj(y)
+
+
+@torch.no_grad()
+def check_parity(device):
+    errors = {}
+    block = AttnBlock(512).to(device).eval()
+    for side in (16, 32):
+        x = torch.randn(2, 512, side, side, device=device)
+        reference = reference_attn_block(block, x)
+        for backend in ("fused", "chunked-100"):
+            use_backend(backend)
+            errors[f"AttnBlock {side}x{side} {backend}"] = (block(x) - reference).abs().max().item()
+
+    for n_unmasked in (0, 256):
+        config = GPTConfig(vocab_size=1024, block_size=512, n_layer=1, n_head=8, n_embd=256,
+                           attn_pdrop=0., resid_pdrop=0., n_unmasked=n_unmasked)
+        attn = CausalSelfAttention(config).to(device).eval()
+        x = torch.randn(2, 512, 256, device=device)
+        reference = reference_self_attention(attn, x)
+        # the last 16 tokens again, after a cache of the others
+        _, present = attn(x[:, :-16])
+        reference_past = reference_self_attention(attn, x[:, -16:], layer_past=present)
+        for backend in ("fused", "chunked-100"):
+            use_backend(backend)
+            errors[f"CausalSelfAttention n_unmasked={n_unmasked} {backend}"] = \
+                (attn(x)[0] - reference).abs().max().item()
+            errors[f"CausalSelfAttention n_unmasked={n_unmasked} with past {backend}"] = \
+                (attn(x[:, -16:], layer_past=present)[0] - reference_past).abs().max().item()
+    use_backend("fused")
+    return errors
+
+
+@torch.no_grad()
+def bench_decode(decoder, ddconfig, size, batch_size, backend, device, repeats):
+    use_backend(backend)
+    side = size // 2**(len(ddconfig.ch_mult)-1)
+    z = torch.randn(batch_size, ddconfig.z_channels, side, side, device=device)
+    cuda = device.startswith("cuda")
+    decoder(z)  # warm up
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    t = time.time()
+    for _ in range(repeats):
+        decoder(z)
+    if cuda:
+        torch.cuda.synchronize()
+    seconds = (time.time() - t) / repeats
+    peak = torch.cuda.max_memory_allocated() / 2**20 if cuda else float("nan")
+    return seconds, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--config", type=str,
+                        default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                             "ckpt", "model.yaml"))
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[256, 512])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--atol", type=float, default=1e-4,
+                        help="Largest absolute difference to the reference allowed by the parity checks (fp32).")
+    opt = parser.parse_args()
+
+    errors = check_parity(opt.device)
+    for name, error in errors.items():
+        print(f"{name}: max abs error {error:.2e}")
+    assert_parity(errors, opt.atol)
+
+    ddconfig = OmegaConf.load(opt.config).model.params.ddconfig
+    decoder = Decoder(**ddconfig).to(opt.device).eval()
+    print(f"\n{'size':>6} {'backend':>8} {'s/batch':>9} {'peak MiB':>9}")
+    for size in opt.sizes:
+        for backend in ("fused", "chunked", "full"):
+            try:
+                seconds, peak = bench_decode(decoder, ddconfig, size, opt.batch_size, backend,
+                                             opt.device, opt.repeats)
+                print(f"{size:>6} {backend:>8} {seconds:>9.3f} {peak:>9.0f}")
+            except torch.cuda.OutOfMemoryError:
+                print(f"{size:>6} {backend:>8} {'OOM':>9}")
+                torch.cuda.empty_cache()
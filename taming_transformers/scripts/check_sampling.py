@@ -0,0 +1,104 @@
+"""
+Check that the kv cached samplers pick the same indices as rerunning the transformer at every step.
+
+A randomly initialized GPT is sampled both ways, greedily and with a fixed seed, for
+plain sequences, through Net2NetTransformer.sample and for windowed sampling of a
+grid larger than the window. Before that, forward_with_past is run on several new
+tokens at once after a cache of the unmasked conditioning (and more), and has to
+give the logits of a full forward pass.
+
+python scripts/check_sampling.py --device cuda
+"""
+import argparse
+import time
+from types import SimpleNamespace
+
+import torch
+
+from taming.models.cond_transformer import Net2NetTransformer
+from taming.modules.transformer.mingpt import GPT, sample
+
+
+def timed(fn, device):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    t = time.time()
+    out = fn()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return out, time.time() - t
+
+
+@torch.no_grad()
+def check_forward_with_past(gpt, x, past_lengths, atol):
+    reference, _ = gpt(x)
+    for past_length in past_lengths:
+        logits_past, _, present = gpt.forward_with_past(x[:, :past_length])
+        logits, _, _ = gpt.forward_with_past(x[:, past_length:], past=[present], past_length=past_length)
+        error = (torch.cat((logits_past, logits), dim=1) - reference).abs().max().item()
+        print(f"forward_with_past, {x.shape[1] - past_length} tokens after {past_length}: max abs error {error:.2e}")
+        assert error <= atol, "forward_with_past differs from a full forward pass"
+
+
+def check(name, fn, device, seed=0):
+    torch.manual_seed(seed)
+    reference, t_reference = timed(lambda: fn(False), device)
+    torch.manual_seed(seed)
+    cached, t_cached = timed(lambda: fn(True), device)
+    mismatch = (reference != cached).float().mean().item()
+    print(f"{name}: {mismatch:.2%} of indices differ, {t_reference:.2f}s without cache, {t_cached:.2f}s with")
+    return mismatch
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--vocab_size", type=int, default=1024)
+    parser.add_argument("--n_layer", type=int, default=4)
+    parser.add_argument("--window", type=int, default=16)
+    parser.add_argument("--grid", type=int, default=20,
+                        help="Side of the grid sampled with windows, larger than --window to move them.")
+    parser.add_argument("--tolerance", type=float, default=0.0,
+                        help="Share of indices allowed to differ, rounding can flip near ties.")
+    parser.add_argument("--atol", type=float, default=1e-4,
+                        help="Largest absolute logit difference allowed between cached and full forward passes.")
+    opt = parser.parse_args()
+
+    window_len = opt.window ** 2
+    gpt = GPT(opt.vocab_size, block_size=2 * window_len, n_layer=opt.n_layer, n_head=8, n_embd=256,
+              n_unmasked=window_len).to(opt.device).eval()
+    cond = torch.randint(opt.vocab_size, (opt.batch_size, window_len), device=opt.device)
+
+    check_forward_with_past(gpt, torch.randint(opt.vocab_size, (opt.batch_size, 2 * window_len), device=opt.device),
+                            (window_len, window_len + 7, 2 * window_len - 3), opt.atol)
+
+    mismatches = [
+        check("greedy", lambda use_cache: sample(gpt, cond, window_len, sample=False, use_cache=use_cache),
+              opt.device),
+        check("top_k=100", lambda use_cache: sample(gpt, cond, window_len, sample=True, top_k=100,
+                                                    use_cache=use_cache), opt.device),
+        check("top_p=0.9", lambda use_cache: sample(gpt, cond, window_len, sample=True, top_p=0.9,
+                                                    use_cache=use_cache), opt.device),
+    ]
+
+    model = SimpleNamespace(transformer=gpt, pkeep=1.0)
+    empty = torch.zeros((opt.batch_size, 0), dtype=torch.long, device=opt.device)
+    for sample_ in (False, True):
+        mismatches.append(check(
+            f"Net2NetTransformer.sample, sample={sample_}",
+            lambda use_cache: Net2NetTransformer.sample(model, empty, cond, window_len, sample=sample_, top_k=100,
+                                                        use_cache=use_cache),
+            opt.device))
+
+    grid = (opt.batch_size, opt.grid, opt.grid)
+    cidx = torch.randint(opt.vocab_size, grid, device=opt.device)
+    for sample_ in (False, True):
+        mismatches.append(check(
+            f"windowed, sample={sample_}",
+            lambda use_cache: Net2NetTransformer.sample_windowed(
+                model, torch.zeros(grid, dtype=torch.long, device=opt.device), cidx, top_k=100,
+                sample=sample_, window=opt.window, use_cache=use_cache),
+            opt.device))
+
+    assert max(mismatches) <= opt.tolerance, "cached and uncached sampling differ"
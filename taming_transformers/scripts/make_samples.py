@@ -17,7 +17,7 @@ def save_image(x, path):
 
 
 @torch.no_grad()
-def run_conditional(model, dsets, outdir, top_k, temperature, batch_size=1):
+def run_conditional(model, dsets, outdir, top_k, temperature, batch_size=1, use_cache=True):
     if len(dsets.datasets) > 1:
         split = sorted(dsets.datasets.keys())[0]
         dset = dsets.datasets[split]
@@ -73,47 +73,8 @@ def run_conditional(model, dsets, outdir, top_k, temperature, batch_size=1):
 
         sample = True
 
-        for i in range(start_i,cshape[2]-0):
-            if i <= 8:
-                local_i = i
-            elif cshape[2]-i < 8:
-                local_i = 16-(cshape[2]-i)
-            else:
-                local_i = 8
-            for j in range(start_j,cshape[3]-0):
-                if j <= 8:
-                    local_j = j
-                elif cshape[3]-j < 8:
-                    local_j = 16-(cshape[3]-j)
-                else:
-                    local_j = 8
-
-                i_start = i-local_i
-                i_end = i_start+16
-                j_start = j-local_j
-                j_end = j_start+16
-                patch = idx[:,i_start:i_end,j_start:j_end]
-                patch = patch.reshape(patch.shape[0],-1)
-                cpatch = cidx[:, i_start:i_end, j_start:j_end]
-                cpatch = cpatch.reshape(cpatch.shape[0], -1)
-                patch = torch.cat((cpatch, patch), dim=1)
-                logits,_ = model.transformer(patch[:,:-1])
-                logits = logits[:, -256:, :]
-                logits = logits.reshape(cshape[0],16,16,-1)
-                logits = logits[:,local_i,local_j,:]
-
-                logits = logits/temperature
-
-                if top_k is not None:
-                    logits = model.top_k_logits(logits, top_k)
-                # apply softmax to convert to probabilities
-                probs = torch.nn.functional.softmax(logits, dim=-1)
-                # sample from the distribution or take the most likely
-                if sample:
-                    ix = torch.multinomial(probs, num_samples=1)
-                else:
-                    _, ix = torch.topk(probs, k=1, dim=-1)
-                idx[:,i,j] = ix
+        idx = model.sample_windowed(idx, cidx, start_i, start_j, temperature=temperature, sample=sample,
+                                    top_k=top_k, use_cache=use_cache)
 
         xsample = model.decode_to_img(idx[:,:cshape[2],:cshape[3]], cshape)
         for i in range(xsample.shape[0]):
@@ -173,6 +134,11 @@ def get_parser():
         default=1.0,
         help="Sampling temperature.",
     )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Rerun the transformer over the whole window at every step instead of caching keys and values.",
+    )
     return parser
 
 
@@ -289,4 +255,4 @@ if __name__ == "__main__":
     print("Writing samples to ", outdir)
     for k in ["originals", "reconstructions", "samples"]:
         os.makedirs(os.path.join(outdir, k), exist_ok=True)
-    run_conditional(model, dsets, outdir, opt.top_k, opt.temperature)
+    run_conditional(model, dsets, outdir, opt.top_k, opt.temperature, use_cache=not opt.no_cache)
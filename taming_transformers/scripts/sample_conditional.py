@@ -126,6 +126,7 @@ def run_conditional(model, dsets):
     top_k = st.number_input("Top k", value=100)
     sample = st.checkbox("Sample", value=True)
     update_every = st.number_input("Update every", value=75)
+    use_cache = st.checkbox("KV cache", value=True)
 
     st.text(f"Sampling shape ({cshape[2]},{cshape[3]})")
 
@@ -140,58 +141,21 @@ def run_conditional(model, dsets):
     if st.button("Sample"):
         output = st.empty()
         start_t = time.time()
-        for i in range(start_i,cshape[2]-0):
-            if i <= 8:
-                local_i = i
-            elif cshape[2]-i < 8:
-                local_i = 16-(cshape[2]-i)
-            else:
-                local_i = 8
-            for j in range(start_j,cshape[3]-0):
-                if j <= 8:
-                    local_j = j
-                elif cshape[3]-j < 8:
-                    local_j = 16-(cshape[3]-j)
-                else:
-                    local_j = 8
-
-                i_start = i-local_i
-                i_end = i_start+16
-                j_start = j-local_j
-                j_end = j_start+16
-                elapsed_t.text(f"Time: {time.time() - start_t} seconds")
-                info.text(f"Step: ({i},{j}) | Local: ({local_i},{local_j}) | Crop: ({i_start}:{i_end},{j_start}:{j_end})")
-                patch = idx[:,i_start:i_end,j_start:j_end]
-                patch = patch.reshape(patch.shape[0],-1)
-                cpatch = cidx[:, i_start:i_end, j_start:j_end]
-                cpatch = cpatch.reshape(cpatch.shape[0], -1)
-                patch = torch.cat((cpatch, patch), dim=1)
-                logits,_ = model.transformer(patch[:,:-1])
-                logits = logits[:, -256:, :]
-                logits = logits.reshape(cshape[0],16,16,-1)
-                logits = logits[:,local_i,local_j,:]
-
-                logits = logits/temperature
-
-                if top_k is not None:
-                    logits = model.top_k_logits(logits, top_k)
-                # apply softmax to convert to probabilities
-                probs = torch.nn.functional.softmax(logits, dim=-1)
-                # sample from the distribution or take the most likely
-                if sample:
-                    ix = torch.multinomial(probs, num_samples=1)
-                else:
-                    _, ix = torch.topk(probs, k=1, dim=-1)
-                idx[:,i,j] = ix
-
-                if (i*cshape[3]+j)%update_every==0:
-                    xstart = model.decode_to_img(idx[:, :cshape[2], :cshape[3]], cshape,)
-
-                    xstart = bchw_to_st(xstart)
-                    output.image(xstart, clamp=True, output_format="PNG")
-
-                    if animate:
-                        writer.append_data((xstart[0]*255).clip(0, 255).astype(np.uint8))
+        def callback(i, j):
+            elapsed_t.text(f"Time: {time.time() - start_t} seconds")
+            info.text(f"Step: ({i},{j})")
+
+            if (i*cshape[3]+j)%update_every==0:
+                xstart = model.decode_to_img(idx[:, :cshape[2], :cshape[3]], cshape,)
+
+                xstart = bchw_to_st(xstart)
+                output.image(xstart, clamp=True, output_format="PNG")
+
+                if animate:
+                    writer.append_data((xstart[0]*255).clip(0, 255).astype(np.uint8))
+
+        model.sample_windowed(idx, cidx, start_i, start_j, temperature=temperature, sample=sample,
+                              top_k=top_k, use_cache=use_cache, callback=callback)
 
         xstart = model.decode_to_img(idx[:,:cshape[2],:cshape[3]], cshape)
         xstart = bchw_to_st(xstart)
@@ -5,6 +5,7 @@ import pytorch_lightning as pl
 
 from main import instantiate_from_config
 from taming.modules.util import SOSProvider
+from taming.modules.transformer.mingpt import sample_from_logits, sample_with_past
 
 
 def disabled_train(self, mode=True):
@@ -111,7 +112,7 @@ class Net2NetTransformer(pl.LightningModule):
 
     @torch.no_grad()
     def sample(self, x, c, steps, temperature=1.0, sample=False, top_k=None,
-               callback=lambda k: None):
+               callback=lambda k: None, top_p=None, use_cache=True):
         x = torch.cat((c,x),dim=1)
         block_size = self.transformer.get_block_size()
         assert not self.transformer.training
@@ -141,30 +142,79 @@ class Net2NetTransformer(pl.LightningModule):
                 _, ix = torch.topk(probs, k=1, dim=-1)
             # cut off conditioning
             x = ix[:, c.shape[1]-1:]
+        elif use_cache:
+            # conditioning and given indices are run once, later steps reuse their keys and values
+            ix = sample_with_past(x, self.transformer, steps, temperature=temperature, sample_logits=sample,
+                                  top_k=top_k, top_p=top_p, callback=callback)
+            x = torch.cat((x, ix), dim=1)
+            # cut off conditioning
+            x = x[:, c.shape[1]:]
         else:
             for k in range(steps):
                 callback(k)
                 assert x.size(1) <= block_size # make sure model can see conditioning
                 x_cond = x if x.size(1) <= block_size else x[:, -block_size:]  # crop context if needed
                 logits, _ = self.transformer(x_cond)
-                # pluck the logits at the final step and scale by temperature
-                logits = logits[:, -1, :] / temperature
-                # optionally crop probabilities to only the top k options
-                if top_k is not None:
-                    logits = self.top_k_logits(logits, top_k)
-                # apply softmax to convert to probabilities
-                probs = F.softmax(logits, dim=-1)
-                # sample from the distribution or take the most likely
-                if sample:
-                    ix = torch.multinomial(probs, num_samples=1)
-                else:
-                    _, ix = torch.topk(probs, k=1, dim=-1)
+                # pluck the logits at the final step
+                ix = sample_from_logits(logits[:, -1, :], temperature, sample, top_k=top_k, top_p=top_p)
                 # append to the sequence and continue
                 x = torch.cat((x, ix), dim=1)
             # cut off conditioning
             x = x[:, c.shape[1]:]
         return x
 
+    @torch.no_grad()
+    def sample_windowed(self, idx, cidx, start_i=0, start_j=0, temperature=1.0, sample=True, top_k=None,
+                        top_p=None, window=16, use_cache=True, callback=None):
+        """
+        Sample the indices idx (b, h, w) in raster order from (start_i, start_j) on, in place. Every
+        position is predicted from the window x window crop of idx and of the conditioning indices
+        cidx around it, so that grids larger than the transformer was trained on can be sampled.
+        While the crop stays in place, each step only feeds the index sampled last and reuses the
+        keys and values of the steps before. callback(i, j) is called after every step.
+        """
+        h, w = idx.shape[1:]
+
+        def local(i, size):
+            # position of i in its crop, which is centered on i away from the borders
+            if i <= window // 2:
+                return i
+            elif size - i < window // 2:
+                return window - (size - i)
+            return window // 2
+
+        past, past_crop, past_length = None, None, 0
+        for i in range(start_i, h):
+            local_i = local(i, h)
+            for j in range(start_j, w):
+                local_j = local(j, w)
+                i_start, j_start = i - local_i, j - local_j
+                patch = idx[:, i_start:i_start+window, j_start:j_start+window]
+                cpatch = cidx[:, i_start:i_start+window, j_start:j_start+window]
+                pos = local_i * patch.shape[2] + local_j
+                patch = patch.reshape(patch.shape[0], -1)
+                cpatch = cpatch.reshape(cpatch.shape[0], -1)
+                if not use_cache:
+                    patch = torch.cat((cpatch, patch), dim=1)
+                    logits, _ = self.transformer(patch[:, :-1])
+                    logits = logits[:, cpatch.shape[1]-1+pos, :]
+                elif past_crop == (i_start, j_start) and past_length == cpatch.shape[1]+pos-1:
+                    logits, _, present = self.transformer.forward_with_past(patch[:, pos-1:pos], past=past,
+                                                                            past_length=past_length)
+                    past.append(present)
+                    past_length += 1
+                    logits = logits[:, -1, :]
+                else:
+                    # the crop moved, run its conditioning and the indices before the position once
+                    x = torch.cat((cpatch, patch[:, :pos]), dim=1)
+                    logits, _, present = self.transformer.forward_with_past(x)
+                    past, past_crop, past_length = [present], (i_start, j_start), x.shape[1]
+                    logits = logits[:, -1, :]
+                idx[:, i, j] = sample_from_logits(logits, temperature, sample, top_k=top_k, top_p=top_p)[:, 0]
+                if callback is not None:
+                    callback(i, j)
+        return idx
+
     @torch.no_grad()
     def encode_to_z(self, x):
         quant_z, _, info = self.first_stage_model.encode(x)
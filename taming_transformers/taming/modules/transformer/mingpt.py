@@ -8,13 +8,13 @@ GPT model:
 - the final decoder is a linear projection into a vanilla Softmax classifier
 """
 
-import math
 import logging
 
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
-from transformers import top_k_top_p_filtering
+
+from taming.modules.util import attention
 
 logger = logging.getLogger(__name__)
 
@@ -63,7 +63,8 @@ class CausalSelfAttention(nn.Module):
                                      config.block_size))
         if hasattr(config, "n_unmasked"):
             mask[:config.n_unmasked, :config.n_unmasked] = 1
-        self.register_buffer("mask", mask.view(1, 1, config.block_size, config.block_size))
+        self.register_buffer("mask", mask.view(1, 1, config.block_size, config.block_size).bool())
+        self.n_unmasked = getattr(config, "n_unmasked", 0)
         self.n_head = config.n_head
 
     def forward(self, x, layer_past=None):
@@ -75,19 +76,23 @@ class CausalSelfAttention(nn.Module):
         v = self.value(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
 
         present = torch.stack((k, v))
+        P = 0
         if layer_past is not None:
             past_key, past_value = layer_past
+            P = past_key.size(-2)
             k = torch.cat((past_key, k), dim=-2)
             v = torch.cat((past_value, v), dim=-2)
 
-        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
-        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-        if layer_past is None:
-            att = att.masked_fill(self.mask[:,:,:T,:T] == 0, float('-inf'))
-
-        att = F.softmax(att, dim=-1)
-        att = self.attn_drop(att)
-        y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
+        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, P+T) -> (B, nh, T, hs)
+        # the (B, nh, T, P+T) attention weights are only held in full by SDPA's math kernel, see attention()
+        dropout_p = self.attn_drop.p if self.training else 0.
+        if T == 1:
+            # a single new token attends to everything before it
+            y = attention(q, k, v, dropout_p=dropout_p)
+        elif P == 0 and self.n_unmasked == 0:
+            y = attention(q, k, v, is_causal=True, dropout_p=dropout_p)
+        else:
+            y = attention(q, k, v, mask=self.mask[:,:,P:P+T,:P+T], dropout_p=dropout_p)
         y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side
 
         # output projection
@@ -192,7 +197,9 @@ class GPT(nn.Module):
             past_shape = list(past.shape)
             expected_shape = [self.config.n_layer, 2, idx.shape[0], self.config.n_head, past_length, self.config.n_embd//self.config.n_head]
             assert past_shape == expected_shape, f"{past_shape} =/= {expected_shape}"
-            position_embeddings = self.pos_emb[:, past_length, :]  # each position maps to a (learnable) vector
+            t = token_embeddings.shape[1]
+            assert past_length + t <= self.block_size, "Cannot forward, model block size is exhausted."
+            position_embeddings = self.pos_emb[:, past_length:past_length+t, :]  # each position maps to a (learnable) vector
         else:
             position_embeddings = self.pos_emb[:, :token_embeddings.shape[1], :]
 
@@ -286,34 +293,59 @@ class CodeGPT(nn.Module):
 def top_k_logits(logits, k):
     v, ix = torch.topk(logits, k)
     out = logits.clone()
-    out[out < v[:, [-1]]] = -float('Inf')
+    out[out < v[..., [-1]]] = -float('Inf')
     return out
 
+
+def top_p_logits(logits, p):
+    """ keep the smallest set of most likely tokens whose probabilities add up to at least p """
+    sorted_logits, sorted_ix = torch.sort(logits, descending=True)
+    cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+    # shift right so that the token crossing the threshold is kept, as is the most likely one
+    sorted_remove = cumulative_probs > p
+    sorted_remove[..., 1:] = sorted_remove[..., :-1].clone()
+    sorted_remove[..., 0] = False
+    remove = sorted_remove.scatter(-1, sorted_ix, sorted_remove)
+    return logits.masked_fill(remove, -float('Inf'))
+
+
+def sample_from_logits(logits, temperature=1.0, sample=True, top_k=None, top_p=None):
+    """ pick the next token (b, 1) from the logits (b, vocab_size) of the last position """
+    # scale by temperature
+    logits = logits / (temperature or 1.0)
+    # optionally crop probabilities to only the top k / top p options
+    if top_k:
+        logits = top_k_logits(logits, min(top_k, logits.size(-1)))
+    if top_p is not None and top_p < 1.0:
+        logits = top_p_logits(logits, top_p)
+    # apply softmax to convert to probabilities
+    probs = F.softmax(logits, dim=-1)
+    # sample from the distribution or take the most likely
+    if sample:
+        ix = torch.multinomial(probs, num_samples=1)
+    else:
+        _, ix = torch.topk(probs, k=1, dim=-1)
+    return ix
+
+
 @torch.no_grad()
-def sample(model, x, steps, temperature=1.0, sample=False, top_k=None):
+def sample(model, x, steps, temperature=1.0, sample=False, top_k=None, top_p=None, use_cache=True):
     """
     take a conditioning sequence of indices in x (of shape (b,t)) and predict the next token in
-    the sequence, feeding the predictions back into the model each time. Clearly the sampling
-    has quadratic complexity unlike an RNN that is only linear, and has a finite context window
-    of block_size, unlike an RNN that has an infinite context window.
+    the sequence, feeding the predictions back into the model each time. Without the kv cache
+    the sampling has quadratic complexity unlike an RNN that is only linear. When the sequence
+    outgrows block_size, the context is cropped and the model rerun at every step.
     """
     block_size = model.get_block_size()
     model.eval()
+    if use_cache and hasattr(model, "forward_with_past") and x.size(1) + steps - 1 <= block_size:
+        return torch.cat((x, sample_with_past(x, model, steps, temperature=temperature, sample_logits=sample,
+                                              top_k=top_k, top_p=top_p)), dim=1)
     for k in range(steps):
         x_cond = x if x.size(1) <= block_size else x[:, -block_size:]  # crop context if needed
         logits, _ = model(x_cond)
-        # pluck the logits at the final step and scale by temperature
-        logits = logits[:, -1, :] / temperature
-        # optionally crop probabilities to only the top k options
-        if top_k is not None:
-            logits = top_k_logits(logits, top_k)
-        # apply softmax to convert to probabilities
-        probs = F.softmax(logits, dim=-1)
-        # sample from the distribution or take the most likely
-        if sample:
-            ix = torch.multinomial(probs, num_samples=1)
-        else:
-            _, ix = torch.topk(probs, k=1, dim=-1)
+        # pluck the logits at the final step
+        ix = sample_from_logits(logits[:, -1, :], temperature, sample, top_k=top_k, top_p=top_p)
         # append to the sequence and continue
         x = torch.cat((x, ix), dim=1)
 
@@ -323,9 +355,15 @@ def sample(model, x, steps, temperature=1.0, sample=False, top_k=None):
 @torch.no_grad()
 def sample_with_past(x, model, steps, temperature=1., sample_logits=True,
                      top_k=None, top_p=None, callback=None):
+    """
+    sample `steps` tokens for the batch of conditioning prefixes x (b, t), returned without
+    the prefix. The prefix is run once, every later step only feeds the token sampled last
+    and attends to the keys and values cached for the tokens before it.
+    """
     # x is conditioning
     sample = x
     cond_len = x.shape[1]
+    assert cond_len + steps - 1 <= model.get_block_size(), "Cannot sample, model block size is exhausted."
     past = None
     for n in range(steps):
         if callback is not None:
@@ -335,15 +373,7 @@ def sample_with_past(x, model, steps, temperature=1., sample_logits=True,
             past = [present]
         else:
             past.append(present)
-        logits = logits[:, -1, :] / temperature
-        if top_k is not None:
-            logits = top_k_top_p_filtering(logits, top_k=top_k, top_p=top_p)
-
-        probs = F.softmax(logits, dim=-1)
-        if not sample_logits:
-            _, x = torch.topk(probs, k=1, dim=-1)
-        else:
-            x = torch.multinomial(probs, num_samples=1)
+        x = sample_from_logits(logits[:, -1, :], temperature, sample_logits, top_k=top_k, top_p=top_p)
         # append to the sequence and continue
         sample = torch.cat((sample, x), dim=1)
     del past
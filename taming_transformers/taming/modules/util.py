@@ -1,5 +1,42 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+
+# "fused" runs torch's scaled_dot_product_attention where available (torch>=2.0). Its flash
+# and memory efficient kernels never hold the (n, m) attention weights, but its math kernel
+# does, e.g. on CPU, and on torch 2.0 whenever a mask is passed, as the masked attention of
+# CausalSelfAttention does.
+# "chunked" holds at most ATTENTION_CHUNK_SIZE rows of the weights, (chunk, m) per batch and
+# head, at once: 256 x 1024 rather than 1024 x 1024 for a 32x32 latent.
+ATTENTION_BACKEND = "fused"
+ATTENTION_CHUNK_SIZE = 256
+
+
+def attention(q, k, v, mask=None, is_causal=False, dropout_p=0.0):
+    """
+    softmax(q k^T / sqrt(d)) v for q of shape (..., n, d) and k, v of shape (..., m, d).
+    mask is boolean and broadcasts to (..., n, m), True where attention is allowed.
+    """
+    if ATTENTION_BACKEND == "fused" and hasattr(F, "scaled_dot_product_attention"):
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=dropout_p, is_causal=is_causal)
+
+    n, m = q.shape[-2], k.shape[-2]
+    scale = q.shape[-1] ** -0.5
+    out = q.new_empty(q.shape[:-1] + v.shape[-1:])
+    for start in range(0, n, ATTENTION_CHUNK_SIZE):
+        end = min(start + ATTENTION_CHUNK_SIZE, n)
+        w = (q[..., start:end, :] @ k.transpose(-2, -1)) * scale
+        if mask is not None:
+            w = w.masked_fill(~mask[..., start:end, :], float('-inf'))
+        if is_causal:
+            rows = torch.arange(start, end, device=q.device)[:, None]
+            w = w.masked_fill(rows < torch.arange(m, device=q.device), float('-inf'))
+        w = F.softmax(w, dim=-1)
+        if dropout_p > 0:
+            w = F.dropout(w, dropout_p)
+        out[..., start:end, :] = w @ v
+    return out
 
 
 def count_params(model):